@@ -0,0 +1,405 @@
+import os
+import re
+import signal
+import selectors
+import subprocess
+import tempfile
+import threading
+import time
+import logging
+from collections import OrderedDict, deque
+import yaml
+import metrics
+
+try:
+    import ansible_runner
+except ImportError:  # fall back to driving the ansible-playbook CLI
+    ansible_runner = None
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+PLAYBOOK_DIR = os.path.join(BASE_DIR, "ansible-playbook")
+ANSIBLE_FORKS = int(os.environ.get("ANSIBLE_FORKS", "20"))
+# Wall-clock limit of one playbook run in seconds, hung runs are killed
+ANSIBLE_RUN_TIMEOUT = int(os.environ.get("ANSIBLE_RUN_TIMEOUT", "7200"))
+# Output lines kept in memory per run, and number of runs kept
+OUTPUT_BUFFER_LINES = int(os.environ.get("ANSIBLE_OUTPUT_LINES", "2000"))
+OUTPUT_BUFFER_RUNS = 100
+# Longest line passed on as one piece, longer ones are split
+MAX_LINE_BYTES = 64 * 1024
+
+_output_buffers = OrderedDict()
+_output_lock = threading.Lock()
+
+# ansible-playbook processes running now, by pid, each in its own process group
+_processes = {}
+_processes_lock = threading.Lock()
+_stopping = threading.Event()
+
+# ansible-runner event names we pass on, everything else is dropped
+RUNNER_EVENTS = {
+    "playbook_on_play_start": "play_start",
+    "playbook_on_task_start": "task_start",
+    "runner_on_ok": "ok",
+    "runner_on_failed": "failed",
+    "runner_on_skipped": "skipped",
+    "runner_on_unreachable": "unreachable",
+    "playbook_on_stats": "stats",
+}
+
+# Default stdout callback lines, used when ansible-runner is not installed
+_PLAY_RE = re.compile(r"^PLAY \[(?P<name>.*)\] \**$")
+_TASK_RE = re.compile(r"^TASK \[(?P<name>.*)\] \**$")
+_RESULT_RE = re.compile(r"^(?P<status>ok|changed|skipping|fatal|failed|unreachable): \[(?P<host>[^\]]+)\]")
+_RECAP_RE = re.compile(r"^(?P<host>\S+)\s+:\s+(?P<counts>(\w+=\d+\s*)+)$")
+
+
+def build_inventory(hosts, group="hypervisors"):
+    """Inventory dict with one host per target, carrying its own vars."""
+    return {"all": {"children": {group: {"hosts": hosts}}}}
+
+
+def output_buffer(keys):
+    """Bounded ring buffer of output lines shared by ``keys`` (e.g. job ids)."""
+    buffer = deque(maxlen=OUTPUT_BUFFER_LINES)
+    with _output_lock:
+        for key in keys:
+            _output_buffers[key] = buffer
+            _output_buffers.move_to_end(key)
+        while len(_output_buffers) > OUTPUT_BUFFER_RUNS:
+            _output_buffers.popitem(last=False)
+    return buffer
+
+
+def get_output(key):
+    """Last output lines recorded for ``key``, or None if not kept."""
+    with _output_lock:
+        buffer = _output_buffers.get(key)
+        return list(buffer) if buffer is not None else None
+
+
+class PlaybookRun:
+    """Outcome of one playbook run across one or more hosts."""
+
+    def __init__(self, playbook, hosts):
+        self.playbook = playbook
+        self.hosts = list(hosts)
+        self.rc = None
+        self.timed_out = False
+        self.events = []
+        self.failed_hosts = set()
+        self._play = None
+        self._task = None
+
+    def host_ok(self, host):
+        if self.rc == 0:
+            return True
+        # Without a recap (e.g. syntax error) we cannot tell which host broke
+        if not self.failed_hosts and not any(e["event"] == "stats" for e in self.events):
+            return False
+        return host not in self.failed_hosts
+
+    def add_event(self, event, host=None, **extra):
+        record = {"event": event, "host": host, "play": self._play, "task": self._task}
+        record.update(extra)
+        self.events.append(record)
+        return record
+
+
+def _host_name(host):
+    # Delegated results read "host -> delegate"
+    return host.split(" -> ")[0].strip() if host else host
+
+
+def _runner_event(run, raw, event_handler):
+    event = RUNNER_EVENTS.get(raw.get("event"))
+    if event is None:
+        return
+    data = raw.get("event_data", {})
+    if event == "play_start":
+        run._play = data.get("play")
+        return
+    if event == "task_start":
+        run._task = data.get("task")
+    if event == "stats":
+        for key in ("failures", "dark"):
+            run.failed_hosts.update((data.get(key) or {}).keys())
+    if event in ("failed", "unreachable") and data.get("ignore_errors"):
+        event = "ignored"
+    record = run.add_event(event, _host_name(data.get("host")),
+                           changed=bool(data.get("res", {}).get("changed")))
+    if event_handler:
+        event_handler(record)
+    return record
+
+
+def _parse_stdout_line(run, line, event_handler):
+    record = None
+    m = _PLAY_RE.match(line)
+    if m:
+        run._play = m.group("name")
+        return
+    if line.startswith("PLAY RECAP"):
+        run._task = None
+        return
+    m = _TASK_RE.match(line)
+    if m:
+        run._task = m.group("name")
+        record = run.add_event("task_start")
+    else:
+        m = _RESULT_RE.match(line)
+        if m:
+            status = m.group("status")
+            event = {"changed": "ok", "skipping": "skipped", "fatal": "failed"}.get(status, status)
+            record = run.add_event(event, _host_name(m.group("host")), changed=status == "changed")
+        elif line.strip() == "...ignoring" and run.events and run.events[-1]["event"] == "failed":
+            run.events[-1]["event"] = "ignored"
+            record = run.events[-1]
+        else:
+            m = _RECAP_RE.match(line)
+            if m:
+                counts = dict(c.split("=") for c in m.group("counts").split())
+                host = m.group("host")
+                if int(counts.get("failed", 0)) or int(counts.get("unreachable", 0)):
+                    run.failed_hosts.add(host)
+                record = run.add_event("stats", host, counts=counts)
+    if record and event_handler:
+        event_handler(record)
+    return record
+
+
+def _line_context(run, record=None):
+    # Lets job_logs attribute a line to the job of its host or VM; recap
+    # lines belong to their host, not to the last task
+    if record and record["event"] == "stats":
+        return {"ansible_host": record["host"], "ansible_task": None}
+    return {"ansible_host": record["host"] if record else None, "ansible_task": run._task}
+
+
+def _run_with_runner(run, inventory, extravars, forks, event_handler, log_prefix, output, timeout):
+    def on_event(raw):
+        record = _runner_event(run, raw, event_handler)
+        if raw.get("stdout"):
+            lines = raw["stdout"].splitlines()
+            output.extend(lines)
+            context = _line_context(run, record)
+            for line in lines:
+                logging.info(f"[Ansible STDOUT]{log_prefix} {line}", extra=context)
+        return True
+
+    with tempfile.TemporaryDirectory(prefix="ansible-run-") as private_dir:
+        result = ansible_runner.run(
+            private_data_dir=private_dir,
+            project_dir=PLAYBOOK_DIR,
+            playbook=run.playbook,
+            inventory=inventory,
+            extravars=extravars,
+            forks=forks,
+            timeout=timeout,
+            quiet=True,
+            envvars={"ANSIBLE_CONFIG": os.path.join(PLAYBOOK_DIR, "ansible.cfg")},
+            event_handler=on_event,
+            # The pexpect child is not tracked by pid: it gets SIGHUP when
+            # this process exits and its pty closes
+            cancel_callback=_stopping.is_set,
+        )
+        run.rc = result.rc
+        run.timed_out = result.status == "timeout"
+
+
+def _group_alive(pgid):
+    try:
+        os.killpg(pgid, 0)
+        return True
+    except (ProcessLookupError, PermissionError):
+        return False
+
+
+def stop_orphaned_playbook(pid, grace=10):
+    """Stop the process group of a playbook left behind by a dead process.
+
+    ``pid`` is only signalled while it still is an ansible-playbook, not a
+    process that reused the id. Returns True if a playbook was stopped.
+    """
+    try:
+        with open(f"/proc/{pid}/cmdline", "rb") as f:
+            cmdline = f.read()
+    except OSError:
+        return False
+    if b"ansible-playbook" not in cmdline or not _group_alive(pid):
+        return False
+    logging.warning(f"Stopping orphaned ansible-playbook process group {pid}")
+    os.killpg(pid, signal.SIGTERM)
+    deadline = time.monotonic() + grace
+    while _group_alive(pid) and time.monotonic() < deadline:
+        time.sleep(0.2)
+    if _group_alive(pid):
+        os.killpg(pid, signal.SIGKILL)
+    return True
+
+
+def terminate_playbooks(grace=10):
+    """Stop every playbook run of this process, on shutdown.
+
+    The runs fail as if the playbook had crashed, so their jobs record the
+    VMs as failed; no new run starts afterwards.
+    """
+    _stopping.set()
+    with _processes_lock:
+        running = list(_processes.items())
+    for pid, (process, log_prefix) in running:
+        logging.error(f"Stopping ansible-playbook {pid} for {log_prefix}, the worker is shutting down")
+    threads = [threading.Thread(target=_kill_process_group, args=(process, grace))
+               for _, (process, _) in running]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return len(running)
+
+
+def _kill_process_group(process, grace=10):
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+        process.wait(grace)
+    except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def pump_process(process, on_stdout, on_stderr, timeout=None):
+    """Drain stdout and stderr of ``process`` concurrently, line by line.
+
+    Both pipes are read as soon as data is available, so neither can fill up
+    and block the child. Partial lines are held back until complete (up to
+    MAX_LINE_BYTES). If ``timeout`` seconds pass, the process group is
+    killed. Returns True if the process was killed for running too long.
+    """
+    callbacks = {process.stdout.fileno(): on_stdout, process.stderr.fileno(): on_stderr}
+    partial = {fd: b"" for fd in callbacks}
+    deadline = time.monotonic() + timeout if timeout else None
+
+    with selectors.DefaultSelector() as sel:
+        for fd in callbacks:
+            sel.register(fd, selectors.EVENT_READ)
+        while sel.get_map():
+            wait = 1.0
+            if deadline is not None:
+                wait = deadline - time.monotonic()
+                if wait <= 0:
+                    _kill_process_group(process)
+                    for fd, rest in partial.items():
+                        if rest:
+                            callbacks[fd](rest.decode(errors="replace"))
+                    return True
+            for key, _ in sel.select(timeout=min(wait, 1.0)):
+                fd = key.fd
+                chunk = os.read(fd, 65536)
+                if not chunk:
+                    sel.unregister(fd)
+                    if partial[fd]:
+                        callbacks[fd](partial[fd].decode(errors="replace"))
+                    continue
+                lines = (partial[fd] + chunk).split(b"\n")
+                partial[fd] = lines.pop()
+                if len(partial[fd]) > MAX_LINE_BYTES:
+                    lines.append(partial[fd])
+                    partial[fd] = b""
+                for line in lines:
+                    callbacks[fd](line.decode(errors="replace").rstrip("\r"))
+    return False
+
+
+def _run_with_cli(run, inventory, extravars, forks, event_handler, log_prefix, output, timeout, on_start):
+    with tempfile.TemporaryDirectory(prefix="ansible-run-") as tmp:
+        inventory_file = os.path.join(tmp, "inventory.yml")
+        vars_file = os.path.join(tmp, "extravars.yml")
+        with open(inventory_file, "w") as f:
+            yaml.safe_dump(inventory, f, sort_keys=False)
+        with open(vars_file, "w") as f:
+            yaml.safe_dump(extravars, f, sort_keys=False)
+
+        cmd = [
+            "ansible-playbook", run.playbook,
+            "-i", inventory_file,
+            "-e", f"@{vars_file}",
+            "--forks", str(forks),
+        ]
+        logging.info(f"Running Ansible: {' '.join(cmd)}")
+
+        process = subprocess.Popen(
+            cmd,
+            cwd=PLAYBOOK_DIR,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            start_new_session=True,
+        )
+        with _processes_lock:
+            _processes[process.pid] = (process, log_prefix)
+            stopping = _stopping.is_set()
+        if stopping:
+            _kill_process_group(process)
+        if on_start is not None:
+            on_start(process.pid)
+
+        def on_stdout(line):
+            output.append(line)
+            record = _parse_stdout_line(run, line, event_handler)
+            logging.info(f"[Ansible STDOUT]{log_prefix} {line}", extra=_line_context(run, record))
+
+        def on_stderr(line):
+            output.append(f"[stderr] {line}")
+            logging.error(f"[Ansible STDERR]{log_prefix} {line}", extra=_line_context(run))
+
+        try:
+            run.timed_out = pump_process(process, on_stdout, on_stderr, timeout)
+        finally:
+            process.stdout.close()
+            process.stderr.close()
+            run.rc = process.wait()
+            with _processes_lock:
+                _processes.pop(process.pid, None)
+
+
+def run_playbook(playbook, hosts, extravars=None, forks=ANSIBLE_FORKS,
+                 event_handler=None, group="hypervisors", output_keys=(),
+                 timeout=ANSIBLE_RUN_TIMEOUT, on_start=None):
+    """Run ``playbook`` from the playbook directory against ``hosts``.
+
+    ``hosts`` maps inventory host names to their host vars, so a single run
+    can target many hypervisors with different VM lists and Ansible's own
+    ``forks`` does the fan-out. Task results are returned as structured
+    events on the PlaybookRun and, if given, passed to ``event_handler`` as
+    they arrive. The process working directory is never changed.
+
+    The last output lines are kept in a bounded buffer readable through
+    get_output() under each of ``output_keys``. A run exceeding ``timeout``
+    seconds is killed and reported as failed with timed_out set.
+    ``on_start(pid)`` is called once the ansible-playbook process runs.
+    """
+    run = PlaybookRun(playbook, hosts)
+    inventory = build_inventory(hosts, group)
+    extravars = extravars or {}
+    log_prefix = f"[{','.join(hosts)}]"
+    output = output_buffer(output_keys)
+    started = time.monotonic()
+
+    if ansible_runner is not None:
+        _run_with_runner(run, inventory, extravars, forks, event_handler, log_prefix, output, timeout)
+    else:
+        _run_with_cli(run, inventory, extravars, forks, event_handler, log_prefix, output, timeout,
+                      on_start)
+
+    if run.timed_out:
+        logging.error(f"Ansible {playbook} for {log_prefix} killed after {timeout}s")
+        output.append(f"[killed after {timeout}s]")
+    metrics.PLAYBOOK_SECONDS.observe(
+        time.monotonic() - started, playbook=playbook,
+        result="timeout" if run.timed_out else "ok" if run.rc == 0 else "failed")
+
+    if run.rc == 0:
+        logging.info(f"Ansible {playbook} finished successfully for {log_prefix}")
+    else:
+        logging.error(f"Ansible {playbook} failed for {log_prefix} with exit code {run.rc}, "
+                      f"failed hosts: {sorted(run.failed_hosts) or 'unknown'}")
+    return run
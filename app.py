@@ -1,82 +1,41 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session
-import sqlite3
+from flask import Flask, render_template, request, redirect, url_for, flash, session, Response, jsonify
 import os
-import paramiko
+import json
 import logging
-from deploy_vm_handler2 import deploy_vm_route
-from delete_vm import delete_vm_handler
-
-LOG_FILE = "vm_deploy.log"
-logging.basicConfig(
-    filename=LOG_FILE,
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S"
-)
+from contextlib import closing
+import db
+import capacity
+from deploy_vm_handler2 import (deploy_vm_route, start_deployment, stages_from_spec,
+                                deployment_status, retry_failed, DeploymentError)
+from delete_vm import queue_vm_deletions
+from hv_inventory import start_inventory_poller, recent_sync_runs
+from ssh_pool import ssh_pool
+import job_queue
+import ansible_engine
+import deploy_events
+import job_logs
+import hv_onboarding
+import ipam
+import metrics
+import metrics_shared
+import inventory_api
+
+job_logs.setup_logging()
 
 app = Flask(__name__)
 app.secret_key = "supersecret"
 
-BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-DB_FILE = os.path.join(BASE_DIR, "hv.db")
-
-def get_db_conn():
-    conn = sqlite3.connect(DB_FILE, check_same_thread=False, timeout=30)
-    try:
-        conn.execute("PRAGMA journal_mode=WAL;")
-        conn.execute("PRAGMA busy_timeout=5000;")
-        conn.execute("PRAGMA synchronous=NORMAL;")
-    except Exception:
-        pass
-    return conn
-
-
-
 def init_db():
-    conn = get_db_conn()
-    c = conn.cursor()
-
-    c.execute('''CREATE TABLE IF NOT EXISTS hypervisors
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  name TEXT, ip TEXT, username TEXT, password TEXT)''')
-
-    c.execute('''CREATE TABLE IF NOT EXISTS vms
-             (id INTEGER PRIMARY KEY AUTOINCREMENT,
-              name TEXT, ip_addr INTEGER, subnetprefix INTEGER, vm_gateway INTEGER, hv_id INTEGER,
-              cpu INTEGER, memory INTEGER, disk INTEGER,
-              status TEXT, vm_type TEXT,
-              FOREIGN KEY (hv_id) REFERENCES hypervisors(id))''')
-
-    
-    conn.commit()
-    try:
-        c.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_vms_unique ON vms (name, hv_id)')
-        conn.commit()
-    except Exception:
-        pass
-
-    conn.close()
+    # Every web and worker process calls this on start, one at a time
+    with closing(db.lock_file("init")):
+        db.migrate()
+        job_logs.prune_job_logs()
 
 
 @app.route('/')
 def index():
     return render_template("index.html")
 
-def check_kvm(ip, username, password):
-    try:
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(ip, username=username, password=password, timeout=10)
-        
-        stdin, stdout, stderr = ssh.exec_command("lsmod | grep kvm")
-        output = stdout.read().decode().strip()
-        ssh.close()
-        
-        return bool(output)
-    except Exception as e:
-        print(f"KVM check failed: {e}")
-        return False
-
 @app.route('/add_hv', methods=['GET', 'POST'])
 def add_hv():
     if request.method == 'POST':
@@ -85,18 +44,34 @@ def add_hv():
         username = request.form['username']
         password = request.form['password']
 
-        if not check_kvm(ip, username, password):
-            return "KVM not installed or not accessible on this host", 400
-            
-        conn = get_db_conn()
-        c = conn.cursor()
-        c.execute("INSERT INTO hypervisors (name, ip, username, password) VALUES (?,?,?,?)",
-                  (name, ip, username, password))
-        conn.commit()
-        conn.close()
+        hv = {"name": name, "ip": ip, "username": username, "password": password}
+        result = hv_onboarding.validate_hv(hv)
+        if not result["ok"]:
+            failed = [f"{check}: {c['detail']}" for check, c in result["checks"].items() if not c["ok"]]
+            return "Hypervisor failed onboarding checks - " + "; ".join(failed), 400
+
+        if not hv_onboarding.insert_hypervisors([hv]):
+            return f"Hypervisor {ip} already added", 400
         return redirect(url_for('dashboard'))
     return render_template("add_hv.html")
 
+@app.route('/add_hv/import', methods=['POST'])
+def import_hvs():
+    upload = request.files.get("file")
+    if upload is None or not upload.filename:
+        return {"error": "No file uploaded"}, 400
+    try:
+        hvs = hv_onboarding.parse_hv_file(upload.filename, upload.read())
+    except ValueError as e:
+        return {"error": str(e)}, 400
+
+    def generate():
+        for result in hv_onboarding.onboard(hvs):
+            yield json.dumps(result) + "\n"
+
+    return Response(generate(), mimetype="application/x-ndjson",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 @app.route('/delete_hv', methods=['POST'])
 def delete_hv():
     selected = request.form.getlist("selected_hvs")
@@ -118,11 +93,8 @@ def delete_hv():
 
 def remove_hv_from_db(hv_id):
     try:
-        conn = sqlite3.connect(DB_FILE)
-        c = conn.cursor()
-        c.execute("DELETE FROM hypervisors WHERE id=?", (hv_id,))
-        conn.commit()
-        conn.close()
+        db.execute("DELETE FROM hypervisors WHERE id=?", (hv_id,))
+        capacity.invalidate()
         flash(f"Hypervisor {hv_id} removed from DB.", "success")
     except Exception as e:
         flash(f"Failed to remove HV {hv_id}: {e}", "error")
@@ -140,224 +112,194 @@ def delete_vm():
         flash("No VMs selected for deletion!", "error")
         return redirect(url_for("dashboard"))
 
+    vms = []
     for vm_info in selected:
         try:
-            vm_name, hv_ip = vm_info.split("::")
+            vm_name, hv_id = vm_info.split("::")
+            vms.append((vm_name, int(hv_id)))
         except ValueError:
             flash(f"Invalid VM info: {vm_info}", "error")
             continue
-        delete_vm_handler(vm_name, hv_ip)
 
+    queued = queue_vm_deletions(vms)
+    if queued:
+        flash(f"Deletion of {queued} VM(s) queued.", "success")
     return redirect(url_for('dashboard'))
 
 
-def get_hv_resources(ip, username, password):
-    try:
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(ip, username=username, password=password, timeout=10)
-
-        stdin, stdout, _ = ssh.exec_command("virsh nodeinfo")
-        output = stdout.read().decode()
-        hv_info = {}
-        for line in output.splitlines():
-            if ":" in line:
-                key, value = line.split(":", 1)
-                hv_info[key.strip()] = value.strip()
-
-        total_cpu = int(hv_info.get("CPU(s)", 0))
-        total_mem = int(hv_info.get("Memory size", "0").split()[0]) // 1024 // 1024
-        total_disk = 5000
-
-        stdin, stdout, _ = ssh.exec_command("virsh list --name | grep -v guestfs")
-        vms = [v.strip() for v in stdout.read().decode().splitlines() if v.strip()]
-
-        used_cpu, used_mem = 0, 0
-        for vm in vms:
-            stdin, stdout, _ = ssh.exec_command(f"virsh dominfo {vm}")
-            dominfo = stdout.read().decode()
-            if not dominfo.strip():
-                continue
-            vm_cpu, vm_mem = 0, 0
-            for line in dominfo.splitlines():
-                if "CPU(s)" in line and not "CPU time" in line:
-                    vm_cpu = int(line.split(":")[1].strip())
-                elif line.strip().startswith("Max memory:"):
-                    vm_mem = int(line.split(":")[1].strip().split()[0]) // 1024 // 1024
-
-            used_cpu += vm_cpu
-            used_mem += vm_mem
-        ssh.close()
-
-        return total_cpu, total_mem, total_disk, used_cpu, used_mem
-
-    except Exception as e:
-        print(f"[WARN] Could not fetch HV resources from {ip}: {e}")
-        return 0, 0, 0, 0, 0
-
-
-def sync_vms_from_hv(hv_id, hv_ip, hv_user, hv_pass):
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    ssh.connect(hv_ip, username=hv_user, password=hv_pass)
-
-    stdin, stdout, stderr = ssh.exec_command("virsh list --name")
-    vm_list = [vm.strip() for vm in stdout.readlines() if vm.strip()]
-
-    conn = get_db_conn()
-    c = conn.cursor()
-
-    for vm in vm_list:
-        cpu, memory, disk = 0, 0, 0
-
-        stdin, stdout, stderr = ssh.exec_command(f"virsh dominfo {vm}")
-        dominfo = stdout.read().decode()
-        for line in dominfo.splitlines():
-            if line.startswith("CPU(s):"):
-                cpu = int(line.split(":")[1].strip())
-            if line.startswith("Max memory:"):
-                memory = int(line.split(":")[1].strip().split()[0]) // 1024 // 1024
-
-        stdin, stdout, stderr = ssh.exec_command(f"virsh domblklist {vm} --details")
-        blk_lines = stdout.read().decode().splitlines()
-        for line in blk_lines:
-            if "disk" in line and ".qcow2" in line:
-                parts = line.split()
-                if len(parts) >= 4:
-                    disk_file = parts[3]
-                    stdin2, stdout2, stderr2 = ssh.exec_command(f"virsh domblkinfo {vm} {disk_file}")
-                    info = stdout2.read().decode()
-                    disk = 0
-                    for l in info.splitlines():
-                        if l.startswith("Capacity:"):
-                            disk = int(l.split()[1]) // (1024 ** 3)
-                            break
-        c.execute(
-            "SELECT id FROM vms WHERE name=? AND hv_id=?", (vm, hv_id)
-        )
-        row = c.fetchone()
-        if row:
-            c.execute(
-                "UPDATE vms SET cpu=?, memory=?, disk=? WHERE id=?",
-                (cpu, memory, disk, row[0]),
-            )
-        else:
-            c.execute(
-                "INSERT INTO vms (name, hv_id, cpu, memory, disk) VALUES (?, ?, ?, ?, ?)",
-                (vm, hv_id, cpu, memory, disk),
-            )
-
-    conn.commit()
-    conn.close()
-    ssh.close()
-
-def refresh_vm_status(hv_ip, hv_user, hv_pass, hv_id):
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    ssh.connect(hv_ip, username=hv_user, password=hv_pass, timeout=10)
-
-    conn = get_db_conn()
-    c = conn.cursor()
-
-    c.execute("SELECT name FROM vms WHERE hv_id=?", (hv_id,))
-    vms = [row[0] for row in c.fetchall()]
-
-    for vm in vms:
-        stdin, stdout, _ = ssh.exec_command(f"virsh domstate {vm}")
-        state = stdout.read().decode().strip() or "Unknown"
-        c.execute("UPDATE vms SET status=? WHERE name=? AND hv_id=?", (state, vm, hv_id))
-    
-    conn.commit()
-    conn.close()
-    ssh.close()
-
 @app.route('/dashboard')
+@metrics.PAGE_RENDER_SECONDS.time(page="dashboard")
 def dashboard():
-    conn = get_db_conn()
-    c = conn.cursor()
-
-    c.execute("SELECT id, name, ip, username, password FROM hypervisors")
-    hypervisors = c.fetchall()
-
-    for hv in hypervisors:
-        hv_id, hv_name, hv_ip, hv_user, hv_pass = hv
-        try:
-            sync_vms_from_hv(hv_id, hv_ip, hv_user, hv_pass)
-            refresh_vm_status(hv_ip, hv_user, hv_pass, hv_id)
-        except Exception as e:
-            app.logger.exception(f"Failed to sync hypervisor {hv_ip}: {e}")
-
-    c.execute("""SELECT vms.name, vms.ip_addr, vms.subnetprefix, vms.vm_gateway,
-                        vms.cpu, vms.memory, vms.disk, vms.status, hypervisors.name
-                 FROM vms JOIN hypervisors ON vms.hv_id = hypervisors.id""")
-    vms = c.fetchall()
-    conn.close()
-
-    hv_resources = {}
-    all_vm_resources = [] 
-
-    for hv in hypervisors:
-        hv_id, hv_name, hv_ip, hv_user, hv_pass = hv
-        total_cpu, total_mem, total_disk, used_cpu, used_mem = get_hv_resources(hv_ip, hv_user, hv_pass)
-        hv_vms = [vm for vm in vms if vm[8] == hv_name]
-        used_disk = sum([vm[6] for vm in hv_vms])
-        
-        hv_resources[hv_name] = {
-            "id": hv_id,
-            "total_cpu": total_cpu,
-            "used_cpu": used_cpu,
-            "remaining_cpu": total_cpu - used_cpu,
-            "total_mem": total_mem,
-            "used_mem": used_mem,
-            "remaining_mem": total_mem - used_mem,
-            "total_disk": total_disk,
-            "used_disk": used_disk,
-            "remaining_disk": total_disk - used_disk,
-        }
-
-        conn = get_db_conn()
-        conn.row_factory = sqlite3.Row
-        c = conn.cursor()
-        c.execute("SELECT name, cpu, memory, disk, status, ip_addr FROM vms WHERE hv_id=?", (hv_id,))
-        db_vms = c.fetchall()
-        conn.close()
-
-        for vm in db_vms:
-            all_vm_resources.append({
-                "name": vm["name"],
-                "cpu": vm["cpu"],
-                "memory": vm["memory"],
-                "disk": vm["disk"],
-                "status": vm["status"],
-                "ip_addr": vm["ip_addr"],
-                "hv_ip": hv_ip
-            })    
+    hosts = list(capacity.get_capacity().values())
+    hv_resources = {hv["name"]: hv for hv in hosts}
 
+    total = capacity.totals(hosts)
     total_remaining = {
-        "cpu": sum(res["remaining_cpu"] for res in hv_resources.values()),
-        "memory": sum(res["remaining_mem"] for res in hv_resources.values()),
-        "disk": sum(res["remaining_disk"] for res in hv_resources.values())
+        "cpu": total["remaining_cpu"],
+        "memory": total["remaining_mem"],
+        "disk": total["remaining_disk"],
     }
+    total_cpu = total["total_cpu"]
+    total_mem = total["total_mem"]
+    total_disk = total["total_disk"]
+    used_cpu = total["used_cpu"]
+    used_mem = total["used_mem"]
 
-    total_cpu = sum(res["total_cpu"] for res in hv_resources.values())
-    total_mem = sum(res["total_mem"] for res in hv_resources.values())
-    total_disk = sum(res["total_disk"] for res in hv_resources.values())
-    used_cpu = sum(res["used_cpu"] for res in hv_resources.values())
-    used_mem = sum(res["used_mem"] for res in hv_resources.values())
-
+    # The VM table is paged in by the browser from /api/vms
     return render_template(
         "dashboard.html",
         hv_resources=hv_resources,
-        vms=vms,
         remaining=total_remaining,
         total_cpu=total_cpu,
         total_mem=total_mem,
         total_disk=total_disk,
         used_cpu=used_cpu,
         used_mem=used_mem,
-        hv_vm_resources=all_vm_resources
+        vm_statuses=[r["status"] for r in db.query("SELECT DISTINCT status FROM vms WHERE status IS NOT NULL ORDER BY status")],
+        vm_types=[r["vm_type"] for r in db.query("SELECT DISTINCT vm_type FROM vms WHERE vm_type IS NOT NULL ORDER BY vm_type")],
+        last_event_id=deploy_events.last_event_id()
     )
 
+def _conditional_json(body):
+    """JSON response with an ETag, 304 when the client already has it."""
+    response = jsonify(body)
+    response.headers["Cache-Control"] = "no-cache"
+    response.add_etag()
+    return response.make_conditional(request)
+
+@app.route('/api/vms')
+def vms_api():
+    try:
+        page = inventory_api.list_vms(request.args)
+    except inventory_api.QueryError as e:
+        return {"error": str(e)}, 400
+    return _conditional_json(page)
+
+@app.route('/api/hypervisors')
+def hypervisors_api():
+    try:
+        page = inventory_api.list_hypervisors(request.args)
+    except inventory_api.QueryError as e:
+        return {"error": str(e)}, 400
+    return _conditional_json(page)
+
+@app.route('/api/ssh_pool')
+def ssh_pool_stats():
+    return ssh_pool.stats()
+
+@app.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics_shared.render(), content_type=metrics.CONTENT_TYPE)
+
+@app.route('/api/capacity')
+def capacity_api():
+    hosts = list(capacity.get_capacity().values())
+    return {
+        "ttl": capacity.CAPACITY_TTL,
+        "age": capacity.snapshot_age(),
+        "hypervisors": hosts,
+        "totals": capacity.totals(hosts),
+    }
+
+@app.route('/api/deployments', methods=['POST'])
+def deployments_create():
+    spec = request.get_json(silent=True) or {}
+    hypervisors = db.query("SELECT id, name, ip, username, password FROM hypervisors ORDER BY id ASC")
+    if spec.get("hv_ids"):
+        hypervisors = [hv for hv in hypervisors if hv["id"] in spec["hv_ids"]]
+    try:
+        stages = stages_from_spec(spec)
+        run_tag, jobs = start_deployment(hypervisors, stages, spec.get("placement") or "spread",
+                                         spec.get("name") or "deployment")
+    except DeploymentError as e:
+        return {"error": str(e), "problems": e.problems}, 400
+    return {"run_tag": run_tag, "jobs": jobs}, 202
+
+@app.route('/api/deployments/<run_tag>')
+def deployment_get(run_tag):
+    status = deployment_status(run_tag)
+    if status is None:
+        return {"error": f"Unknown deployment {run_tag}"}, 404
+    return status
+
+@app.route('/api/subnets', methods=['GET', 'POST'])
+def subnets():
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or request.form
+        if not data.get("cidr"):
+            return {"error": "cidr is required"}, 400
+        try:
+            subnet_id = ipam.add_subnet(data["cidr"], data.get("gateway") or None, data.get("name") or None,
+                                        data.get("range_start") or None, data.get("range_end") or None)
+        except ipam.IPAMError as e:
+            return {"error": str(e)}, 400
+        return {"id": subnet_id}, 201
+    return {"subnets": ipam.list_subnets()}
+
+@app.route('/api/subnets/<int:subnet_id>/allocations')
+def subnet_allocations(subnet_id):
+    return {"id": subnet_id, "allocations": ipam.allocations(subnet_id)}
+
+@app.route('/api/sync_runs')
+def sync_runs_list():
+    return {"runs": recent_sync_runs(request.args.get("limit", 100, type=int))}
+
+@app.route('/api/jobs')
+def jobs_list():
+    return {"jobs": job_queue.list_jobs()}
+
+@app.route('/api/jobs/<int:job_id>/cancel', methods=['POST'])
+def job_cancel(job_id):
+    if not job_queue.cancel(job_id):
+        return {"error": f"Job {job_id} is not queued"}, 409
+    return {"id": job_id, "state": "cancelled"}
+
+@app.route('/api/jobs/<int:job_id>/retry', methods=['POST'])
+def job_retry(job_id):
+    try:
+        new_id = retry_failed(job_id)
+    except DeploymentError as e:
+        return {"error": str(e)}, 409
+    if new_id is None:
+        return {"error": f"Unknown deploy job {job_id}"}, 404
+    return {"id": new_id, "retry_of": job_id}, 202
+
+@app.route('/api/jobs/<int:job_id>/output')
+def job_output(job_id):
+    lines = ansible_engine.get_output(job_id)
+    if lines is None:
+        # Ran in the worker process, or before a restart
+        lines = job_logs.ansible_output(job_id, ansible_engine.OUTPUT_BUFFER_LINES)
+    if lines is None:
+        return {"error": f"No output kept for job {job_id}"}, 404
+    return {"id": job_id, "lines": lines}
+
+@app.route('/api/jobs/<int:job_id>/log')
+def job_log(job_id):
+    return {"id": job_id, "records": job_logs.job_log(job_id)}
+
+@app.route('/api/vm_log/<vm_name>')
+def vm_log(vm_name):
+    job_id, records = job_logs.vm_log(vm_name, request.args.get("hv_id", type=int))
+    if job_id is None:
+        return {"error": f"No deployment log for VM {vm_name}"}, 404
+    return {"vm_name": vm_name, "job_id": job_id, "records": records}
+
+@app.route('/api/deploy_events')
+def deploy_events_list():
+    after = request.args.get("after", 0, type=int)
+    return {"events": deploy_events.events_since(after)}
+
+@app.route('/api/deploy_events/stream')
+def deploy_events_stream():
+    after = request.headers.get("Last-Event-ID", type=int) or request.args.get("after", 0, type=int)
+    stream = deploy_events.open_stream(after)
+    if stream is None:
+        # The dashboard falls back to polling /api/deploy_events
+        return {"error": "Too many open event streams"}, 503, {"Retry-After": "30"}
+    return Response(stream, mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 # @app.route('/refresh_hv/<int:hv_id>', methods=['POST'])
 # def refresh_hv(hv_id):
 #     conn = get_db_conn()
@@ -387,5 +329,12 @@ def dashboard():
 
 
 if __name__ == "__main__":
+    # Development server running the background work in-process; in
+    # production serve wsgi:app with gunicorn and run worker.py next to it
     init_db()
+    try:
+        job_queue.start_job_workers()
+        start_inventory_poller()
+    except job_queue.WorkersRunningError as e:
+        logging.warning(f"{e}, serving the web UI only")
     app.run(debug=False)
@@ -0,0 +1,222 @@
+"""Load-test the dashboard, deploy and delete routes against simulated hypervisors.
+
+Starts a fleet of fake SSH hypervisors (fake_hypervisor.py) and a stub
+ansible-playbook, loads their inventory into a scratch database, then
+drives the Flask routes from concurrent clients and reports latency
+percentiles, SSH round-trips and SQLite write-lock waits per phase.
+
+Usage: python benchmarks/bench_app.py [--hosts 50] [--domains 100] [--concurrency 8]
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+
+class Phase:
+    """Latencies and counter deltas of one benchmark phase."""
+
+    def __init__(self, name, metrics, fleet):
+        self.name = name
+        self.latencies = []
+        self.errors = 0
+        self._metrics = metrics
+        self._fleet = fleet
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        self._ssh = self._metrics.SSH_COMMAND_SECONDS.total()[0]
+        self._commands = sum(hv.commands for hv in self._fleet)
+        self._locks = self._metrics.DB_LOCK_WAIT_SECONDS.total()
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self._started
+        self.ssh_calls = self._metrics.SSH_COMMAND_SECONDS.total()[0] - self._ssh
+        self.fake_commands = sum(hv.commands for hv in self._fleet) - self._commands
+        count, total = self._metrics.DB_LOCK_WAIT_SECONDS.total()
+        self.lock_waits = count - self._locks[0]
+        self.lock_wait_seconds = total - self._locks[1]
+
+    def record(self, seconds, ok=True):
+        with self._lock:
+            self.latencies.append(seconds)
+            if not ok:
+                self.errors += 1
+
+    def report(self):
+        ms = [s * 1000 for s in self.latencies]
+        line = f"{self.name:<12} n={len(ms):<5} err={self.errors:<4}"
+        if ms:
+            line += (f" p50={percentile(ms, 50):8.1f}ms p90={percentile(ms, 90):8.1f}ms"
+                     f" p99={percentile(ms, 99):8.1f}ms max={max(ms):8.1f}ms"
+                     f" {len(ms) / self.elapsed:7.1f} req/s")
+        else:
+            line += f" took {self.elapsed:.2f}s"
+        line += (f" | ssh={self.ssh_calls} (server saw {self.fake_commands})"
+                 f" | db lock waits={self.lock_waits} ({self.lock_wait_seconds * 1000:.1f}ms)")
+        print(line)
+
+
+def drive(phase, requests, concurrency, app, send):
+    """Issue ``requests`` calls of ``send(client, i)`` from ``concurrency`` threads.
+
+    ``send`` returns True when the response is the expected one.
+    """
+    local = threading.local()
+
+    def one(i):
+        client = getattr(local, "client", None)
+        if client is None:
+            client = local.client = app.test_client()
+        started = time.perf_counter()
+        try:
+            ok = send(client, i)
+        except Exception as e:
+            print(f"  {phase.name} request {i} raised {e!r}")
+            ok = False
+        phase.record(time.perf_counter() - started, ok)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, range(requests)))
+
+
+def wait_for_jobs(job_queue, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if not any(j["state"] in ("queued", "running") for j in job_queue.list_jobs(1000)):
+            return True
+        time.sleep(0.2)
+    return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--hosts", type=int, default=50, help="simulated hypervisors")
+    parser.add_argument("--domains", type=int, default=100, help="domains per hypervisor")
+    parser.add_argument("--concurrency", type=int, default=8, help="concurrent clients")
+    parser.add_argument("--requests", type=int, default=200, help="dashboard requests")
+    parser.add_argument("--deploys", type=int, default=20, help="deploy requests")
+    parser.add_argument("--deletes", type=int, default=20, help="delete requests")
+    parser.add_argument("--vms-per-deploy", type=int, default=2)
+    parser.add_argument("--latency-ms", type=float, default=5, help="mean latency of an SSH command")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="share of SSH commands that fail")
+    parser.add_argument("--task-seconds", type=float, default=0.01, help="duration of a stub Ansible task")
+    parser.add_argument("--port", type=int, default=2222, help="SSH port of the simulated fleet")
+    parser.add_argument("--keep", action="store_true", help="keep the scratch directory")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench-app-")
+    # Configuration is read at import time, so it must be in place first
+    os.environ.update({
+        "HV_DB_FILE": os.path.join(workdir, "hv.db"),
+        "LOG_DIR": os.path.join(workdir, "logs"),
+        "SSH_PORT": str(args.port),
+        "SSH_CONNECT_TIMEOUT": "5",
+        "JOB_MAX_PER_HV": "1",
+        "BENCH_ANSIBLE_TASK_SECONDS": str(args.task_seconds),
+        "PATH": os.path.join(BENCH_DIR, "bin") + os.pathsep + os.environ.get("PATH", ""),
+    })
+    sys.path.insert(0, os.path.dirname(BENCH_DIR))
+    import logging
+    import app as webapp
+    import db
+    import metrics
+    import capacity
+    import job_queue
+    import hv_inventory
+    from fake_hypervisor import start_fleet
+    logging.getLogger().setLevel(logging.WARNING)
+
+    fleet = start_fleet(args.hosts, args.port, args.domains, args.latency_ms / 1000, args.fail_rate)
+    webapp.init_db()
+    db.executemany("INSERT INTO hypervisors (name, ip, username, password) VALUES (?, ?, 'root', 'x')",
+                   [(f"sim{i:04d}", hv.ip) for i, hv in enumerate(fleet)])
+    flask_app = webapp.app
+    flask_app.config["TESTING"] = True
+    print(f"{args.hosts} hypervisors x {args.domains} domains, concurrency {args.concurrency}, "
+          f"SSH latency {args.latency_ms}ms, fail rate {args.fail_rate}, scratch {workdir}")
+
+    phases = []
+    with Phase("inventory", metrics, fleet) as phase:
+        started = time.perf_counter()
+        hv_inventory.poll_inventory_once()
+        phase.record(time.perf_counter() - started)
+    phases.append(phase)
+
+    with Phase("dashboard", metrics, fleet) as phase:
+        drive(phase, args.requests, args.concurrency, flask_app,
+              lambda client, i: client.get("/dashboard").status_code == 200)
+    phases.append(phase)
+
+    job_queue.start_job_workers()
+
+    def deploy(client, i):
+        hv = fleet[i % len(fleet)]
+        hv_id = db.query_one("SELECT id FROM hypervisors WHERE ip=?", (hv.ip,))["id"]
+        response = client.post("/deploy_vm", data={
+            "name": f"bench{i:04d}-", "vm_type": "other", "vm_count": args.vms_per_deploy,
+            "hv_id": str(hv_id), "cpu": 2, "memory": 4, "disksize": 20,
+        })
+        if response.status_code == 302 and response.headers["Location"].endswith("/dashboard"):
+            return True
+        with client.session_transaction() as session:
+            print(f"  deploy {i} rejected: {[m for _, m in session.pop('_flashes', [])][:2]}")
+        return False
+
+    with Phase("deploy", metrics, fleet) as phase:
+        drive(phase, args.deploys, args.concurrency, flask_app, deploy)
+    phases.append(phase)
+    with Phase("deploy-jobs", metrics, fleet) as phase:
+        if not wait_for_jobs(job_queue, 600):
+            print("  deploy jobs still running after 600s")
+    phases.append(phase)
+
+    victims = [(row["name"], row["hv_id"]) for row in db.query(
+        "SELECT name, hv_id FROM vms WHERE status != 'In-progress' ORDER BY RANDOM() LIMIT ?",
+        (args.deletes,))]
+
+    def delete(client, i):
+        name, hv_id = victims[i]
+        response = client.post("/delete_vm", data={"selected_vms": f"{name}::{hv_id}"})
+        return response.status_code == 302
+
+    with Phase("delete", metrics, fleet) as phase:
+        drive(phase, len(victims), args.concurrency, flask_app, delete)
+    phases.append(phase)
+    with Phase("delete-jobs", metrics, fleet) as phase:
+        if not wait_for_jobs(job_queue, 600):
+            print("  delete jobs still running after 600s")
+    phases.append(phase)
+    job_queue.stop_job_workers()
+
+    print()
+    for phase in phases:
+        phase.report()
+    states = db.query("SELECT kind, state, COUNT(*) AS n FROM jobs GROUP BY kind, state")
+    print("jobs:", ", ".join(f"{r['kind']} {r['state']}={r['n']}" for r in states))
+    print(f"fleet: {sum(hv.commands for hv in fleet)} SSH commands, "
+          f"{sum(hv.failures for hv in fleet)} injected failures")
+    capacity.invalidate()
+    for hv in fleet:
+        hv.stop()
+    if not args.keep:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""Time the placement strategies on a synthetic fleet.
+
+Usage: python benchmarks/bench_placement.py [--hosts 300] [--vms 5000]
+"""
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import placement
+
+
+def synthetic_fleet(count, rng):
+    hosts = []
+    for order in range(count):
+        cpu, mem = rng.choice([(48, 256), (64, 512), (96, 768), (128, 1024)])
+        hosts.append(placement.host_capacity(order + 1, order, (cpu, mem, 20000), (0, 0, 0),
+                                             cpu_ratio=4.0))
+    return hosts
+
+
+def synthetic_vms(count, rng, groups):
+    vms = []
+    for i in range(count):
+        cpu, ram = rng.choice([(2, 4096), (4, 8192), (8, 16384), (16, 65536)])
+        vm = {"name": f"vm{i:05d}", "cpu": cpu, "ram": ram, "disk": 100}
+        if groups and i % 10 == 0:
+            vm["anti_affinity"] = f"cluster{i // 30}"
+        vms.append(vm)
+    return vms
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--hosts", type=int, default=300)
+    parser.add_argument("--vms", type=int, default=5000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    print(f"{args.vms} VMs on {args.hosts} hypervisors, best of {args.repeat}")
+    for strategy in placement.STRATEGIES:
+        best = None
+        for _ in range(args.repeat):
+            rng = random.Random(args.seed)
+            hosts = synthetic_fleet(args.hosts, rng)
+            vms = synthetic_vms(args.vms, rng, groups=True)
+            started = time.perf_counter()
+            plan = placement.place_vms(vms, hosts, strategy)
+            elapsed = (time.perf_counter() - started) * 1000
+            best = elapsed if best is None else min(best, elapsed)
+        used = sum(1 for v in plan.values() if v)
+        print(f"  {strategy:<10} {best:8.2f} ms  ({used} hypervisors used)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,272 @@
+"""Simulated KVM hypervisors reachable over SSH, for benchmarks.
+
+Each FakeHypervisor listens on its own loopback address (127.0.x.y, Linux
+routes the whole 127/8 to lo) on a shared port, accepts any password and
+answers the virsh, ip and df commands the app sends with synthetic output
+for ``domains`` guests. Every command sleeps ``latency`` seconds (with
+jitter) and, with probability ``fail_rate``, drops the connection instead
+of answering.
+"""
+import os
+import re
+import sys
+import time
+import shlex
+import random
+import socket
+import struct
+import threading
+import paramiko
+from paramiko.common import cMSG_CHANNEL_SUCCESS
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from virsh_collect import SECTION_MARKER
+
+GIB = 1024 ** 3
+_SECTION_RE = re.compile(r"echo '" + re.escape(SECTION_MARKER) + r"(?P<name>[^']+)'; (?P<command>.*?) 2>/dev/null(?:; |$)")
+_HOST_KEY = None
+
+
+def host_key():
+    global _HOST_KEY
+    if _HOST_KEY is None:
+        _HOST_KEY = paramiko.RSAKey.generate(2048)
+    return _HOST_KEY
+
+
+def fleet_addresses(count, base="127.0"):
+    """``count`` distinct loopback addresses, 127.0.1.1 onwards."""
+    return [f"{base}.{1 + i // 250}.{1 + i % 250}" for i in range(count)]
+
+
+class _Transport(paramiko.Transport):
+    """Server transport that reports when an exec request was acknowledged.
+
+    paramiko replies to the request only after check_channel_exec_request()
+    returns; answering and closing the channel before that makes the client
+    fail with "Channel closed".
+    """
+
+    def __init__(self, sock):
+        super().__init__(sock)
+        self._acked = {}
+        self._acked_lock = threading.Lock()
+
+    def _event(self, remote_chanid):
+        with self._acked_lock:
+            return self._acked.setdefault(remote_chanid, threading.Event())
+
+    def wait_acked(self, channel, timeout=5):
+        self._event(channel.remote_chanid).wait(timeout)
+        with self._acked_lock:
+            self._acked.pop(channel.remote_chanid, None)
+
+    def _send_user_message(self, data):
+        super()._send_user_message(data)
+        raw = data.asbytes()
+        if raw[:1] == cMSG_CHANNEL_SUCCESS:
+            self._event(struct.unpack(">I", raw[1:5])[0]).set()
+
+
+class FakeHypervisor:
+    def __init__(self, ip, port, domains=50, latency=0.0, fail_rate=0.0, seed=0):
+        self.ip = ip
+        self.port = port
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.commands = 0
+        self.failures = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.domains = [self._domain(i) for i in range(domains)]
+        self._sock = None
+
+    def _domain(self, i):
+        cpu, mem_gb = self._rng.choice([(2, 4), (4, 8), (8, 16), (16, 64)])
+        return {"name": f"sim-{self.ip.replace('.', '-')}-{i:05d}", "cpu": cpu, "memory": mem_gb,
+                "disk": self._rng.choice([50, 100, 200]), "running": self._rng.random() < 0.9,
+                "ip": f"10.{self._rng.randrange(256)}.{self._rng.randrange(256)}.{self._rng.randrange(1, 255)}"}
+
+    # --- command output -------------------------------------------------
+
+    def nodeinfo(self):
+        # Twice what the domains use, so deployments still fit
+        cpu = max(128, 2 * sum(d["cpu"] for d in self.domains))
+        memory_gb = max(1024, 2 * sum(d["memory"] for d in self.domains))
+        return f"CPU model:           x86_64\nCPU(s):              {cpu}\nMemory size:         {memory_gb * 1024 * 1024} KiB\n"
+
+    def domstats(self):
+        out = []
+        for d in self.domains:
+            out += [f"Domain: '{d['name']}'",
+                    f"  state.state={1 if d['running'] else 5}",
+                    f"  balloon.maximum={d['memory'] * 1024 * 1024}",
+                    f"  vcpu.current={d['cpu']}",
+                    "  block.count=1",
+                    "  block.0.name=vda",
+                    f"  block.0.path=/home/images/{d['name']}/{d['name']}.qcow2",
+                    f"  block.0.capacity={d['disk'] * GIB}", ""]
+        return "\n".join(out)
+
+    def pools(self):
+        used = sum(d["disk"] for d in self.domains)
+        capacity = max(20000, used * 2)
+        return (f"Pool: default\nName:           default\nState:          running\n"
+                f"Capacity:       {capacity * GIB}\nAllocation:     {used * GIB}\n"
+                f"Available:      {(capacity - used) * GIB}\n")
+
+    def addresses(self):
+        out = []
+        for d in self.domains:
+            if d["running"]:
+                out += [f"Domain: {d['name']}",
+                        " Name       MAC address          Protocol     Address",
+                        f" vnet0      52:54:00:00:00:01    ipv4         {d['ip']}/24"]
+        return "\n".join(out)
+
+    def dominfo(self, name):
+        d = self._find(name)
+        if d is None:
+            return ""
+        return (f"Name:           {d['name']}\nState:          {'running' if d['running'] else 'shut off'}\n"
+                f"CPU(s):         {d['cpu']}\nMax memory:     {d['memory'] * 1024 * 1024} KiB\n")
+
+    def _find(self, name):
+        return next((d for d in self.domains if d["name"] == name), None)
+
+    def respond(self, command):
+        """Output of one shell command, or of a sectioned collect script."""
+        sections = list(_SECTION_RE.finditer(command))
+        if sections:
+            return "".join(f"{SECTION_MARKER}{m.group('name')}\n{self.respond(m.group('command'))}\n"
+                           for m in sections)
+        try:
+            words = shlex.split(command)
+        except ValueError:
+            words = command.split()
+        if command.startswith("for p in $(virsh pool-list"):
+            return self.pools()
+        if command.startswith("for d in $(virsh list"):
+            return self.addresses()
+        if command.startswith("for ip in"):
+            return ""  # nobody answers ping
+        if words[:2] == ["virsh", "nodeinfo"]:
+            return self.nodeinfo()
+        if words[:2] == ["virsh", "domstats"]:
+            return self.domstats()
+        if words[:2] == ["virsh", "list"]:
+            running_only = "--all" not in words
+            return "\n".join(d["name"] for d in self.domains if d["running"] or not running_only) + "\n"
+        if words[:2] == ["virsh", "dominfo"] and len(words) > 2:
+            return self.dominfo(words[2])
+        if words[:2] == ["virsh", "domstate"] and len(words) > 2:
+            d = self._find(words[2])
+            return ("running" if d["running"] else "shut off") + "\n" if d else ""
+        if words[:2] == ["virsh", "domblklist"] and len(words) > 2:
+            name = words[2]
+            return f" Target   Source\n vda      /home/images/{name}/{name}.qcow2\n"
+        if words[:2] == ["virsh", "domblkinfo"] and len(words) > 3:
+            d = self._find(words[2])
+            return f"Capacity:       {d['disk'] * GIB if d else 0}\n"
+        if words[:2] == ["virsh", "version"]:
+            return "Compiled against library: libvirt 8.0.0\nRunning against daemon: 8.0.0\n"
+        if words[:1] == ["lsmod"]:
+            return "kvm_intel             12345  0\n"
+        if words[:3] == ["ip", "-o", "link"]:
+            return f"5: {words[-1]}: <BROADCAST,MULTICAST,UP,LOWER_UP> mtu 1500\n"
+        if words[:2] == ["ls", "-1d"]:
+            return words[2].replace("*", "23") + "\n"
+        if words[:2] == ["grep", "MemAvailable"]:
+            total_gb = max(1024, 2 * sum(d["memory"] for d in self.domains))
+            used_gb = sum(d["memory"] for d in self.domains if d["running"])
+            return f"MemAvailable:   {(total_gb - used_gb) * 1024 * 1024} kB\n"
+        if words[:1] == ["df"]:
+            return "Filesystem 1G-blocks Used Available Capacity Mounted on\n/dev/sda1 20000G 1000G 19000G 5% /home\n"
+        return ""
+
+    # --- SSH server ------------------------------------------------------
+
+    def _exec(self, channel, command):
+        with self._lock:
+            self.commands += 1
+            fail = self._rng.random() < self.fail_rate
+            delay = self.latency * self._rng.uniform(0.5, 1.5)
+        if delay:
+            time.sleep(delay)
+        transport = channel.get_transport()
+        transport.wait_acked(channel)
+        if fail:
+            # Drop the whole connection, as a rebooting or overloaded host would
+            with self._lock:
+                self.failures += 1
+            transport.close()
+            return
+        try:
+            channel.sendall(self.respond(command).encode())
+            channel.send_exit_status(0)
+        finally:
+            channel.close()
+
+    def _serve_client(self, client):
+        hv = self
+
+        class Server(paramiko.ServerInterface):
+            def check_auth_password(self, username, password):
+                return paramiko.AUTH_SUCCESSFUL
+
+            def get_allowed_auths(self, username):
+                return "password"
+
+            def check_channel_request(self, kind, chanid):
+                return paramiko.OPEN_SUCCEEDED
+
+            def check_channel_exec_request(self, channel, command):
+                threading.Thread(target=hv._exec, args=(channel, command.decode()), daemon=True).start()
+                return True
+
+        transport = _Transport(client)
+        transport.add_server_key(host_key())
+        transport.start_server(server=Server())
+
+    def start(self):
+        self._sock = socket.socket()
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind((self.ip, self.port))
+        self._sock.listen(64)
+        threading.Thread(target=self._accept_loop, daemon=True, name=f"fake-hv-{self.ip}").start()
+        return self
+
+    def _accept_loop(self):
+        while True:
+            try:
+                client, _ = self._sock.accept()
+            except OSError:
+                return  # stopped
+            threading.Thread(target=self._serve_client, args=(client,), daemon=True).start()
+
+    def stop(self):
+        if self._sock is not None:
+            self._sock.close()
+
+
+def start_fleet(count, port, domains=50, latency=0.0, fail_rate=0.0, seed=42):
+    return [FakeHypervisor(ip, port, domains, latency, fail_rate, seed + i).start()
+            for i, ip in enumerate(fleet_addresses(count))]
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Run simulated hypervisors until interrupted.")
+    parser.add_argument("--hosts", type=int, default=10)
+    parser.add_argument("--domains", type=int, default=50)
+    parser.add_argument("--port", type=int, default=2222)
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--fail-rate", type=float, default=0)
+    args = parser.parse_args()
+    fleet = start_fleet(args.hosts, args.port, args.domains, args.latency_ms / 1000, args.fail_rate)
+    print(f"{len(fleet)} hypervisors on {fleet[0].ip}..{fleet[-1].ip} port {args.port}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
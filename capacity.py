@@ -0,0 +1,123 @@
+import os
+import threading
+import time
+import db
+import metrics
+
+# Seconds a capacity snapshot is served before it is rebuilt from the DB.
+# Deploys, deletes and inventory passes invalidate it as soon as they finish,
+# in every process using the DB.
+CAPACITY_TTL = float(os.environ.get("CAPACITY_TTL", "30"))
+
+_lock = threading.Lock()
+_snapshot = None
+_built_at = 0.0
+_generation = None
+
+
+def load_capacity():
+    """Capacity of every hypervisor from the stored inventory, keyed by hv_id.
+
+    cpu is in cores, memory and disk in GB. ``used_*`` are what the HV
+    reports, ``pending_*`` what In-progress deployments will add, and
+    ``provisioned_disk`` the summed disk size of the VMs on the HV.
+    """
+    rows = db.query(
+        """SELECT h.id, h.name, h.ip,
+                  COALESCE(s.total_cpu, 0) AS total_cpu, COALESCE(s.total_mem, 0) AS total_mem,
+                  COALESCE(s.total_disk, 0) AS total_disk, COALESCE(s.used_cpu, 0) AS used_cpu,
+                  COALESCE(s.used_mem, 0) AS used_mem, s.used_disk, s.storage_pool,
+                  s.last_refresh, s.last_error,
+                  COALESCE(v.vm_count, 0) AS vm_count,
+                  COALESCE(v.provisioned_disk, 0) AS provisioned_disk,
+                  COALESCE(v.pending_cpu, 0) AS pending_cpu,
+                  COALESCE(v.pending_mem_mb, 0) AS pending_mem_mb
+           FROM hypervisors h
+           LEFT JOIN hv_status s ON s.hv_id = h.id
+           LEFT JOIN (SELECT hv_id, COUNT(*) AS vm_count,
+                             SUM(disk) AS provisioned_disk,
+                             SUM(CASE WHEN status='In-progress' THEN cpu ELSE 0 END) AS pending_cpu,
+                             SUM(CASE WHEN status='In-progress' THEN memory ELSE 0 END) AS pending_mem_mb
+                      FROM vms GROUP BY hv_id) v ON v.hv_id = h.id
+           ORDER BY h.id"""
+    )
+    hosts = {}
+    for row in rows:
+        # Deployments store the requested RAM in MB
+        pending_mem = row.pop("pending_mem_mb") / 1024
+        if row["used_disk"] is None:
+            row["used_disk"] = row["provisioned_disk"]
+        row.update(
+            pending_mem=pending_mem,
+            remaining_cpu=row["total_cpu"] - row["used_cpu"] - row["pending_cpu"],
+            remaining_mem=row["total_mem"] - row["used_mem"] - pending_mem,
+            remaining_disk=row["total_disk"] - row["used_disk"],
+        )
+        hosts[row["id"]] = row
+    return hosts
+
+
+def _stored_generation():
+    row = db.query_one("SELECT generation FROM cache_generations WHERE name='capacity'")
+    return row["generation"] if row else 0
+
+
+def get_capacity():
+    """Cached result of load_capacity(), rebuilt after CAPACITY_TTL seconds
+    or once any process has called invalidate().
+
+    The returned dicts are shared, callers must not modify them.
+    """
+    global _snapshot, _built_at, _generation
+    with _lock:
+        generation = _stored_generation()
+        if (_snapshot is None or generation != _generation
+                or time.monotonic() - _built_at >= CAPACITY_TTL):
+            _snapshot = load_capacity()
+            _built_at = time.monotonic()
+            _generation = generation
+        return _snapshot
+
+
+def snapshot_age():
+    return time.monotonic() - _built_at if _snapshot is not None else None
+
+
+def invalidate():
+    """Drop the cached snapshot here and in the other processes.
+
+    The next reader rebuilds it.
+    """
+    global _snapshot
+    db.execute("UPDATE cache_generations SET generation = generation + 1 WHERE name='capacity'")
+    with _lock:
+        _snapshot = None
+
+
+def totals(hosts):
+    keys = ("total_cpu", "used_cpu", "pending_cpu", "remaining_cpu",
+            "total_mem", "used_mem", "pending_mem", "remaining_mem",
+            "total_disk", "used_disk", "remaining_disk")
+    return {key: sum(h[key] for h in hosts) for key in keys}
+
+
+# Per-hypervisor gauges exported on /metrics: (metric, capacity key, unit)
+CAPACITY_GAUGES = (
+    ("vmdeploy_hv_cpu_total", "total_cpu", "CPU cores"),
+    ("vmdeploy_hv_cpu_used", "used_cpu", "CPU cores"),
+    ("vmdeploy_hv_memory_total_gb", "total_mem", "memory in GB"),
+    ("vmdeploy_hv_memory_used_gb", "used_mem", "memory in GB"),
+    ("vmdeploy_hv_disk_total_gb", "total_disk", "disk in GB"),
+    ("vmdeploy_hv_disk_used_gb", "used_disk", "disk in GB"),
+)
+
+
+def _capacity_metrics():
+    hosts = get_capacity().values()
+    for name, key, unit in CAPACITY_GAUGES:
+        kind = "total" if key.startswith("total") else "used"
+        yield (name, "gauge", f"{kind.capitalize()} {unit} of the hypervisor, from the last inventory.",
+               [({"hypervisor": h["ip"], "name": h["name"]}, h[key] or 0) for h in hosts])
+
+
+metrics.register_collector(_capacity_metrics)
@@ -0,0 +1,65 @@
+import json
+import time
+import hashlib
+import db
+
+# Stages of vm_creation.yml, in order. The role reports a finished stage
+# with a task named "<vm> | Checkpoint <stage>" and skips stages passed to
+# it in vm.done_stages.
+DEPLOY_STAGES = ("image_staged", "disk_resized", "lvs_laid_out", "guest_configured",
+                 "domain_defined", "autostart_set")
+CHECKPOINT_STEP = "Checkpoint "
+
+# Spec fields that shape what the stages produce; changing any of them
+# invalidates the checkpoints of a VM
+SPEC_FIELDS = ("qcow2_image", "disk", "flatten", "vg_name", "required_partitions",
+               "ipaddr", "prefix", "gateway", "cpu", "ram", "vm_type")
+
+
+def spec_hash(vm):
+    spec = {field: vm.get(field) for field in SPEC_FIELDS}
+    return hashlib.sha256(json.dumps(spec, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+def completed_stages(hv_id, vm_names):
+    """{vm_name: {stage: spec_hash}} of the checkpoints recorded on ``hv_id``."""
+    if not vm_names:
+        return {}
+    placeholders = ",".join("?" * len(vm_names))
+    done = {}
+    for row in db.query(
+        f"SELECT vm_name, stage, spec_hash FROM vm_checkpoints WHERE hv_id=? AND vm_name IN ({placeholders})",
+        (hv_id, *vm_names),
+    ):
+        done.setdefault(row["vm_name"], {})[row["stage"]] = row["spec_hash"]
+    return done
+
+
+def attach(hv_id, vms):
+    """Set spec_hash and done_stages on deploy ``vms`` before a run.
+
+    Only checkpoints recorded for the same spec count, so a VM whose spec
+    changed starts over.
+    """
+    done = completed_stages(hv_id, [vm["name"] for vm in vms])
+    for vm in vms:
+        vm["spec_hash"] = spec_hash(vm)
+        stages = done.get(vm["name"], {})
+        vm["done_stages"] = [s for s in DEPLOY_STAGES if stages.get(s) == vm["spec_hash"]]
+    return vms
+
+
+def record(hv_id, vm_name, stage, spec_hash, job_id=None):
+    db.execute(
+        """INSERT INTO vm_checkpoints (hv_id, vm_name, stage, spec_hash, job_id, completed_at)
+           VALUES (?, ?, ?, ?, ?, ?)
+           ON CONFLICT (hv_id, vm_name, stage) DO UPDATE SET
+               spec_hash=excluded.spec_hash, job_id=excluded.job_id, completed_at=excluded.completed_at""",
+        (hv_id, vm_name, stage, spec_hash, job_id, time.strftime("%Y-%m-%d %H:%M:%S")),
+    )
+
+
+def clear(conn, hv_id, vm_names):
+    """Forget the checkpoints of VMs that were deployed or removed."""
+    conn.executemany("DELETE FROM vm_checkpoints WHERE hv_id=? AND vm_name=?",
+                     [(hv_id, name) for name in vm_names])
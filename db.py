@@ -0,0 +1,294 @@
+import os
+import fcntl
+import sqlite3
+import threading
+import logging
+from contextlib import contextmanager
+import metrics
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DB_FILE = os.environ.get("HV_DB_FILE", os.path.join(BASE_DIR, "hv.db"))
+# Milliseconds a writer waits for the database lock before failing
+DB_BUSY_TIMEOUT = int(os.environ.get("DB_BUSY_TIMEOUT", "5000"))
+
+_local = threading.local()
+
+
+def connect(check_same_thread=True):
+    """A new connection of its own, outside this thread's transactions.
+
+    The caller closes it. Most code wants get_conn() instead.
+    """
+    conn = sqlite3.connect(DB_FILE, timeout=DB_BUSY_TIMEOUT / 1000,
+                           check_same_thread=check_same_thread)
+    conn.execute("PRAGMA journal_mode=WAL;")
+    conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT};")
+    conn.execute("PRAGMA synchronous=NORMAL;")
+    return conn
+
+
+def get_conn():
+    """This thread's connection, opened on first use.
+
+    The connection is shared by everything running on the thread, so it
+    must not be closed by callers; use close_conn() when a thread is done.
+    """
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = _local.conn = connect()
+    return conn
+
+
+def lock_file(name, blocking=True):
+    """Exclusive lock ``<DB_FILE>.<name>.lock`` shared by every process using the DB.
+
+    It is held until the returned file is closed, or the process exits.
+    Returns None if ``blocking`` is False and another process holds it.
+    """
+    f = open(f"{DB_FILE}.{name}.lock", "a")
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+    except BlockingIOError:
+        f.close()
+        return None
+    return f
+
+
+def close_conn():
+    conn = getattr(_local, "conn", None)
+    if conn is not None:
+        _local.conn = None
+        conn.close()
+
+
+@contextmanager
+def transaction(immediate=False):
+    """Commit on success, roll back on error.
+
+    ``immediate`` takes the write lock up front, for read-then-write
+    sequences that must not interleave with other writers. Nested use
+    joins the outer transaction.
+    """
+    conn = get_conn()
+    if conn.in_transaction:
+        yield conn
+        return
+    if immediate:
+        with metrics.DB_LOCK_WAIT_SECONDS.time():
+            conn.execute("BEGIN IMMEDIATE")
+    else:
+        conn.execute("BEGIN")
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
+
+
+def execute(sql, params=()):
+    """Run one statement, committing it unless a transaction is open."""
+    with transaction() as conn:
+        return conn.execute(sql, params)
+
+
+def executemany(sql, rows):
+    with transaction() as conn:
+        return conn.executemany(sql, rows)
+
+
+def query(sql, params=()):
+    """Rows of a SELECT as dicts."""
+    cur = get_conn().cursor()
+    cur.row_factory = sqlite3.Row
+    return [dict(r) for r in cur.execute(sql, params)]
+
+
+def query_one(sql, params=()):
+    rows = query(sql, params)
+    return rows[0] if rows else None
+
+
+def _columns(conn, table):
+    return {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+
+
+def _migration_baseline(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS hypervisors
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  name TEXT, ip TEXT, username TEXT, password TEXT)''')
+
+    conn.execute('''CREATE TABLE IF NOT EXISTS vms
+             (id INTEGER PRIMARY KEY AUTOINCREMENT,
+              name TEXT, ip_addr INTEGER, subnetprefix INTEGER, vm_gateway INTEGER, hv_id INTEGER,
+              cpu INTEGER, memory INTEGER, disk INTEGER,
+              status TEXT, vm_type TEXT,
+              FOREIGN KEY (hv_id) REFERENCES hypervisors(id))''')
+
+    conn.execute('''CREATE TABLE IF NOT EXISTS hv_status
+             (hv_id INTEGER PRIMARY KEY,
+              total_cpu INTEGER DEFAULT 0, total_mem INTEGER DEFAULT 0, total_disk INTEGER DEFAULT 0,
+              used_cpu INTEGER DEFAULT 0, used_mem INTEGER DEFAULT 0,
+              last_refresh TEXT, last_error TEXT,
+              FOREIGN KEY (hv_id) REFERENCES hypervisors(id))''')
+
+    conn.execute('''CREATE TABLE IF NOT EXISTS jobs
+             (id INTEGER PRIMARY KEY AUTOINCREMENT,
+              kind TEXT, hv_id INTEGER, batch TEXT, payload TEXT,
+              state TEXT DEFAULT 'queued', attempts INTEGER DEFAULT 0, error TEXT,
+              created_at TEXT, started_at TEXT, finished_at TEXT)''')
+    if "batch" not in _columns(conn, "jobs"):
+        conn.execute('ALTER TABLE jobs ADD COLUMN batch TEXT')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_jobs_state ON jobs (state, hv_id)')
+
+    conn.execute('''CREATE TABLE IF NOT EXISTS deploy_events
+             (id INTEGER PRIMARY KEY AUTOINCREMENT,
+              job_id INTEGER, hv_id INTEGER, vm_name TEXT,
+              step TEXT, step_no INTEGER, total_steps INTEGER,
+              status TEXT, elapsed REAL, created_at TEXT)''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_deploy_events_vm ON deploy_events (hv_id, vm_name)')
+
+    conn.execute('''CREATE TABLE IF NOT EXISTS job_logs
+             (job_id INTEGER, hv_id INTEGER, vm_name TEXT, path TEXT, created_at TEXT,
+              PRIMARY KEY (job_id, vm_name))''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_job_logs_vm ON job_logs (vm_name, hv_id)')
+
+
+def _migration_vm_types(conn):
+    # Addresses were declared INTEGER and defaulted to 0; store them as
+    # dotted strings and NULL when unknown. Duplicate (name, hv_id) rows
+    # left by the old SELECT-then-INSERT sync keep only their newest entry.
+    dropped = conn.execute(
+        "SELECT COUNT(*) - COUNT(DISTINCT name || '@' || hv_id) FROM vms"
+    ).fetchone()[0]
+    if dropped:
+        logging.warning(f"Dropping {dropped} duplicate VM row(s) while migrating vms")
+    conn.execute('DROP INDEX IF EXISTS idx_vms_unique')
+    conn.execute('''CREATE TABLE vms_new
+             (id INTEGER PRIMARY KEY AUTOINCREMENT,
+              name TEXT NOT NULL, ip_addr TEXT, subnetprefix INTEGER, vm_gateway TEXT,
+              hv_id INTEGER NOT NULL,
+              cpu INTEGER, memory INTEGER, disk INTEGER,
+              status TEXT, vm_type TEXT,
+              FOREIGN KEY (hv_id) REFERENCES hypervisors(id))''')
+    conn.execute('''INSERT INTO vms_new
+                 (id, name, ip_addr, subnetprefix, vm_gateway, hv_id, cpu, memory, disk, status, vm_type)
+             SELECT id, name, NULLIF(CAST(ip_addr AS TEXT), '0'), CAST(subnetprefix AS INTEGER),
+                    NULLIF(CAST(vm_gateway AS TEXT), '0'), hv_id, cpu, memory, disk, status, vm_type
+             FROM vms
+             WHERE name IS NOT NULL AND hv_id IS NOT NULL
+               AND id IN (SELECT MAX(id) FROM vms GROUP BY name, hv_id)''')
+    conn.execute('DROP TABLE vms')
+    conn.execute('ALTER TABLE vms_new RENAME TO vms')
+    conn.execute('CREATE UNIQUE INDEX idx_vms_unique ON vms (name, hv_id)')
+    conn.execute('CREATE INDEX idx_vms_hv_status ON vms (hv_id, status)')
+    conn.execute('CREATE INDEX idx_vms_status ON vms (status)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_hypervisors_ip ON hypervisors (ip)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_jobs_batch ON jobs (batch)')
+
+
+def _migration_sync_runs(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS sync_runs
+             (id INTEGER PRIMARY KEY AUTOINCREMENT,
+              hv_id INTEGER NOT NULL, finished_at TEXT, duration_ms INTEGER,
+              inserted INTEGER DEFAULT 0, updated INTEGER DEFAULT 0,
+              deleted INTEGER DEFAULT 0, unchanged INTEGER DEFAULT 0, error TEXT)''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_sync_runs_hv ON sync_runs (hv_id, id)')
+
+
+def _migration_storage_pool(conn):
+    columns = _columns(conn, "hv_status")
+    if "used_disk" not in columns:
+        conn.execute('ALTER TABLE hv_status ADD COLUMN used_disk INTEGER')
+    if "storage_pool" not in columns:
+        conn.execute('ALTER TABLE hv_status ADD COLUMN storage_pool TEXT')
+
+
+def _migration_ipam(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS subnets
+             (id INTEGER PRIMARY KEY AUTOINCREMENT,
+              name TEXT, cidr TEXT NOT NULL UNIQUE, gateway TEXT,
+              range_start TEXT, range_end TEXT,
+              generation INTEGER DEFAULT 0, created_at TEXT)''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS ip_allocations
+             (ip TEXT PRIMARY KEY, subnet_id INTEGER NOT NULL,
+              vm_name TEXT, hv_id INTEGER, source TEXT, allocated_at TEXT,
+              FOREIGN KEY (subnet_id) REFERENCES subnets(id))''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_ip_allocations_subnet ON ip_allocations (subnet_id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_ip_allocations_vm ON ip_allocations (vm_name, hv_id)')
+
+
+def _migration_job_deps(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS job_deps
+             (job_id INTEGER NOT NULL, depends_on INTEGER NOT NULL,
+              PRIMARY KEY (job_id, depends_on))''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_job_deps_parent ON job_deps (depends_on)')
+
+
+def _migration_vm_checkpoints(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS vm_checkpoints
+             (hv_id INTEGER NOT NULL, vm_name TEXT NOT NULL, stage TEXT NOT NULL,
+              spec_hash TEXT, job_id INTEGER, completed_at TEXT,
+              PRIMARY KEY (hv_id, vm_name, stage))''')
+
+
+def _migration_inventory_indexes(conn):
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_vms_name ON vms (name)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_vms_vm_type ON vms (vm_type)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_hypervisors_name ON hypervisors (name)')
+
+
+def _migration_cache_generations(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS cache_generations
+             (name TEXT PRIMARY KEY, generation INTEGER NOT NULL DEFAULT 0)''')
+    conn.execute("INSERT OR IGNORE INTO cache_generations (name) VALUES ('capacity')")
+
+
+
+def _migration_job_pids(conn):
+    if "pid" not in _columns(conn, "jobs"):
+        conn.execute('ALTER TABLE jobs ADD COLUMN pid INTEGER')
+
+
+
+def _migration_metric_snapshots(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS metric_snapshots
+             (process TEXT PRIMARY KEY, pid INTEGER, updated_at TEXT, data TEXT)''')
+
+
+# Schema versions, applied in order and recorded in PRAGMA user_version.
+# Never edit a released migration, append a new one.
+MIGRATIONS = [
+    (1, "baseline schema", _migration_baseline),
+    (2, "typed vms address columns and indexes", _migration_vm_types),
+    (3, "sync_runs reconciliation history", _migration_sync_runs),
+    (4, "storage pool usage in hv_status", _migration_storage_pool),
+    (5, "subnets and IP allocations", _migration_ipam),
+    (6, "job dependencies", _migration_job_deps),
+    (7, "per-VM deploy checkpoints", _migration_vm_checkpoints),
+    (8, "indexes for the inventory API", _migration_inventory_indexes),
+    (9, "cache generations shared between processes", _migration_cache_generations),
+    (10, "playbook process of running jobs", _migration_job_pids),
+    (11, "metrics of every process", _migration_metric_snapshots),
+]
+
+
+def schema_version(conn=None):
+    conn = conn or get_conn()
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate():
+    """Bring the database up to the latest schema version in place."""
+    conn = get_conn()
+    for version, description, apply in MIGRATIONS:
+        if schema_version(conn) >= version:
+            continue
+        with transaction(immediate=True):
+            # Another process may have migrated while we waited for the lock
+            if schema_version(conn) >= version:
+                continue
+            logging.info(f"Migrating database to version {version}: {description}")
+            apply(conn)
+            conn.execute(f"PRAGMA user_version={version}")
+    return schema_version(conn)
@@ -1,73 +1,104 @@
-import os
-import subprocess
+import time
 import logging
-import sqlite3
-from flask import request, flash, redirect, url_for
+import db
+import capacity
+import ipam
+import checkpoints
+import ansible_engine
+import job_queue
 
-BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-DB_FILE = os.path.join(BASE_DIR, "hv.db")
+def queue_vm_deletions(selected):
+    """Queue one 'delete' job per hypervisor for the selected VMs.
 
-def delete_vm_handler(vm_name, hv_ip):
-    #vm_name = request.form.get('vm_name')
-    if not vm_name:
-        flash("VM name not provided!", "error")
-        #return redirect(url_for('dashboard'))
+    ``selected`` is a list of (vm_name, hv_id) pairs. All jobs share one
+    batch so the hypervisors are destroyed in a single playbook run.
+    Returns the number of VMs queued.
+    """
+    by_hv = {}
+    for vm_name, hv_id in selected:
+        by_hv.setdefault(int(hv_id), []).append(vm_name)
+    if not by_hv:
+        return 0
 
-    prev_cwd = os.getcwd()
-    try:
-        os.chdir("ansible-playbook")
-        cmd = [
-            "ansible-playbook", "destroy.yml",
-            "-e", f"vm_name={vm_name}",
-            "-e", f"target_server={hv_ip}",
-            "-e", "target_server_username=root",
-            "-e", "libvirt_user=root",
-            "-e", "libvirt_group=root"
-        ]
-        logging.info(f"Running Ansible: {' '.join(cmd)}")
-
-        process = subprocess.Popen(
-            cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
-        )
-
-        for line in process.stdout:
-            logging.info(f"[Ansible STDOUT] {line.strip()}")
+    batch = f"delete-{int(time.time())}"
+    queued = 0
+    with db.transaction(immediate=True) as conn:
+        for hv_id, vm_names in by_hv.items():
+            hv = conn.execute("SELECT ip, username FROM hypervisors WHERE id=?", (hv_id,)).fetchone()
+            if hv is None:
+                logging.error(f"Cannot delete {vm_names}: hypervisor {hv_id} not found")
+                continue
+            conn.executemany(
+                "UPDATE vms SET status='Deleting' WHERE hv_id=? AND name=?",
+                [(hv_id, name) for name in vm_names],
+            )
+            job_queue.enqueue("delete", {
+                "hv_id": hv_id,
+                "hv_ip": hv[0],
+                "hv_user": hv[1],
+                "vm_names": vm_names,
+            }, hv_id=hv_id, conn=conn, batch=batch)
+            queued += len(vm_names)
+    return queued
 
-        for line in process.stderr:
-            logging.error(f"[Ansible STDERR] {line.strip()}")
+def delete_vms_batch(jobs):
+    """Destroy the VMs of every job in one destroy.yml run, one host per HV."""
+    hosts = {
+        job['payload']['hv_ip']: {
+            "ansible_user": job['payload']['hv_user'],
+            "target_server": job['payload']['hv_ip'],
+            "target_server_username": job['payload']['hv_user'],
+            "vm_names": job['payload']['vm_names'],
+        }
+        for job in jobs
+    }
+    job_ids = [job['id'] for job in jobs]
+    run = ansible_engine.run_playbook("destroy.yml", hosts, output_keys=job_ids,
+                                      on_start=lambda pid: job_queue.record_pid(job_ids, pid))
 
-        process.wait()
-
-        if process.returncode == 0:
-            flash(f"VM '{vm_name}' deleted successfully!", "success")
-            remove_vm_from_db(vm_name)
+    errors = {}
+    for job in jobs:
+        payload = job['payload']
+        if run.host_ok(payload['hv_ip']):
+            try:
+                remove_vm_from_db(payload['hv_id'], payload['vm_names'])
+            except Exception as e:
+                errors[job['id']] = f"VMs destroyed on {payload['hv_ip']} but not removed from the DB: {e}"
+                set_vm_status(payload['hv_id'], payload['vm_names'], "Delete failed")
         else:
-            flash(f"Failed to delete VM '{vm_name}'. Exit code: {process.returncode}", "error")
-
-    except Exception as e:
-        flash(f"Error deleting VM '{vm_name}': {e}", "error")
+            errors[job['id']] = f"destroy.yml failed on {payload['hv_ip']} (exit code {run.rc})"
+            if run.timed_out:
+                errors[job['id']] += " - timed out"
+            set_vm_status(payload['hv_id'], payload['vm_names'], "Delete failed")
+    capacity.invalidate()
+    return errors
 
-    finally:
-        os.chdir(prev_cwd)
+job_queue.register_handler("delete", delete_vms_batch, batched=True)
 
-    return redirect(url_for('dashboard'))
 
+def set_vm_status(hv_id, vm_names, status):
+    db.executemany(
+        "UPDATE vms SET status=? WHERE hv_id=? AND name=?",
+        [(status, hv_id, name) for name in vm_names],
+    )
 
-def remove_vm_from_db(vm_name):
+def remove_vm_from_db(hv_id, vm_names):
+    """Drop the rows, addresses and checkpoints of deleted VMs; DB errors are raised."""
     try:
-        conn = sqlite3.connect(DB_FILE)
-        c = conn.cursor()
-        c.execute("DELETE FROM vms WHERE name=?", (vm_name,))
-        conn.commit()
-        conn.close()
-        flash(f"Database entry for VM '{vm_name}' removed successfully.", "success")
+        placeholders = ",".join("?" * len(vm_names))
+        with db.transaction() as conn:
+            conn.execute(f"DELETE FROM vms WHERE hv_id=? AND name IN ({placeholders})",
+                         (hv_id, *vm_names))
+            ipam.release_vms(conn, hv_id, vm_names)
+            checkpoints.clear(conn, hv_id, vm_names)
+        logging.info(f"Database entries for VMs {vm_names} on HV {hv_id} removed")
     except Exception as e:
-        flash(f"Failed to remove VM '{vm_name}' from DB: {e}", "error")
+        logging.error(f"Failed to remove VMs {vm_names} on HV {hv_id} from DB: {e}")
+        raise
 
 if __name__ == "__main__":
     import sys
-    if len(sys.argv) != 2:
-        print("Usage: python delete_vm.py <vm_name>")
+    if len(sys.argv) < 3:
+        print("Usage: python delete_vm.py <hv_id> <vm_name> [<vm_name> ...]")
     else:
-        vm_name = sys.argv[1]
-        remove_vm_from_db(vm_name)
\ No newline at end of file
+        remove_vm_from_db(int(sys.argv[1]), sys.argv[2:])
@@ -0,0 +1,227 @@
+import os
+import json
+import time
+import logging
+import threading
+import yaml
+import db
+import checkpoints
+import metrics
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+ROLE_TASKS_DIR = os.path.join(BASE_DIR, "ansible-playbook", "roles", "vm_deploy", "tasks")
+
+# vm_creation.yml names every task "{{ vm.name }} | <step>"
+VM_TASK_SEPARATOR = " | "
+
+# Every open SSE stream holds a server thread. A stream ends after
+# SSE_MAX_SECONDS and the browser reconnects with Last-Event-ID after
+# SSE_RETRY_MS; at most SSE_MAX_STREAMS are open at once per process.
+SSE_MAX_SECONDS = int(os.environ.get("SSE_MAX_SECONDS", "300"))
+SSE_MAX_STREAMS = int(os.environ.get("SSE_MAX_STREAMS", "4"))
+SSE_RETRY_MS = 3000
+
+_streams = threading.BoundedSemaphore(SSE_MAX_STREAMS)
+
+_deploy_steps = None
+
+
+def _task_steps(filename):
+    with open(os.path.join(ROLE_TASKS_DIR, filename)) as f:
+        tasks = yaml.safe_load(f) or []
+    return [step for task in tasks for step in _task_steps_from(task)]
+
+
+def _task_steps_from(task):
+    if "block" in task:
+        return [s for sub in task["block"] for s in _task_steps_from(sub)]
+    if "include_tasks" in task:
+        return _task_steps(task["include_tasks"])
+    name = task.get("name", "")
+    step = name.split(VM_TASK_SEPARATOR, 1)[-1]
+    # Checkpoints are bookkeeping, not progress steps
+    return [] if step.startswith(checkpoints.CHECKPOINT_STEP) else [step]
+
+
+def deploy_steps():
+    """Ordered step names of the per-VM deploy tasks, read from the role."""
+    global _deploy_steps
+    if _deploy_steps is None:
+        try:
+            _deploy_steps = _task_steps("vm_creation.yml")
+        except Exception as e:
+            logging.error(f"Could not read deploy steps from role: {e}")
+            _deploy_steps = []
+    return _deploy_steps
+
+
+def split_task_name(task):
+    """'vm_deploy : vm01 | Copy ...' -> ('vm01', 'Copy ...'), else (None, task)."""
+    if not task:
+        return None, task
+    if " : " in task:
+        task = task.split(" : ", 1)[1]
+    if VM_TASK_SEPARATOR not in task:
+        return None, task
+    vm_name, step = task.split(VM_TASK_SEPARATOR, 1)
+    return vm_name.strip(), step.strip()
+
+
+def record_event(job_id, hv_id, vm_name, step, status, elapsed=None, conn=None):
+    steps = deploy_steps()
+    step_no = steps.index(step) + 1 if step in steps else None
+    execute = conn.execute if conn is not None else db.execute
+    execute(
+        """INSERT INTO deploy_events
+               (job_id, hv_id, vm_name, step, step_no, total_steps, status, elapsed, created_at)
+           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+        (job_id, hv_id, vm_name, step, step_no, len(steps) or None, status,
+         round(elapsed, 1) if elapsed is not None else None,
+         time.strftime("%Y-%m-%d %H:%M:%S")),
+    )
+
+
+def make_event_handler(targets):
+    """Turn ansible_engine events into deploy_events rows.
+
+    ``targets`` are the deploy targets of one playbook run (hv_id, hv_ip,
+    job_id, vms). Elapsed time is measured per VM from its first task, and
+    the duration of every task is recorded in metrics.DEPLOY_TASK_SECONDS.
+    """
+    owners = {}
+    labels = {}
+    for t in targets:
+        for vm in t['vms']:
+            owners[vm['name']] = (t.get('job_id'), t['hv_id'], vm.get('spec_hash'))
+            labels[vm['name']] = {"hypervisor": t.get('hv_ip') or t['hv_id'],
+                                  "vm_type": vm.get('vm_type') or "other"}
+    started = {}
+    task_started = {}
+
+    def observe_task(vm_name, step, event):
+        if event == "task_start":
+            task_started[vm_name] = (step, time.monotonic())
+            return
+        begun = task_started.pop(vm_name, None)
+        if begun is None or begun[0] != step or event == "skipped":
+            return
+        metrics.DEPLOY_TASK_SECONDS.observe(time.monotonic() - begun[1], task=step, **labels[vm_name])
+        if event in ("failed", "unreachable"):
+            metrics.DEPLOY_TASK_FAILURES.inc(task=step, **labels[vm_name])
+
+    def handler(event):
+        vm_name, step = split_task_name(event.get("task"))
+        if vm_name not in owners:
+            return
+        if step.startswith(checkpoints.CHECKPOINT_STEP):
+            if event["event"] == "ok":
+                job_id, hv_id, spec_hash = owners[vm_name]
+                stage = step[len(checkpoints.CHECKPOINT_STEP):].strip()
+                try:
+                    checkpoints.record(hv_id, vm_name, stage, spec_hash, job_id)
+                except Exception as e:
+                    logging.error(f"Failed to record checkpoint {stage} of {vm_name}: {e}")
+            return
+        observe_task(vm_name, step, event["event"])
+        if event["event"] == "task_start":
+            status = "running"
+        elif event["event"] in ("failed", "unreachable"):
+            status = "failed"
+        else:
+            return
+        now = time.monotonic()
+        started.setdefault(vm_name, now)
+        job_id, hv_id, _ = owners[vm_name]
+        try:
+            record_event(job_id, hv_id, vm_name, step, status, now - started[vm_name])
+        except Exception as e:
+            logging.error(f"Failed to record deploy event for {vm_name}: {e}")
+
+    return handler
+
+
+def events_since(after_id=0, limit=500):
+    return db.query(
+        """SELECT id, job_id, hv_id, vm_name, step, step_no, total_steps, status, elapsed, created_at
+           FROM deploy_events WHERE id > ? ORDER BY id LIMIT ?""",
+        (after_id, limit),
+    )
+
+
+def latest_progress(vms=None):
+    """Most recent event of every VM, keyed by (hv_id, vm_name).
+
+    ``vms`` limits the lookup to those (hv_id, vm_name) pairs.
+    """
+    if vms is None:
+        rows = db.query(
+            """SELECT e.* FROM deploy_events e
+               JOIN (SELECT MAX(id) AS id FROM deploy_events GROUP BY hv_id, vm_name) last
+                 ON last.id = e.id"""
+        )
+    elif not vms:
+        return {}
+    else:
+        rows = db.query(
+            f"""SELECT * FROM deploy_events WHERE id IN
+                    (SELECT MAX(e.id) FROM (VALUES {','.join(['(?, ?)'] * len(vms))}) AS p
+                     JOIN deploy_events e ON e.hv_id = p.column1 AND e.vm_name = p.column2
+                     GROUP BY e.hv_id, e.vm_name)""",
+            [value for pair in vms for value in pair],
+        )
+    return {(r["hv_id"], r["vm_name"]): r for r in rows}
+
+
+def last_event_id():
+    row = db.query_one("SELECT MAX(id) AS id FROM deploy_events")
+    return row["id"] or 0
+
+
+def stream_events(after_id=0, poll_interval=1.0, keepalive=15, max_seconds=SSE_MAX_SECONDS):
+    """Server-Sent Events generator over new deploy_events rows.
+
+    Ends after ``max_seconds``, the client then reconnects.
+    """
+    yield f"retry: {SSE_RETRY_MS}\n\n"
+    last_sent = time.monotonic()
+    deadline = last_sent + max_seconds
+    while time.monotonic() < deadline:
+        events = events_since(after_id)
+        for event in events:
+            after_id = event["id"]
+            yield f"id: {event['id']}\nevent: progress\ndata: {json.dumps(event)}\n\n"
+        now = time.monotonic()
+        if events:
+            last_sent = now
+        elif now - last_sent >= keepalive:
+            last_sent = now
+            yield ": keepalive\n\n"
+        time.sleep(poll_interval)
+
+
+class _Stream:
+    """Response iterable holding one of the SSE_MAX_STREAMS slots until closed."""
+
+    def __init__(self, events):
+        self._events = events
+        self._open = True
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._events)
+
+    def close(self):
+        # The server closes the response also when it was never iterated
+        if self._open:
+            self._open = False
+            self._events.close()
+            _streams.release()
+
+
+def open_stream(after_id=0):
+    """stream_events() as a response iterable, None if SSE_MAX_STREAMS are open."""
+    if not _streams.acquire(blocking=False):
+        return None
+    return _Stream(stream_events(after_id))
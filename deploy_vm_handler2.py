@@ -1,27 +1,30 @@
 import os
-import sqlite3
-import threading
-import subprocess
-import yaml
-from itertools import cycle
-import glob
+import json
+import time
 import logging
+import job_queue
+import ansible_engine
+import placement
+import deploy_events
+import capacity
+import preflight
+import ipam
+import checkpoints
+import metrics
+import db
 
-DB_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "hv.db")
+# Failed VMs listed individually when a deployment fails pre-flight
+PREFLIGHT_FLASH_LINES = 20
 
 def update_vm_status(vm_name, hv_id, new_status):
     try:
-        with sqlite3.connect(DB_FILE, timeout=30) as conn:
-            conn.execute("PRAGMA journal_mode=WAL;")
-            conn.execute("PRAGMA busy_timeout=5000;")
-            conn.execute(
-                "UPDATE vms SET status=? WHERE name=? AND hv_id=?",
-                (new_status, vm_name, hv_id),
-            )
-            conn.commit()
-        logging.info(f"Updated VM {vm_name} on HV {hv_id} → {new_status}")
+        db.execute(
+            "UPDATE vms SET status=? WHERE name=? AND hv_id=?",
+            (new_status, vm_name, hv_id),
+        )
+        logging.info(f"Updated VM {vm_name} on HV {hv_id} → {new_status}", extra={"vm_name": vm_name})
     except Exception as e:
-        logging.error(f"Failed to update VM {vm_name} on HV {hv_id}: {e}")
+        logging.error(f"Failed to update VM {vm_name} on HV {hv_id}: {e}", extra={"vm_name": vm_name})
 
 def expand_vm_bundle(base_name, count, base_spec):
     vms = []
@@ -31,153 +34,396 @@ def expand_vm_bundle(base_name, count, base_spec):
         vms.append(vm)
     return vms
 
-def spread_even(vms, hv_list):
-    plan = {hv['id']: [] for hv in hv_list}
-    if not vms:
-        return plan
-    if len(hv_list) == 1:
-        plan[hv_list[0]['id']] = vms
-        return plan
-    idx = 0
-    while idx < min(len(vms), len(hv_list)):
-        hv = hv_list[idx]
-        plan[hv['id']].append(vms[idx])
-        idx += 1
-    hv_cycle = cycle(hv_list)
-    for vm in vms[idx:]:
-        hv = next(hv_cycle)
-        plan[hv['id']].append(vm)
-    return plan
-
-def build_deployment_plan(hv_list, bundles):
+def load_hv_capacity(hv_list):
+    """HostCapacity for every hypervisor with a known inventory snapshot.
+
+    VMs still being deployed are not visible to the inventory poller yet, so
+    their CPU and memory are reserved on top of the snapshot figures. Disk
+    is counted as provisioned, i.e. the summed disk size of the HV's VMs.
+    """
+    known = capacity.get_capacity()
+    hosts = []
+    for order, hv in enumerate(hv_list):
+        cap = known.get(hv['id'])
+        if cap is None or cap['last_refresh'] is None or cap['total_cpu'] <= 0:
+            logging.warning(f"No capacity snapshot for HV {hv['ip']}, excluded from placement")
+            continue
+        hosts.append(placement.host_capacity(
+            hv['id'], order,
+            (cap['total_cpu'], cap['total_mem'], cap['total_disk']),
+            (cap['used_cpu'] + cap['pending_cpu'], cap['used_mem'] + cap['pending_mem'],
+             cap['provisioned_disk']),
+        ))
+    return hosts
+
+def build_deployment_plan(hv_list, bundles, strategy="spread"):
+    """Place all bundle VMs; raises placement.PlacementError if they don't fit."""
     all_vms = []
     for b in bundles:
         all_vms += expand_vm_bundle(b['base_name'], b['count'], b['spec'])
-    by_hv = spread_even(all_vms, hv_list)
-    return [{'hv': hv, 'hv_id': hv['id'], 'vms': by_hv[hv['id']]} for hv in hv_list]
-
-def run_ansible_playbook(hv_ip, hv_user, run_tag, hv_id, vms):
-    playbook_dir = os.path.join(os.path.dirname(__file__), "ansible-playbook")
-    vars_dir = os.path.join(playbook_dir, "vars")
-    os.makedirs(vars_dir, exist_ok=True)
-    var_file = os.path.join(vars_dir, f"vm_vars_{run_tag}_{hv_id}.yml")
-    with open(var_file, "w") as f:
-        yaml.dump({"vms": vms}, f, sort_keys=False)
-
-    prev_cwd = os.getcwd()
-    try:
-        os.chdir(playbook_dir)
-        cmd = [
-            "ansible-playbook", "playbook.yml",
-            "-e", f"target_server={hv_ip}",
-            "-e", f"target_server_username={hv_user}",
-            "-e", f"@vars/{os.path.basename(var_file)}",
-            "-e", "qcow2_image_src_dir=/home/qcow2images",
-            "-e", "qcow2_image_dst_dir=/home/images",
-            "-e", "vm_bridge=br0",
-            "-e", "vm_interface=enp1s0",
-            "-e", "libvirt_user=root",
-            "-e", "libvirt_group=root",            
-            "-e", "user_ssh_pub_key=~/.ssh/id_rsa.pub",
-            "--forks", "5",
-        ]
-        logging.info(f"Running Ansible: {' '.join(cmd)}")
-
-        process = subprocess.Popen(
-            cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-        )
+    by_hv = placement.place_vms(all_vms, load_hv_capacity(hv_list), strategy)
+    return [{'hv': hv, 'hv_id': hv['id'], 'vms': by_hv.get(hv['id'], [])} for hv in hv_list]
 
-        for line in process.stdout:
-            logging.info(f"[Ansible STDOUT][HV {hv_ip}] {line.strip()}")
-        for line in process.stderr:
-            logging.error(f"[Ansible STDERR][HV {hv_ip}] {line.strip()}")
+DEPLOY_EXTRAVARS = {
+    "qcow2_image_src_dir": "/home/qcow2images",
+    "qcow2_image_dst_dir": "/home/images",
+    "vm_bridge": "br0",
+    "vm_interface": "enp1s0",
+    "libvirt_user": "root",
+    "libvirt_group": "root",
+    "user_ssh_pub_key": "~/.ssh/id_rsa.pub",
+}
 
-        ret = process.wait()
-        if ret == 0:
-            logging.info(f"Ansible finished successfully for HV {hv_ip}")
-            for vm in vms:
-                update_vm_status(vm['name'], hv_id, "Completed")
-        else:
-            logging.error(f"Ansible failed for HV {hv_ip} with exit code {ret}")
-            for vm in vms:
-                update_vm_status(vm['name'], hv_id, "Failed")
+def run_ansible_playbook(targets, run_tag):
+    """Deploy the VMs of several hypervisors in one playbook run.
+
+    ``targets`` is a list of dicts with hv_id, hv_ip, hv_user and vms.
+    Stages checkpointed by an earlier attempt are skipped, and a VM that
+    reached its last checkpoint counts as deployed even if another VM of
+    its hypervisor failed.
+    Returns {hv_id: True/False} telling which hypervisors succeeded.
+    """
+    for t in targets:
+        checkpoints.attach(t['hv_id'], t['vms'])
+    hosts = {
+        t['hv_ip']: {
+            "ansible_user": t['hv_user'],
+            "target_server": t['hv_ip'],
+            "target_server_username": t['hv_user'],
+            "vms": t['vms'],
+        }
+        for t in targets
+    }
+    logging.info(f"Deploying run {run_tag} on {list(hosts)}")
+    job_ids = [t['job_id'] for t in targets if t.get('job_id')]
 
+    try:
+        run = ansible_engine.run_playbook("playbook.yml", hosts, DEPLOY_EXTRAVARS,
+                                          event_handler=deploy_events.make_event_handler(targets),
+                                          output_keys=job_ids,
+                                          on_start=lambda pid: job_queue.record_pid(job_ids, pid))
     except Exception as e:
-        logging.exception(f"Unexpected error running Ansible for HV {hv_ip}: {e}")
-    finally:
-        os.chdir(prev_cwd)
+        logging.exception(f"Unexpected error running Ansible for {list(hosts)}: {e}")
+        for t in targets:
+            for vm in t['vms']:
+                update_vm_status(vm['name'], t['hv_id'], "Failed")
+        raise
+
+    results = {}
+    for t in targets:
+        ok = run.host_ok(t['hv_ip'])
+        results[t['hv_id']] = ok
+        if ok:
+            deployed = [vm['name'] for vm in t['vms']]
+        else:
+            checkpoints.attach(t['hv_id'], t['vms'])
+            deployed = [vm['name'] for vm in t['vms']
+                        if checkpoints.DEPLOY_STAGES[-1] in vm['done_stages']]
+        for vm in t['vms']:
+            done = vm['name'] in deployed
+            update_vm_status(vm['name'], t['hv_id'], "Completed" if done else "Failed")
+            deploy_events.record_event(t.get('job_id'), t['hv_id'], vm['name'],
+                                       "Completed" if done else "Failed",
+                                       "completed" if done else "failed")
+            metrics.VM_DEPLOYS.inc(hypervisor=t['hv_ip'], vm_type=vm.get('vm_type') or "other",
+                                   result="completed" if done else "failed")
+        with db.transaction() as conn:
+            checkpoints.clear(conn, t['hv_id'], deployed)
+    capacity.invalidate()
+    return results
+
+def deploy_jobs(jobs):
+    targets = [dict(job['payload'], job_id=job['id']) for job in jobs]
+    results = run_ansible_playbook(targets, jobs[0]['payload']['run_tag'])
+    return {
+        job['id']: None if results.get(job['payload']['hv_id']) else "ansible-playbook failed"
+        for job in jobs
+    }
+
+def cancel_deploy_job(job):
+    """VMs of a deploy job cancelled before it ran give back their addresses."""
+    payload = job['payload']
+    names = [vm['name'] for vm in payload['vms']]
+    with db.transaction() as conn:
+        conn.executemany("UPDATE vms SET status='Cancelled' WHERE name=? AND hv_id=?",
+                         [(name, payload['hv_id']) for name in names])
+        ipam.release_vms(conn, payload['hv_id'], names)
+        checkpoints.clear(conn, payload['hv_id'], names)
+    for name in names:
+        deploy_events.record_event(job['id'], payload['hv_id'], name, "Cancelled", "cancelled")
+    capacity.invalidate()
+
+job_queue.register_handler("deploy", deploy_jobs, batched=True, on_cancel=cancel_deploy_job)
+
+QCOW2_IMAGES = {
+    "deployer": "NSP_K8S_PLATFORM_RHEL*.qcow2",
+    "cluster": "NSP_K8S_PLATFORM_RHEL*.qcow2",
+    "nfm-p": "NSP_RHEL*.qcow2",
+    "other": "default.qcow2",
+}
+
+class DeploymentError(Exception):
+    """A deployment was rejected before anything was queued.
+
+    ``problems`` lists the per-VM reasons, if any.
+    """
+
+    def __init__(self, message, problems=()):
+        super().__init__(message)
+        self.problems = list(problems)
+
+def build_vm_spec(vm_type, cpu, memory_gb, disk, partitions=(), flatten=False,
+                  ip_addr="", prefix="24", gateway="", affinity_mode="", group=None):
+    """Spec shared by the VMs of one bundle; partitions are (lv, mount, size GB)."""
+    required_partitions = []
+    for lv, mount, size in partitions:
+        try:
+            required_partitions.append({
+                "lv": lv.strip(),
+                "mount": mount.strip(),
+                "size_mb": int(float(size or 0) * 1024),
+            })
+        except Exception as e:
+            logging.error(f"Invalid partition input: {lv}, {mount}, {size} - {e}")
+
+    spec = {
+        "cpu": cpu,
+        "ram": memory_gb * 1024,
+        "disk": disk,
+        "ipaddr": ip_addr,
+        "prefix": prefix,
+        "gateway": gateway,
+        # Resolved on each target hypervisor by the pre-flight checks
+        "qcow2_image": os.path.join(DEPLOY_EXTRAVARS["qcow2_image_src_dir"],
+                                    QCOW2_IMAGES.get(vm_type, "default.qcow2")),
+        "vg_name": "vg1",
+        "flatten": bool(flatten),
+        "vm_type": vm_type,
+        "required_partitions": required_partitions,
+    }
+    if affinity_mode in ("affinity", "anti_affinity"):
+        spec[affinity_mode] = group
+    return spec
+
+def stage_order(stages):
+    """Stage names ordered so that every stage follows its dependencies.
+
+    Raises DeploymentError for duplicate names, unknown dependencies and
+    cycles.
+    """
+    names = [st['name'] for st in stages]
+    if len(set(names)) != len(names):
+        raise DeploymentError("Stage names must be unique")
+    waiting = {st['name']: set(st.get('depends_on') or ()) for st in stages}
+    for name, deps in waiting.items():
+        unknown = deps - waiting.keys()
+        if unknown:
+            raise DeploymentError(f"Stage {name} depends on unknown stage(s) {sorted(unknown)}")
+    order = []
+    while waiting:
+        ready = [name for name in names if name in waiting and not waiting[name] - set(order)]
+        if not ready:
+            raise DeploymentError(f"Stages {sorted(waiting)} depend on each other in a cycle")
+        for name in ready:
+            order.append(name)
+            del waiting[name]
+    return order
+
+def start_deployment(hypervisors, stages, strategy="spread", name="vm"):
+    """Place, check and queue a deployment made of dependent stages.
+
+    ``stages`` are dicts with name, base_name, count, spec (see
+    build_vm_spec), depends_on and optionally subnet_id and ip_addr. All VMs
+    are placed and pre-flight checked together, then every stage is queued
+    as one deploy job per hypervisor. A stage's jobs start as soon as all
+    jobs of the stages it depends on have succeeded; stages without
+    dependencies run in parallel, and a failure cancels only the stages
+    downstream of it.
+
+    Returns (run_tag, {stage: [job ids]}). Raises DeploymentError if the
+    deployment cannot be placed or fails pre-flight; nothing is queued then.
+    """
+    order = stage_order(stages)
+    by_name = {st['name']: st for st in stages}
+    bundles = [{"base_name": by_name[n]['base_name'], "count": by_name[n]['count'],
+                "spec": dict(by_name[n]['spec'], stage=n)} for n in order]
+    try:
+        plan = build_deployment_plan(hypervisors, bundles, strategy)
+    except placement.PlacementError as e:
+        raise DeploymentError(str(e))
+    logging.info(f"Deployment plan: {plan}")
+    stage_plans = {
+        n: [dict(entry, vms=[vm for vm in entry['vms'] if vm['stage'] == n]) for entry in plan]
+        for n in order
+    }
+
+    reserved = []
+    try:
+        for n in order:
+            reserved += ipam.assign_addresses(stage_plans[n], by_name[n].get('subnet_id'),
+                                              by_name[n].get('ip_addr') or None)
+
+        report = preflight.run_preflight(plan, DEPLOY_EXTRAVARS["vm_bridge"])
+        failed = [r for r in report if not r["ok"]]
+        if failed:
+            raise DeploymentError(
+                f"pre-flight checks failed for {len(failed)} of {len(report)} VM(s)",
+                [f"{r['name']} on {r['hv_ip']}: {'; '.join(r['problems'])}" for r in failed])
+
+        run_tag = f"{name}-{int(time.time())}"
+        jobs = {}
+        with db.transaction() as conn:
+            for n in order:
+                depends_on = [job_id for dep in by_name[n].get('depends_on') or () for job_id in jobs[dep]]
+                batch = run_tag if len(order) == 1 else f"{run_tag}:{n}"
+                jobs[n] = []
+                for entry in stage_plans[n]:
+                    hv_id = entry['hv_id']
+                    for vm in entry['vms']:
+                        conn.execute(
+                            """INSERT INTO vms 
+                               (name, ip_addr, subnetprefix, vm_gateway, hv_id, cpu, memory, disk, status, vm_type) 
+                               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                            (vm['name'], vm.get('ipaddr') or None, vm.get('prefix') or 24,
+                             vm.get('gateway') or None, hv_id, vm['cpu'], vm['ram'],
+                             vm['disk'], "In-progress", vm['vm_type'])
+                        )
+                    if entry['vms']:
+                        jobs[n].append(job_queue.enqueue("deploy", {
+                            "hv_ip": entry['hv']['ip'],
+                            "hv_user": entry['hv']['username'],
+                            "run_tag": run_tag,
+                            "stage": n,
+                            "hv_id": hv_id,
+                            "vms": entry['vms'],
+                        }, hv_id=hv_id, conn=conn, batch=batch, depends_on=depends_on))
+    except ipam.IPAMError as e:
+        ipam.release_ips(reserved)
+        raise DeploymentError(str(e))
+    except BaseException:
+        ipam.release_ips(reserved)
+        raise
+    capacity.invalidate()
+    logging.info(f"Deployment {run_tag} queued: {jobs}")
+    return run_tag, jobs
+
+def _int(value, default=None):
+    return int(value) if value not in (None, "") else default
+
+def stages_from_spec(spec):
+    """Stages for start_deployment() from a JSON deployment spec.
+
+    Each stage names its vm_type, base_name, count, cpu, memory (GB), disk
+    (GB) and optionally flatten, partitions [{lv, mount, size_gb}],
+    affinity, subnet_id, ip_addr, prefix, gateway and depends_on. subnet_id
+    defaults to the deployment's. Raises DeploymentError for invalid specs.
+    """
+    stages = []
+    for i, st in enumerate(spec.get("stages") or ()):
+        name = st.get("name") or st.get("vm_type") or f"stage{i + 1}"
+        try:
+            vm_spec = build_vm_spec(
+                st.get("vm_type") or "other", int(st["cpu"]), int(st["memory"]), int(st["disk"]),
+                [(p.get("lv", ""), p.get("mount", ""), p.get("size_gb")) for p in st.get("partitions") or ()],
+                st.get("flatten"), st.get("ip_addr") or "", str(st.get("prefix") or "24"),
+                st.get("gateway") or "", st.get("affinity") or "", st.get("base_name") or name,
+            )
+            count = int(st.get("count") or 1)
+        except (KeyError, TypeError, ValueError) as e:
+            raise DeploymentError(f"Invalid stage {name}: {e!r}")
+        if count < 1:
+            raise DeploymentError(f"Invalid stage {name}: count must be at least 1")
+        stages.append({
+            "name": name,
+            "base_name": st.get("base_name") or name,
+            "count": count,
+            "spec": vm_spec,
+            "depends_on": list(st.get("depends_on") or ()),
+            "subnet_id": _int(st.get("subnet_id"), _int(spec.get("subnet_id"))),
+            "ip_addr": st.get("ip_addr"),
+        })
+    if not stages:
+        raise DeploymentError("A deployment needs at least one stage")
+    return stages
+
+def deployment_status(run_tag):
+    """Jobs of a deployment grouped by stage, or None if it is unknown."""
+    jobs = db.query(
+        """SELECT id, hv_id, batch, state, error, started_at, finished_at FROM jobs
+           WHERE kind='deploy' AND (batch = ? OR substr(batch, 1, ?) = ?)
+           ORDER BY id""",
+        (run_tag, len(run_tag) + 1, run_tag + ":"),
+    )
+    if not jobs:
+        return None
+    deps = {}
+    for row in db.query(f"SELECT job_id, depends_on FROM job_deps WHERE job_id IN "
+                        f"({','.join('?' * len(jobs))})", [job['id'] for job in jobs]):
+        deps.setdefault(row['job_id'], []).append(row['depends_on'])
+    stages = {}
+    for job in jobs:
+        stage = job.pop('batch').partition(":")[2] or "main"
+        job['depends_on'] = deps.get(job['id'], [])
+        stages.setdefault(stage, []).append(job)
+    return {"run_tag": run_tag, "stages": stages}
+
+def retry_failed(job_id):
+    """Queue a new deploy job for the VMs of ``job_id`` that failed.
+
+    The VMs keep their names, addresses and hypervisor, and the stages they
+    already completed are skipped. Jobs cancelled because ``job_id`` failed
+    are not requeued. Returns the new job id, or None if there is no such
+    deploy job. Raises DeploymentError if the job has not finished or has
+    no failed VMs.
+    """
+    with db.transaction(immediate=True) as conn:
+        job = conn.execute("SELECT id, hv_id, batch, state, payload FROM jobs WHERE id=? AND kind='deploy'",
+                           (job_id,)).fetchone()
+        if job is None:
+            return None
+        if job[3] in ("queued", "running"):
+            raise DeploymentError(f"Job {job_id} has not finished yet")
+        payload = json.loads(job[4])
+        failed = {row[0] for row in conn.execute(
+            f"""SELECT name FROM vms WHERE hv_id=? AND status='Failed'
+                AND name IN ({','.join('?' * len(payload['vms']))})""",
+            (payload['hv_id'], *[vm['name'] for vm in payload['vms']]))}
+        if not failed:
+            raise DeploymentError(f"Job {job_id} has no failed VMs")
+        conn.executemany("UPDATE vms SET status='In-progress' WHERE name=? AND hv_id=?",
+                         [(name, payload['hv_id']) for name in failed])
+        new_id = job_queue.enqueue("deploy", dict(payload, retry_of=job_id,
+                                                  vms=[vm for vm in payload['vms'] if vm['name'] in failed]),
+                                   hv_id=job[1], conn=conn, batch=job[2])
+    capacity.invalidate()
+    logging.info(f"Retrying {sorted(failed)} of job {job_id} as job {new_id}")
+    return new_id
 
 def deploy_vm_route(request, render_template, redirect, url_for, flash):
-    with sqlite3.connect(DB_FILE, timeout=30) as conn:
-        conn.row_factory = sqlite3.Row
-        cur = conn.cursor()
-        cur.execute("SELECT id, name, ip, username, password FROM hypervisors ORDER BY id ASC")
-        hypervisors = [dict(r) for r in cur.fetchall()]
+    hypervisors = db.query("SELECT id, name, ip, username, password FROM hypervisors ORDER BY id ASC")
 
     if request.method == "POST":
         base_name = (request.form.get("name") or "vm").strip()
         vm_type = (request.form.get("vm_type") or "other").strip()
         vm_count = int(request.form.get("vm_count") or request.form.get("count") or 1)
-        cpu = int(request.form.get("cpu") or 2)
-        memory_gb = int(request.form.get("memory") or 2048)
-        disk = int(request.form.get("disksize") or 20480)
-        ip_addr = (request.form.get("ip_addr") or "").strip()
-        subnetprefix = (request.form.get("subnetprefix") or "24").strip()
-        vm_gateway = (request.form.get("vm_gateway") or "").strip()
         hv_id_selected = request.form.getlist("hv_id")
+        strategy = request.form.get("placement") or "spread"
 
-        qcow2_images = {
-            "deployer": "NSP_K8S_PLATFORM_RHEL*.qcow2",
-            "cluster": "NSP_K8S_PLATFORM_RHEL*.qcow2",
-            "nfm-p": "NSP_RHEL*.qcow2",
-            "other": "default.qcow2",
-        }
-        pattern = qcow2_images.get(vm_type, "default.qcow2")
-        matches = glob.glob(os.path.join("/home/qcow2images", pattern))
-
-        if matches:
-            qcow2_image = matches[0]
-            logging.info(f"Selected qcow2 image for {vm_type}: {qcow2_image}")
-        else:
-            flash(f"No qcow2 image found for pattern {pattern}", "danger")
-            return redirect(url_for("deploy_vm"))
-
-        lvs = request.form.getlist("lv[]")
-        mounts = request.form.getlist("mount[]")
-        sizes_gb = request.form.getlist("size_g[]")
-        sizes_mb = [int(float(size) * 1024) for size in sizes_gb]
-        memory =memory_gb * 1024
-
-
-        required_partitions = []
-        for lv, mount, size in zip(lvs, mounts, sizes_mb):
-            try:
-                required_partitions.append({
-                    "lv": lv.strip(),
-                    "mount": mount.strip(),
-                    "size_mb": int(size or 0),
-                })
-            except Exception as e:
-                logging.error(f"Invalid partition input: {lv}, {mount}, {size} - {e}")
-
-        base_spec = {
-            "cpu": cpu,
-            "ram": memory,
-            "disk": disk,
-            "ipaddr": ip_addr,
-            "prefix": subnetprefix,
-            "gateway": vm_gateway,
-            "qcow2_image": qcow2_image,
-            "vg_name": "vg1",
-            "vm_type": vm_type,
-            "required_partitions": required_partitions,
-        }
+        spec = build_vm_spec(
+            vm_type,
+            int(request.form.get("cpu") or 2),
+            int(request.form.get("memory") or 2),
+            int(request.form.get("disksize") or 20),
+            zip(request.form.getlist("lv[]"), request.form.getlist("mount[]"),
+                request.form.getlist("size_g[]")),
+            request.form.get("flatten"),
+            (request.form.get("ip_addr") or "").strip(),
+            (request.form.get("subnetprefix") or "24").strip(),
+            (request.form.get("vm_gateway") or "").strip(),
+            request.form.get("affinity_mode") or "",
+            base_name,
+        )
 
-        bundles = [{"base_name": base_name, "count": vm_count, "spec": base_spec}]
-        
         # if hv_id_selected and hv_id_selected.lower() != "all":
         #     hypervisors = [hv for hv in hypervisors if str(hv["id"]) == hv_id_selected]
         if not hv_id_selected or "all" in hv_id_selected:
@@ -185,35 +431,19 @@ def deploy_vm_route(request, render_template, redirect, url_for, flash):
         else:
             hypervisors = [hv for hv in hypervisors if str(hv["id"]) in hv_id_selected]
 
-        plan = build_deployment_plan(hypervisors, bundles)
-        logging.info(f"Deployment plan: {plan}")
-
-        with sqlite3.connect(DB_FILE, timeout=30) as conn:
-            conn.execute("PRAGMA journal_mode=WAL;")
-            conn.execute("PRAGMA busy_timeout=5000;")
-            for entry in plan:
-                hv_id = entry['hv_id']
-                for vm in entry['vms']:
-                    conn.execute(
-                        """INSERT INTO vms 
-                           (name, ip_addr, subnetprefix, vm_gateway, hv_id, cpu, memory, disk, status, vm_type) 
-                           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-                        (vm['name'], vm.get('ipaddr') or 0, vm.get('prefix') or 24,
-                         vm.get('gateway') or 0, hv_id, vm['cpu'], vm['ram'],
-                         vm['disk'], "In-progress", vm_type)
-                    )
-            conn.commit()
-
-        for entry in plan:
-            if not entry['vms']:
-                continue
-            threading.Thread(
-                target=run_ansible_playbook,
-                args=(entry['hv']['ip'], entry['hv']['username'],
-                      base_name, entry['hv_id'], entry['vms']),
-                daemon=True,
-            ).start()
+        stage = {"name": vm_type, "base_name": base_name, "count": vm_count, "spec": spec,
+                 "subnet_id": request.form.get("subnet_id", type=int),
+                 "ip_addr": spec["ipaddr"]}
+        try:
+            start_deployment(hypervisors, [stage], strategy, base_name)
+        except DeploymentError as e:
+            flash(f"Deployment rejected: {e}", "danger")
+            for line in e.problems[:PREFLIGHT_FLASH_LINES]:
+                flash(line, "danger")
+            if len(e.problems) > PREFLIGHT_FLASH_LINES:
+                flash(f"... and {len(e.problems) - PREFLIGHT_FLASH_LINES} more, see the application log", "danger")
+            return redirect(url_for("deploy_vm"))
 
         return redirect(url_for("dashboard"))
 
-    return render_template("deploy_vm.html", hypervisors=hypervisors)
+    return render_template("deploy_vm.html", hypervisors=hypervisors, subnets=ipam.list_subnets())
@@ -0,0 +1,22 @@
+"""gunicorn settings of the web tier, see wsgi.py."""
+import os
+import multiprocessing
+
+bind = os.environ.get("WEB_BIND", "0.0.0.0:5000")
+workers = int(os.environ.get("WEB_WORKERS", str(min(multiprocessing.cpu_count() * 2 + 1, 9))))
+# Threaded workers, so open /api/deploy_events/stream connections do not
+# take a whole process each. Each open dashboard holds a thread for its
+# event stream; half the threads of a worker may do so, further dashboards
+# poll instead. Size WEB_WORKERS * WEB_THREADS / 2 for the open dashboards.
+worker_class = "gthread"
+threads = int(os.environ.get("WEB_THREADS", "8"))
+os.environ.setdefault("SSE_MAX_STREAMS", str(max(1, threads // 2)))
+timeout = int(os.environ.get("WEB_TIMEOUT", "120"))
+graceful_timeout = 30
+# Each worker imports the app itself; nothing (DB connections, log files)
+# is opened before the fork
+preload_app = False
+
+# Every worker appends to logs/app.jsonl and none may rotate it under the
+# others: rotate it externally (e.g. logrotate with copytruncate)
+os.environ.setdefault("LOG_MAX_BYTES", "0")
@@ -0,0 +1,331 @@
+import os
+import threading
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import db
+import capacity
+import ipam
+import checkpoints
+from virsh_collect import collect_hv_inventory
+
+# Seconds between two inventory passes over the hypervisor fleet
+POLL_INTERVAL = int(os.environ.get("HV_POLL_INTERVAL", "60"))
+# Deadline for collecting a single hypervisor and for a whole fleet pass
+POLL_HOST_TIMEOUT = int(os.environ.get("HV_POLL_HOST_TIMEOUT", "30"))
+POLL_GLOBAL_TIMEOUT = int(os.environ.get("HV_POLL_GLOBAL_TIMEOUT", "45"))
+POLL_WORKERS = int(os.environ.get("HV_POLL_WORKERS", "16"))
+# sync_runs rows kept, older ones are pruned after every poll
+SYNC_RUNS_KEEP = int(os.environ.get("HV_SYNC_RUNS_KEEP", "10000"))
+
+# Storage pool whose figures are the HV's disk capacity; without it the
+# largest pool is used, and without any pool HV_DEFAULT_DISK_GB
+STORAGE_POOL = os.environ.get("HV_STORAGE_POOL", "default")
+DEFAULT_DISK_GB = int(os.environ.get("HV_DEFAULT_DISK_GB", "5000"))
+
+# VM statuses set by deploys and deletes. The poller never overwrites them,
+# and rows with them stay in the DB while their domain is missing on the HV
+KEEP_MISSING_STATUSES = ("In-progress", "Deleting", "Failed", "Delete failed")
+
+_collect_pool = ThreadPoolExecutor(max_workers=POLL_WORKERS, thread_name_prefix="hv-collect")
+# Hypervisors whose collection is still running, possibly abandoned
+_inflight = set()
+_inflight_lock = threading.Lock()
+
+_poller_thread = None
+_poller_stop = threading.Event()
+
+
+def storage_pool(pools, name=STORAGE_POOL):
+    """The pool backing VM disks: ``name`` if present, else the largest."""
+    running = [p for p in pools if p["state"] in (None, "running")]
+    for pool in running:
+        if pool["name"] == name:
+            return pool
+    return max(running, key=lambda p: p["capacity"], default=None)
+
+
+def get_hv_resources(ip, username, password, inventory=None):
+    """(total_cpu, total_mem, total_disk, used_cpu, used_mem, used_disk, pool name).
+
+    Memory and disk are in GB. used_disk and the pool name are None when
+    the HV reports no storage pool.
+    """
+    try:
+        if inventory is None:
+            inventory = collect_hv_inventory(ip, username, password)
+
+        total_cpu = inventory["node"]["cpu"]
+        total_mem = inventory["node"]["memory"]
+        pool = storage_pool(inventory.get("pools", []))
+        if pool:
+            total_disk, used_disk, pool_name = pool["capacity"], pool["allocation"], pool["name"]
+        else:
+            total_disk, used_disk, pool_name = DEFAULT_DISK_GB, None, None
+
+        used_cpu, used_mem = 0, 0
+        for vm in inventory["domains"]:
+            if not vm["active"]:
+                continue
+            used_cpu += vm["cpu"]
+            used_mem += vm["memory"]
+
+        return total_cpu, total_mem, total_disk, used_cpu, used_mem, used_disk, pool_name
+
+    except Exception as e:
+        logging.warning(f"Could not fetch HV resources from {ip}: {e}")
+        return 0, 0, 0, 0, 0, None, None
+
+
+def diff_vms(db_rows, domains):
+    """Compare stored VM rows of one HV with the domains found on it.
+
+    ``db_rows`` are (name, cpu, memory, disk, status) tuples. Returns
+    (inserts, updates, deletes) where inserts and updates are
+    (name, cpu, memory, disk, status) and deletes are names.
+    """
+    stored = {row[0]: row[1:] for row in db_rows}
+    inserts, updates = [], []
+    for vm in domains:
+        row = stored.get(vm["name"])
+        wanted = (vm["cpu"], vm["memory"], vm["disk"], vm["state"])
+        if row is None:
+            inserts.append((vm["name"],) + wanted)
+            continue
+        # Deploy and delete outcomes are kept while the domain exists too: a
+        # VM that failed after virt-install must stay Failed to be retried
+        if row[3] in KEEP_MISSING_STATUSES:
+            wanted = wanted[:3] + (row[3],)
+        if tuple(row) != wanted:
+            updates.append((vm["name"],) + wanted)
+
+    found = {vm["name"] for vm in domains}
+    # Domains still being built by a playbook are not defined yet, and failed
+    # or pending operations stay visible until the user acts on them
+    deletes = [
+        name for name, row in stored.items()
+        if name not in found and row[3] not in KEEP_MISSING_STATUSES
+    ]
+    return inserts, updates, deletes
+
+
+def reconcile_vms(hv_id, inventory, conn):
+    """Apply the difference between ``inventory`` and the vms table.
+
+    Runs on ``conn`` inside the caller's transaction and returns the
+    (inserted, updated, deleted, unchanged) counts.
+    """
+    if not inventory["node"].get("cpu"):
+        raise ValueError("hypervisor returned no node info, not reconciling its VMs")
+    rows = conn.execute(
+        "SELECT name, cpu, memory, disk, status FROM vms WHERE hv_id=?", (hv_id,)
+    ).fetchall()
+    inserts, updates, deletes = diff_vms(rows, inventory["domains"])
+
+    conn.executemany(
+        "INSERT INTO vms (name, cpu, memory, disk, status, hv_id) VALUES (?, ?, ?, ?, ?, ?)",
+        [row + (hv_id,) for row in inserts],
+    )
+    conn.executemany(
+        "UPDATE vms SET cpu=?, memory=?, disk=?, status=? WHERE name=? AND hv_id=?",
+        [row[1:] + (row[0], hv_id) for row in updates],
+    )
+    conn.executemany(
+        "DELETE FROM vms WHERE name=? AND hv_id=?", [(name, hv_id) for name in deletes]
+    )
+    ipam.release_vms(conn, hv_id, deletes)
+    checkpoints.clear(conn, hv_id, deletes)
+    unchanged = len(rows) - len(updates) - len(deletes)
+    return len(inserts), len(updates), len(deletes), unchanged
+
+
+def record_sync_run(conn, hv_id, started, counts=(0, 0, 0, 0), error=None):
+    conn.execute(
+        """INSERT INTO sync_runs
+               (hv_id, finished_at, duration_ms, inserted, updated, deleted, unchanged, error)
+           VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+        (hv_id, time.strftime("%Y-%m-%d %H:%M:%S"),
+         int((time.monotonic() - started) * 1000), *counts, error),
+    )
+
+
+def prune_sync_runs(keep=SYNC_RUNS_KEEP):
+    db.execute("DELETE FROM sync_runs WHERE id <= (SELECT MAX(id) FROM sync_runs) - ?", (keep,))
+
+
+def recent_sync_runs(limit=100):
+    return db.query(
+        """SELECT id, hv_id, finished_at, duration_ms, inserted, updated, deleted, unchanged, error
+           FROM sync_runs ORDER BY id DESC LIMIT ?""",
+        (limit,),
+    )
+
+
+def save_hv_snapshot(hv_id, resources, error=None):
+    """Store the latest capacity figures and refresh outcome for one HV.
+
+    On failure the previous capacity figures are kept so the dashboard still
+    shows the last known values, only the timestamp and error are updated.
+    """
+    now = time.strftime("%Y-%m-%d %H:%M:%S")
+    if resources is not None:
+        db.execute(
+            """INSERT INTO hv_status
+                   (hv_id, total_cpu, total_mem, total_disk, used_cpu, used_mem,
+                    used_disk, storage_pool, last_refresh, last_error)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+               ON CONFLICT(hv_id) DO UPDATE SET
+                   total_cpu=excluded.total_cpu, total_mem=excluded.total_mem,
+                   total_disk=excluded.total_disk, used_cpu=excluded.used_cpu,
+                   used_mem=excluded.used_mem, used_disk=excluded.used_disk,
+                   storage_pool=excluded.storage_pool, last_refresh=excluded.last_refresh,
+                   last_error=excluded.last_error""",
+            (hv_id, *resources, now, error),
+        )
+    else:
+        db.execute(
+            """INSERT INTO hv_status (hv_id, last_refresh, last_error) VALUES (?, ?, ?)
+               ON CONFLICT(hv_id) DO UPDATE SET
+                   last_refresh=excluded.last_refresh, last_error=excluded.last_error""",
+            (hv_id, now, error),
+        )
+
+
+def apply_hv_inventory(hv_id, hv_ip, hv_user, hv_pass, inventory):
+    """Reconcile the VMs and capacity of one HV in a single transaction."""
+    started = time.monotonic()
+    try:
+        resources = get_hv_resources(hv_ip, hv_user, hv_pass, inventory)
+        with db.transaction(immediate=True) as conn:
+            counts = reconcile_vms(hv_id, inventory, conn)
+            ipam.record_addresses(conn, hv_id, inventory["domains"])
+            save_hv_snapshot(hv_id, resources)
+            record_sync_run(conn, hv_id, started, counts)
+        if any(counts[:3]):
+            logging.info(f"Reconciled hypervisor {hv_ip}: {counts[0]} added, "
+                         f"{counts[1]} updated, {counts[2]} removed")
+        return counts
+    except Exception as e:
+        logging.exception(f"Failed to store inventory of hypervisor {hv_ip}: {e}")
+        with db.transaction() as conn:
+            save_hv_snapshot(hv_id, None, str(e))
+            record_sync_run(conn, hv_id, started, error=str(e))
+
+
+def refresh_hypervisor(hv_id, hv_ip, hv_user, hv_pass):
+    try:
+        inventory = collect_hv_inventory(hv_ip, hv_user, hv_pass, timeout=POLL_HOST_TIMEOUT)
+    except Exception as e:
+        logging.exception(f"Failed to refresh hypervisor {hv_ip}: {e}")
+        save_hv_snapshot(hv_id, None, str(e))
+        return
+    apply_hv_inventory(hv_id, hv_ip, hv_user, hv_pass, inventory)
+
+
+def _collect(hv_id, hv_ip, hv_user, hv_pass, host_timeout, started):
+    started[hv_id] = time.monotonic()
+    try:
+        return collect_hv_inventory(hv_ip, hv_user, hv_pass, host_timeout)
+    finally:
+        with _inflight_lock:
+            _inflight.discard(hv_id)
+
+
+def _outcome(future):
+    try:
+        return future.result(), None
+    except Exception as e:
+        return None, str(e) or type(e).__name__
+
+
+def collect_fleet(hypervisors, host_timeout=POLL_HOST_TIMEOUT, global_timeout=POLL_GLOBAL_TIMEOUT):
+    """Collect inventories from all hypervisors concurrently.
+
+    Returns {hv_id: (inventory, error)}. A host gets inventory None and an
+    error message when it fails, has been collecting for ``host_timeout``
+    seconds or is still pending when the global deadline expires. Hosts
+    given up on are abandoned: their collection finishes in the background
+    and is not started again before it has.
+    """
+    results = {}
+    started = {}
+    futures = {}
+    for hv_id, hv_name, hv_ip, hv_user, hv_pass in hypervisors:
+        with _inflight_lock:
+            if hv_id in _inflight:
+                results[hv_id] = (None, "previous collection still running")
+                continue
+            _inflight.add(hv_id)
+        futures[_collect_pool.submit(_collect, hv_id, hv_ip, hv_user, hv_pass, host_timeout, started)] = hv_id
+
+    deadline = time.monotonic() + global_timeout
+    pending = set(futures)
+    while pending:
+        now = time.monotonic()
+        for future in [f for f in pending if futures[f] in started and not f.done()]:
+            if now - started[futures[future]] >= host_timeout:
+                pending.discard(future)
+                results[futures[future]] = (None, f"timed out after {host_timeout}s")
+        if not pending or now >= deadline:
+            break
+        # Wake up for the next finished host or the next host deadline
+        wake = min([deadline] + [started[futures[f]] + host_timeout for f in pending if futures[f] in started])
+        done, pending = wait(pending, timeout=max(0.0, min(wake - now, 1.0)), return_when=FIRST_COMPLETED)
+        for future in done:
+            results[futures[future]] = _outcome(future)
+    for future in pending:
+        if future.done():
+            results[futures[future]] = _outcome(future)
+            continue
+        if future.cancel():
+            with _inflight_lock:
+                _inflight.discard(futures[future])
+        results[futures[future]] = (None, f"timed out after {global_timeout}s")
+    return results
+
+
+def poll_inventory_once():
+    hypervisors = db.get_conn().execute(
+        "SELECT id, name, ip, username, password FROM hypervisors"
+    ).fetchall()
+
+    results = collect_fleet(hypervisors)
+
+    # Writes are applied serially so only one thread holds the SQLite lock
+    for hv_id, hv_name, hv_ip, hv_user, hv_pass in hypervisors:
+        inventory, error = results[hv_id]
+        if inventory is None:
+            logging.warning(f"Inventory refresh of hypervisor {hv_ip} failed: {error}")
+            save_hv_snapshot(hv_id, None, error)
+            continue
+        apply_hv_inventory(hv_id, hv_ip, hv_user, hv_pass, inventory)
+    prune_sync_runs()
+    ipam.release_stale()
+    capacity.invalidate()
+
+
+def _poller_loop(interval):
+    while not _poller_stop.is_set():
+        started = time.monotonic()
+        try:
+            poll_inventory_once()
+        except Exception as e:
+            logging.exception(f"Inventory poll failed: {e}")
+        logging.info(f"Inventory poll finished in {time.monotonic() - started:.1f}s")
+        _poller_stop.wait(interval)
+
+
+def start_inventory_poller(interval=POLL_INTERVAL):
+    global _poller_thread
+    if _poller_thread and _poller_thread.is_alive():
+        return _poller_thread
+    _poller_stop.clear()
+    _poller_thread = threading.Thread(
+        target=_poller_loop, args=(interval,), name="hv-inventory-poller", daemon=True
+    )
+    _poller_thread.start()
+    return _poller_thread
+
+
+def stop_inventory_poller():
+    _poller_stop.set()
@@ -0,0 +1,241 @@
+import os
+import io
+import re
+import csv
+import logging
+import yaml
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import db
+import capacity
+from ssh_pool import ssh_pool
+from hv_inventory import storage_pool
+from virsh_collect import build_collect_script, split_sections, parse_pools, POOLS_COMMAND
+
+try:
+    import openpyxl
+except ImportError:  # XLSX import is optional, CSV always works
+    openpyxl = None
+
+# Requirements a hypervisor must meet to be onboarded
+MIN_LIBVIRT_VERSION = os.environ.get("HV_MIN_LIBVIRT_VERSION", "4.5.0")
+REQUIRED_BRIDGE = os.environ.get("HV_BRIDGE", "br0")
+MIN_FREE_DISK_GB = int(os.environ.get("HV_MIN_FREE_DISK_GB", "100"))
+IMAGE_DIR = "/home/images"
+ONBOARD_WORKERS = int(os.environ.get("HV_ONBOARD_WORKERS", "16"))
+ONBOARD_TIMEOUT = int(os.environ.get("HV_ONBOARD_TIMEOUT", "30"))
+DF_COMMAND = f"df -P -BG {IMAGE_DIR} || df -P -BG /"
+
+HV_FIELDS = ("name", "ip", "username", "password")
+# Alternative column headers accepted in import files
+FIELD_ALIASES = {"hv_name": "name", "hostname": "name", "host": "ip", "ip_address": "ip",
+                 "user": "username"}
+
+# Everything the checks need, fetched in one round-trip
+VALIDATE_SECTIONS = [
+    ("kvm", "lsmod | grep -E '^kvm(_intel|_amd)? '"),
+    ("libvirt", "virsh version --daemon"),
+    ("bridge", f"ip -o link show {REQUIRED_BRIDGE}"),
+    ("pools", POOLS_COMMAND),
+    ("df", DF_COMMAND),
+]
+
+
+def _header(name):
+    key = name.strip().lower().replace(" ", "_")
+    return FIELD_ALIASES.get(key, key)
+
+
+def _rows_to_hvs(rows):
+    rows = iter(rows)
+    header = [_header(str(h or "")) for h in next(rows, [])]
+    missing = [f for f in HV_FIELDS if f not in header]
+    if missing:
+        raise ValueError(f"Missing column(s): {', '.join(missing)}")
+    hvs = []
+    for row in rows:
+        values = dict(zip(header, ("" if v is None else str(v).strip() for v in row)))
+        if not any(values.get(f) for f in HV_FIELDS):
+            continue  # blank line
+        hvs.append({f: values.get(f, "") for f in HV_FIELDS})
+    return hvs
+
+
+def _yaml_rows(data):
+    try:
+        doc = yaml.safe_load(data)
+    except yaml.YAMLError as e:
+        raise ValueError(f"Invalid YAML: {e}")
+    if isinstance(doc, dict):
+        doc = doc.get("hypervisors")
+    if not isinstance(doc, list) or not all(isinstance(hv, dict) for hv in doc):
+        raise ValueError("YAML must be a list of hypervisors, or a mapping with a 'hypervisors' list")
+    # Aliases are resolved per entry, entries may spell a column differently
+    doc = [{_header(str(key)): value for key, value in hv.items()} for hv in doc]
+    header = list(dict.fromkeys(key for hv in doc for key in hv))
+    return [header] + [[hv.get(key) for key in header] for hv in doc]
+
+
+def parse_hv_file(filename, data):
+    """Hypervisors listed in an uploaded CSV, XLSX or YAML file.
+
+    The first row of a sheet holds the column names name, ip, username and
+    password (a few aliases are accepted); a YAML file lists one mapping per
+    hypervisor with the same keys. Raises ValueError for unusable files.
+    """
+    if filename.lower().endswith((".yml", ".yaml")):
+        return _rows_to_hvs(_yaml_rows(data))
+    if filename.lower().endswith(".xlsx"):
+        if openpyxl is None:
+            raise ValueError("XLSX import needs openpyxl, upload a CSV instead")
+        sheet = openpyxl.load_workbook(io.BytesIO(data), read_only=True, data_only=True).active
+        return _rows_to_hvs(sheet.iter_rows(values_only=True))
+    text = data.decode("utf-8-sig")
+    return _rows_to_hvs(csv.reader(io.StringIO(text)))
+
+
+def _version(text):
+    return tuple(int(p) for p in re.findall(r"\d+", text)[:3])
+
+
+def parse_libvirt_version(output):
+    for line in output.splitlines():
+        if "daemon" in line or "library" in line:
+            m = re.search(r"(\d+\.\d+(\.\d+)?)\s*$", line.strip())
+            if m:
+                return m.group(1)
+    return None
+
+
+def free_disk_gb(sections):
+    pool = storage_pool(parse_pools(sections.get("pools", "")))
+    if pool:
+        return pool["available"], f"pool {pool['name']}"
+    lines = sections.get("df", "").splitlines()
+    if len(lines) >= 2:
+        fields = lines[-1].split()
+        if len(fields) >= 4:
+            return int(fields[3].rstrip("G")), fields[-1]
+    return None, None
+
+
+def check_hv_output(output):
+    """Turn the output of the validation script into per-check results.
+
+    Returns {check: (ok, detail)}.
+    """
+    sections = split_sections(output)
+    checks = {}
+    kvm = sections.get("kvm", "").split()
+    checks["kvm"] = (bool(kvm), kvm[0] if kvm else "kvm module not loaded")
+
+    version = parse_libvirt_version(sections.get("libvirt", ""))
+    if version is None:
+        checks["libvirt"] = (False, "libvirtd not running")
+    else:
+        checks["libvirt"] = (_version(version) >= _version(MIN_LIBVIRT_VERSION),
+                             f"{version} (need {MIN_LIBVIRT_VERSION})")
+
+    has_bridge = bool(sections.get("bridge", "").strip())
+    checks["bridge"] = (has_bridge, REQUIRED_BRIDGE if has_bridge else f"{REQUIRED_BRIDGE} not found")
+
+    free, where = free_disk_gb(sections)
+    if free is None:
+        checks["storage"] = (False, "no storage pool or filesystem found")
+    else:
+        checks["storage"] = (free >= MIN_FREE_DISK_GB,
+                             f"{free} GB free on {where} (need {MIN_FREE_DISK_GB})")
+    return checks
+
+
+def validate_hv(hv, timeout=ONBOARD_TIMEOUT):
+    """Run all onboarding checks against one hypervisor.
+
+    Returns the hypervisor (without password) with ``ok`` and ``checks``,
+    a {check: {"ok", "detail"}} dict starting with ``reachable``.
+    """
+    result = {"name": hv["name"], "ip": hv["ip"], "username": hv["username"]}
+    try:
+        output = ssh_pool.run(hv["ip"], hv["username"], hv["password"],
+                              build_collect_script(VALIDATE_SECTIONS), timeout=timeout,
+                              label="onboarding")
+    except Exception as e:
+        result["checks"] = {"reachable": {"ok": False, "detail": str(e) or type(e).__name__}}
+        result["ok"] = False
+        return result
+    checks = {"reachable": (True, "ssh ok")}
+    checks.update(check_hv_output(output))
+    result["checks"] = {name: {"ok": ok, "detail": detail} for name, (ok, detail) in checks.items()}
+    result["ok"] = all(ok for ok, _ in checks.values())
+    return result
+
+
+def _rejected(hv, reason):
+    return {"name": hv.get("name"), "ip": hv.get("ip"), "username": hv.get("username"),
+            "ok": False, "checks": {"input": {"ok": False, "detail": reason}}}
+
+
+def validate_many(hvs, workers=ONBOARD_WORKERS):
+    """Validate hypervisors concurrently, yielding (hv, result) as each finishes.
+
+    Rows with missing fields, IPs listed twice or IPs already onboarded are
+    rejected without connecting to them.
+    """
+    known = {row[0] for row in db.get_conn().execute("SELECT ip FROM hypervisors")}
+    seen = set()
+    to_check = []
+    for hv in hvs:
+        missing = [f for f in HV_FIELDS if not hv.get(f)]
+        if missing:
+            yield hv, _rejected(hv, f"missing {', '.join(missing)}")
+        elif hv["ip"] in known:
+            yield hv, _rejected(hv, "hypervisor already added")
+        elif hv["ip"] in seen:
+            yield hv, _rejected(hv, "listed more than once")
+        else:
+            seen.add(hv["ip"])
+            to_check.append(hv)
+
+    if not to_check:
+        return
+    with ThreadPoolExecutor(max_workers=min(workers, len(to_check)),
+                            thread_name_prefix="hv-onboard") as pool:
+        futures = {pool.submit(validate_hv, hv): hv for hv in to_check}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+
+def insert_hypervisors(hvs):
+    """Insert validated hypervisors in one transaction, returning their ids."""
+    ids = []
+    with db.transaction(immediate=True) as conn:
+        # Another import may have added some of them since validation started
+        known = {row[0] for row in conn.execute("SELECT ip FROM hypervisors")}
+        for hv in hvs:
+            if hv["ip"] in known:
+                continue
+            cur = conn.execute(
+                "INSERT INTO hypervisors (name, ip, username, password) VALUES (?,?,?,?)",
+                (hv["name"], hv["ip"], hv["username"], hv["password"]),
+            )
+            ids.append(cur.lastrowid)
+    capacity.invalidate()
+    logging.info(f"Onboarded {len(ids)} hypervisor(s): {[hv['ip'] for hv in hvs]}")
+    return ids
+
+
+def onboard(hvs):
+    """Validate ``hvs`` and insert the ones that pass.
+
+    Yields every per-host result as it becomes available, then a final
+    summary {"done": True, "inserted": n, "failed": m}.
+    """
+    valid, failed = [], 0
+    for hv, result in validate_many(hvs):
+        if result["ok"]:
+            valid.append(hv)
+        else:
+            failed += 1
+            logging.warning(f"Hypervisor {hv.get('ip')} failed onboarding checks: {result['checks']}")
+        yield result
+    inserted = insert_hypervisors(valid) if valid else []
+    yield {"done": True, "inserted": len(inserted), "failed": failed}
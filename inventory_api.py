@@ -0,0 +1,162 @@
+import os
+import json
+import base64
+import db
+import capacity
+import deploy_events
+
+# Page size of /api/vms and /api/hypervisors, and the most a client may ask for
+API_PAGE_SIZE = int(os.environ.get("API_PAGE_SIZE", "100"))
+API_MAX_PAGE_SIZE = int(os.environ.get("API_MAX_PAGE_SIZE", "1000"))
+
+# Sort keys accepted by the API and the column behind each. Every page is
+# ordered by (column, id), which the indexes on these columns serve since
+# SQLite appends the rowid to every index entry.
+VM_SORT_COLUMNS = {"id": "v.id", "name": "v.name", "status": "v.status", "vm_type": "v.vm_type",
+                   "hv_id": "v.hv_id", "cpu": "v.cpu", "memory": "v.memory", "disk": "v.disk"}
+HV_SORT_COLUMNS = {"id": "h.id", "name": "h.name", "ip": "h.ip"}
+
+VM_COLUMNS = """v.id, v.name, v.status, v.vm_type, v.cpu, v.memory, v.disk, v.ip_addr,
+                v.subnetprefix, v.vm_gateway, v.hv_id, h.name AS hv_name, h.ip AS hv_ip"""
+
+
+class QueryError(ValueError):
+    """Invalid filter, sort or cursor in an API request."""
+
+
+def encode_cursor(sort, order, row_value, row_id):
+    raw = json.dumps([sort, order, row_value, row_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor, sort, order):
+    """(value, id) of the last row of the previous page."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        cursor_sort, cursor_order, value, row_id = json.loads(raw)
+    except (ValueError, TypeError):
+        raise QueryError("invalid cursor")
+    if (cursor_sort, cursor_order) != (sort, order):
+        raise QueryError("cursor was issued for another sort order")
+    # Anything else would reach SQLite as a parameter
+    if (not isinstance(value, (str, int, float, type(None))) or isinstance(value, bool)
+            or not isinstance(row_id, int) or isinstance(row_id, bool)):
+        raise QueryError("invalid cursor")
+    return value, row_id
+
+
+def after_clause(column, id_column, order, value, row_id):
+    """WHERE clause selecting the rows after (value, id) in (column, id) order.
+
+    NULLs sort first ascending and last descending, as SQLite orders them.
+    """
+    if order == "asc":
+        if value is None:
+            return f"(({column} IS NULL AND {id_column} > ?) OR {column} IS NOT NULL)", [row_id]
+        return f"({column} > ? OR ({column} = ? AND {id_column} > ?))", [value, value, row_id]
+    if value is None:
+        return f"({column} IS NULL AND {id_column} < ?)", [row_id]
+    return (f"({column} < ? OR ({column} = ? AND {id_column} < ?) OR {column} IS NULL)",
+            [value, value, row_id])
+
+
+def _page_args(args, sort_columns, default_sort):
+    sort = args.get("sort") or default_sort
+    if sort not in sort_columns:
+        raise QueryError(f"sort must be one of {', '.join(sort_columns)}")
+    order = (args.get("order") or "asc").lower()
+    if order not in ("asc", "desc"):
+        raise QueryError("order must be asc or desc")
+    try:
+        limit = int(args.get("limit") or API_PAGE_SIZE)
+    except ValueError:
+        raise QueryError("limit must be an integer")
+    return sort, order, max(1, min(limit, API_MAX_PAGE_SIZE))
+
+
+def _in(column, values, where, params):
+    values = [v for v in values if v != ""]
+    if values:
+        where.append(f"{column} IN ({','.join('?' * len(values))})")
+        params += values
+
+
+def _prefix(column, prefix, where, params):
+    """Range condition matching ``prefix`` that can use the column's index."""
+    if prefix:
+        where.append(f"{column} >= ? AND {column} < ?")
+        params += [prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)]
+
+
+def _page(sql, where, params, column, id_column, sort, order, limit, cursor):
+    if cursor:
+        value, row_id = decode_cursor(cursor, sort, order)
+        clause, clause_params = after_clause(column, id_column, order, value, row_id)
+        where.append(clause)
+        params += clause_params
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += f" ORDER BY {column} {order.upper()}, {id_column} {order.upper()} LIMIT ?"
+    rows = db.query(sql, params + [limit + 1])
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_cursor(sort, order, last[column.split(".", 1)[1]], last["id"])
+    return rows, next_cursor
+
+
+def list_vms(args):
+    """One page of VMs for /api/vms.
+
+    ``args`` are the query parameters: status, vm_type, hv_id and hv (name
+    or IP), each repeatable; name, a name prefix; sort, order, limit and the
+    cursor returned with the previous page. Raises QueryError for invalid
+    parameters.
+    """
+    sort, order, limit = _page_args(args, VM_SORT_COLUMNS, "id")
+    where, params = [], []
+    _in("v.status", args.getlist("status"), where, params)
+    _in("v.vm_type", args.getlist("vm_type"), where, params)
+    try:
+        _in("v.hv_id", [int(v) for v in args.getlist("hv_id") if v], where, params)
+    except ValueError:
+        raise QueryError("hv_id must be an integer")
+    hvs = [v for v in args.getlist("hv") if v]
+    if hvs:
+        marks = ",".join("?" * len(hvs))
+        where.append(f"v.hv_id IN (SELECT id FROM hypervisors WHERE name IN ({marks}) OR ip IN ({marks}))")
+        params += hvs + hvs
+    _prefix("v.name", args.get("name"), where, params)
+
+    rows, next_cursor = _page(f"SELECT {VM_COLUMNS} FROM vms v JOIN hypervisors h ON h.id = v.hv_id",
+                              where, params, VM_SORT_COLUMNS[sort], "v.id", sort, order, limit,
+                              args.get("cursor"))
+    progress = deploy_events.latest_progress([(r["hv_id"], r["name"]) for r in rows])
+    for row in rows:
+        row["progress"] = progress.get((row["hv_id"], row["name"]))
+    return {"items": rows, "next_cursor": next_cursor, "limit": limit}
+
+
+def list_hypervisors(args):
+    """One page of hypervisors with their cached capacity, for /api/hypervisors.
+
+    Filters are id (repeatable) and name, a name prefix; paging works as
+    for list_vms().
+    """
+    sort, order, limit = _page_args(args, HV_SORT_COLUMNS, "id")
+    where, params = [], []
+    try:
+        _in("h.id", [int(v) for v in args.getlist("id") if v], where, params)
+    except ValueError:
+        raise QueryError("id must be an integer")
+    _prefix("h.name", args.get("name"), where, params)
+
+    rows, next_cursor = _page("SELECT h.id, h.name, h.ip, h.username FROM hypervisors h",
+                              where, params, HV_SORT_COLUMNS[sort], "h.id", sort, order, limit,
+                              args.get("cursor"))
+    hosts = capacity.get_capacity()
+    for row in rows:
+        host = hosts.get(row["id"], {})
+        row.update({k: v for k, v in host.items() if k not in row})
+    return {"items": rows, "next_cursor": next_cursor, "limit": limit}
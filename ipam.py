@@ -0,0 +1,341 @@
+import os
+import time
+import ipaddress
+import threading
+import logging
+import db
+
+# Reservations made for a deployment whose VM rows never appeared (e.g. the
+# process died in between) are released after this many seconds
+IPAM_RESERVATION_TTL = int(os.environ.get("IPAM_RESERVATION_TTL", "3600"))
+
+SUBNET_FIELDS = ("id", "name", "cidr", "gateway", "range_start", "range_end")
+
+# Guards the cached bitmaps. Always taken inside a DB transaction, never
+# around one, so it cannot be held while waiting for the SQLite lock.
+_lock = threading.Lock()
+_indexes = {}
+
+
+class IPAMError(Exception):
+    """Addresses cannot be allocated or reserved as requested."""
+
+
+class SubnetIndex:
+    """Bitmap of one subnet's addresses, bit n set when network + n is taken.
+
+    The network and broadcast addresses, the gateway and everything outside
+    the allocation range start out taken. ``generation`` is the subnet's
+    generation the bitmap was built from.
+    """
+
+    __slots__ = ("network", "first", "last", "bits", "generation")
+
+    def __init__(self, subnet, taken, generation):
+        self.network = subnet["network"]
+        size = self.network.num_addresses
+        self.first = 1 if size > 2 else 0
+        self.last = size - 2 if size > 2 else size - 1
+        if subnet["range_start"]:
+            self.first = max(self.first, self.offset(subnet["range_start"]))
+        if subnet["range_end"]:
+            self.last = min(self.last, self.offset(subnet["range_end"]))
+        self.bits = 0
+        self.generation = generation
+        for ip in taken:
+            self.take(self.offset(ip))
+        if subnet["gateway"]:
+            self.take(self.offset(subnet["gateway"]))
+
+    def offset(self, ip):
+        return int(ipaddress.ip_address(ip)) - int(self.network.network_address)
+
+    def address(self, offset):
+        return str(self.network.network_address + offset)
+
+    def take(self, offset):
+        self.bits |= 1 << offset
+
+    def free(self, offset):
+        self.bits &= ~(1 << offset)
+
+    def is_free(self, offset):
+        return self.first <= offset <= self.last and not self.bits >> offset & 1
+
+    def next_free(self, start=0):
+        """Lowest free offset at or above ``start``, or None."""
+        start = max(start, self.first)
+        # Lowest clear bit of the bitmap from ``start`` upwards
+        clear = ~self.bits >> start << start
+        offset = (clear & -clear).bit_length() - 1
+        return offset if offset <= self.last else None
+
+    def free_count(self):
+        used = bin(self.bits >> self.first & ((1 << (self.last - self.first + 1)) - 1)).count("1")
+        return self.last - self.first + 1 - used
+
+
+def list_subnets():
+    """All subnets with their allocation counts."""
+    rows = db.query(
+        """SELECT s.id, s.name, s.cidr, s.gateway, s.range_start, s.range_end, s.created_at,
+                  COUNT(a.ip) AS allocated
+           FROM subnets s LEFT JOIN ip_allocations a ON a.subnet_id = s.id
+           GROUP BY s.id ORDER BY s.id"""
+    )
+    for row in rows:
+        with _lock:
+            row["free"] = _index(db.get_conn(), row["id"]).free_count()
+    return rows
+
+
+def _load_subnets(conn):
+    subnets = []
+    for row in conn.execute("SELECT id, name, cidr, gateway, range_start, range_end FROM subnets"):
+        subnet = dict(zip(SUBNET_FIELDS, row))
+        subnet["network"] = ipaddress.ip_network(subnet["cidr"])
+        subnets.append(subnet)
+    return subnets
+
+
+def subnet_for(ip, subnets):
+    try:
+        address = ipaddress.ip_address(ip)
+    except ValueError:
+        return None
+    return next((s for s in subnets if address in s["network"]), None)
+
+
+def _index(conn, subnet_id):
+    """The bitmap of ``subnet_id``, rebuilt when another writer changed it.
+
+    Callers hold _lock.
+    """
+    row = conn.execute("SELECT generation FROM subnets WHERE id=?", (subnet_id,)).fetchone()
+    if row is None:
+        raise IPAMError(f"Unknown subnet {subnet_id}")
+    index = _indexes.get(subnet_id)
+    if index is None or index.generation != row[0]:
+        subnet = next(s for s in _load_subnets(conn) if s["id"] == subnet_id)
+        taken = [r[0] for r in conn.execute("SELECT ip FROM ip_allocations WHERE subnet_id=?", (subnet_id,))]
+        index = _indexes[subnet_id] = SubnetIndex(subnet, taken, row[0])
+    return index
+
+
+def _bump(conn, subnet_ids, index=None):
+    """Mark subnets as changed so other processes rebuild their bitmaps.
+
+    ``index``, if given, already reflects the change and stays cached; if
+    the transaction rolls back its generation no longer matches and it is
+    rebuilt. Other cached bitmaps of the subnets are dropped.
+    """
+    for subnet_id in set(subnet_ids):
+        conn.execute("UPDATE subnets SET generation = generation + 1 WHERE id=?", (subnet_id,))
+        if index is not None and _indexes.get(subnet_id) is index:
+            index.generation += 1
+        else:
+            _indexes.pop(subnet_id, None)
+
+
+def add_subnet(cidr, gateway=None, name=None, range_start=None, range_end=None):
+    """Register a subnet, returning its id.
+
+    The gateway defaults to the first host address. Addresses of VMs
+    already in the database that fall into the subnet are recorded as
+    allocated. Raises IPAMError for invalid or overlapping subnets.
+    """
+    try:
+        network = ipaddress.ip_network(cidr, strict=False)
+        hosts = [ipaddress.ip_address(a) for a in (gateway, range_start, range_end) if a]
+    except ValueError as e:
+        raise IPAMError(str(e))
+    if network.version != 4:
+        raise IPAMError("Only IPv4 subnets are managed")
+    if any(a not in network for a in hosts):
+        raise IPAMError(f"Gateway and range must be inside {network}")
+    if gateway is None and network.num_addresses > 2:
+        gateway = str(network.network_address + 1)
+
+    with db.transaction(immediate=True) as conn:
+        for other in _load_subnets(conn):
+            if other["network"].overlaps(network):
+                raise IPAMError(f"{network} overlaps subnet {other['cidr']}")
+        now = time.strftime("%Y-%m-%d %H:%M:%S")
+        subnet_id = conn.execute(
+            """INSERT INTO subnets (name, cidr, gateway, range_start, range_end, created_at)
+               VALUES (?, ?, ?, ?, ?, ?)""",
+            (name or str(network), str(network), gateway, range_start, range_end, now),
+        ).lastrowid
+        existing = [
+            (ip, subnet_id, vm_name, hv_id, "vms", now)
+            for vm_name, hv_id, ip in conn.execute(
+                "SELECT name, hv_id, ip_addr FROM vms WHERE ip_addr IS NOT NULL")
+            if subnet_for(ip, [{"network": network}])
+        ]
+        conn.executemany(
+            """INSERT OR IGNORE INTO ip_allocations (ip, subnet_id, vm_name, hv_id, source, allocated_at)
+               VALUES (?, ?, ?, ?, ?, ?)""", existing)
+    logging.info(f"Added subnet {network} (gateway {gateway}), {len(existing)} address(es) already in use")
+    return subnet_id
+
+
+def allocations(subnet_id):
+    return db.query(
+        "SELECT ip, vm_name, hv_id, source, allocated_at FROM ip_allocations WHERE subnet_id=?",
+        (subnet_id,),
+    )
+
+
+def assign_addresses(plan, subnet_id=None, start=None):
+    """Give every VM of a deployment plan its own address.
+
+    VMs are taken from a managed subnet: ``subnet_id``, or the one holding
+    ``start``. Allocation begins at ``start`` if given and fills free
+    addresses upwards; every address is reserved in one transaction and
+    ipaddr, prefix and gateway are set on the VMs. A single VM may also
+    get an address outside any managed subnet. Returns the reserved
+    addresses. Raises IPAMError if the subnet has too few free addresses
+    or ``start`` is taken.
+    """
+    wanted = [(vm, entry["hv_id"]) for entry in plan for vm in entry["vms"]]
+    if not wanted or (subnet_id is None and not start):
+        return []
+    with db.transaction(immediate=True) as conn, _lock:
+        subnets = _load_subnets(conn)
+        subnet = next((s for s in subnets if s["id"] == subnet_id), None) if subnet_id \
+            else subnet_for(start, subnets)
+        if subnet is None:
+            if subnet_id:
+                raise IPAMError(f"Unknown subnet {subnet_id}")
+            if len(wanted) > 1:
+                raise IPAMError(f"{start} is not in a managed subnet, "
+                                f"cannot allocate addresses for {len(wanted)} VMs")
+            return []  # unmanaged static address, left as entered
+        index = _index(conn, subnet["id"])
+        offset = index.first
+        if start:
+            if subnet_for(start, [subnet]) is None:
+                raise IPAMError(f"{start} is not in subnet {subnet['cidr']}")
+            offset = index.offset(start)
+            if not index.is_free(offset):
+                raise IPAMError(f"{start} is already allocated")
+
+        offsets = []
+        for _ in wanted:
+            offset = index.next_free(offset)
+            if offset is None:
+                raise IPAMError(f"Subnet {subnet['cidr']} has only {len(offsets)} free address(es) "
+                                f"from {start or index.address(index.first)}, {len(wanted)} needed")
+            offsets.append(offset)
+            offset += 1
+
+        now = time.strftime("%Y-%m-%d %H:%M:%S")
+        rows = []
+        for (vm, hv_id), offset in zip(wanted, offsets):
+            rows.append((index.address(offset), subnet["id"], vm["name"], hv_id, "ipam", now))
+        conn.executemany(
+            """INSERT INTO ip_allocations (ip, subnet_id, vm_name, hv_id, source, allocated_at)
+               VALUES (?, ?, ?, ?, ?, ?)""", rows)
+        for offset in offsets:
+            index.take(offset)
+        _bump(conn, [subnet["id"]], index)
+        for (vm, _), row in zip(wanted, rows):
+            vm["ipaddr"] = row[0]
+            vm["prefix"] = subnet["network"].prefixlen
+            vm["gateway"] = subnet["gateway"]
+    logging.info(f"Allocated {len(rows)} address(es) in {subnet['cidr']}: "
+                 f"{rows[0][0]} .. {rows[-1][0]}")
+    return [row[0] for row in rows]
+
+
+def release_ips(ips):
+    """Return reserved addresses to their subnets."""
+    if not ips:
+        return
+    with db.transaction() as conn, _lock:
+        placeholders = ",".join("?" * len(ips))
+        subnet_ids = [r[0] for r in conn.execute(
+            f"SELECT DISTINCT subnet_id FROM ip_allocations WHERE ip IN ({placeholders})", ips)]
+        conn.execute(f"DELETE FROM ip_allocations WHERE ip IN ({placeholders})", ips)
+        _bump(conn, subnet_ids)
+
+
+def release_vms(conn, hv_id, vm_names):
+    """Release the addresses of VMs removed from ``hv_id``, inside the caller's transaction."""
+    if not vm_names:
+        return
+    placeholders = ",".join("?" * len(vm_names))
+    params = (hv_id, *vm_names)
+    with _lock:
+        subnet_ids = [r[0] for r in conn.execute(
+            f"SELECT DISTINCT subnet_id FROM ip_allocations WHERE hv_id=? AND vm_name IN ({placeholders})",
+            params)]
+        if subnet_ids:
+            conn.execute(f"DELETE FROM ip_allocations WHERE hv_id=? AND vm_name IN ({placeholders})", params)
+            _bump(conn, subnet_ids)
+
+
+def release_stale(ttl=IPAM_RESERVATION_TTL):
+    """Release reservations older than ``ttl`` seconds whose VM was never recorded."""
+    cutoff = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(time.time() - ttl))
+    with db.transaction() as conn, _lock:
+        stale = conn.execute(
+            """SELECT ip, subnet_id FROM ip_allocations a
+               WHERE source='ipam' AND allocated_at < ?
+                 AND NOT EXISTS (SELECT 1 FROM vms WHERE vms.name = a.vm_name AND vms.hv_id = a.hv_id)""",
+            (cutoff,),
+        ).fetchall()
+        if stale:
+            conn.executemany("DELETE FROM ip_allocations WHERE ip=?", [(ip,) for ip, _ in stale])
+            _bump(conn, [subnet_id for _, subnet_id in stale])
+            logging.info(f"Released {len(stale)} stale address reservation(s)")
+
+
+def record_addresses(conn, hv_id, domains):
+    """Store the addresses harvested from ``hv_id``'s domains.
+
+    A VM whose recorded ip_addr is not among the addresses it actually has
+    gets the first one inside a managed subnet (or simply the first), and
+    the address is recorded as allocated to it. Addresses still allocated
+    to the VM that it no longer has are released, unless it is still being
+    deployed (the guest may not have its assigned address yet). Runs inside
+    the caller's transaction; returns the number of VMs updated.
+    """
+    rows = conn.execute("SELECT name, ip_addr, status FROM vms WHERE hv_id=?", (hv_id,)).fetchall()
+    stored = {name: ip_addr for name, ip_addr, _ in rows}
+    deploying = {name for name, _, status in rows if status == "In-progress"}
+    found = [(d["name"], d["addresses"]) for d in domains
+             if d.get("addresses") and d["name"] in stored and stored[d["name"]] not in d["addresses"]]
+    if not found:
+        return 0
+    subnets = _load_subnets(conn)
+    now = time.strftime("%Y-%m-%d %H:%M:%S")
+    changed = []
+    with _lock:
+        for name, addresses in found:
+            ip = next((a for a in addresses if subnet_for(a, subnets)), addresses[0])
+            conn.execute("UPDATE vms SET ip_addr=? WHERE name=? AND hv_id=?", (ip, name, hv_id))
+            if name not in deploying:
+                old = conn.execute(
+                    f"""SELECT ip, subnet_id FROM ip_allocations WHERE vm_name=? AND hv_id=?
+                        AND ip NOT IN ({','.join('?' * len(addresses))})""",
+                    (name, hv_id, *addresses)).fetchall()
+                if old:
+                    conn.executemany("DELETE FROM ip_allocations WHERE ip=?", [(r[0],) for r in old])
+                    changed += [r[1] for r in old]
+                    logging.info(f"VM {name} on HV {hv_id} moved to {ip}, released "
+                                 f"{', '.join(r[0] for r in old)}", extra={"vm_name": name})
+            subnet = subnet_for(ip, subnets)
+            if subnet is None:
+                continue
+            owner = conn.execute("SELECT vm_name, hv_id FROM ip_allocations WHERE ip=?", (ip,)).fetchone()
+            if owner is None:
+                conn.execute(
+                    """INSERT INTO ip_allocations (ip, subnet_id, vm_name, hv_id, source, allocated_at)
+                       VALUES (?, ?, ?, ?, 'harvest', ?)""", (ip, subnet["id"], name, hv_id, now))
+                changed.append(subnet["id"])
+            elif tuple(owner) != (name, hv_id):
+                logging.warning(f"VM {name} on HV {hv_id} uses {ip}, which is allocated to "
+                                f"{owner[0]} on HV {owner[1]}", extra={"vm_name": name})
+        _bump(conn, changed)
+    return len(found)
@@ -0,0 +1,337 @@
+import os
+import re
+import gzip
+import json
+import shutil
+import sqlite3
+import threading
+import time
+import logging
+import logging.handlers
+import db
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+LOG_DIR = os.environ.get("LOG_DIR", os.path.join(BASE_DIR, "logs"))
+JOB_LOG_DIR = os.path.join(LOG_DIR, "jobs")
+
+# Size based rotation of the application and access logs, rotated files are
+# gzipped. Job logs are gzipped when their job finishes and pruned after
+# LOG_JOB_RETENTION_DAYS.
+LOG_MAX_BYTES = int(os.environ.get("LOG_MAX_BYTES", str(20 * 1024 * 1024)))
+LOG_BACKUP_COUNT = int(os.environ.get("LOG_BACKUP_COUNT", "10"))
+LOG_JOB_RETENTION_DAYS = int(os.environ.get("LOG_JOB_RETENTION_DAYS", "30"))
+# Job log files kept open at once
+LOG_MAX_OPEN_FILES = 64
+
+CONTEXT_FIELDS = ("job_id", "hv_id", "vm_name")
+
+_context = threading.local()
+
+
+class job_context:
+    """Attribute log records of the current thread to the given jobs.
+
+    ``jobs`` are job_queue jobs; their payload may carry hv_ip and the VM
+    names. With a single job every record belongs to it. With a batch the
+    owner is looked up from the record's ``ansible_host`` or ``vm_name``.
+    """
+
+    def __init__(self, jobs):
+        self.jobs = list(jobs)
+
+    def __enter__(self):
+        by_host, by_vm = {}, {}
+        for job in self.jobs:
+            payload = job.get("payload") or {}
+            owner = (job["id"], job.get("hv_id"))
+            if payload.get("hv_ip"):
+                by_host[payload["hv_ip"]] = owner
+            for vm in payload.get("vms", []):
+                by_vm[vm["name"]] = owner
+            for name in payload.get("vm_names", []):
+                by_vm[name] = owner
+        only = (self.jobs[0]["id"], self.jobs[0].get("hv_id")) if len(self.jobs) == 1 else None
+        self._previous = getattr(_context, "jobs", None)
+        _context.jobs = (only, by_host, by_vm)
+        return self
+
+    def __exit__(self, *exc):
+        _context.jobs = self._previous
+
+
+def _vm_from_task(task):
+    # vm_creation.yml names every task "<role> : <vm> | <step>"
+    if not task or " | " not in task:
+        return None
+    return task.split(" : ", 1)[-1].split(" | ", 1)[0].strip()
+
+
+class ContextFilter(logging.Filter):
+    """Fill job_id, hv_id and vm_name on every record from the job context."""
+
+    def filter(self, record):
+        vm_name = getattr(record, "vm_name", None) or _vm_from_task(getattr(record, "ansible_task", None))
+        owner = None
+        jobs = getattr(_context, "jobs", None)
+        if jobs:
+            only, by_host, by_vm = jobs
+            owner = only or by_vm.get(vm_name) or by_host.get(getattr(record, "ansible_host", None))
+        record.vm_name = vm_name
+        if getattr(record, "job_id", None) is None:
+            record.job_id = owner[0] if owner else None
+        if getattr(record, "hv_id", None) is None:
+            record.hv_id = owner[1] if owner else None
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line."""
+
+    def format(self, record):
+        entry = {
+            "ts": self.formatTime(record, "%Y-%m-%d %H:%M:%S") + f".{int(record.msecs):03d}",
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "msg": record.getMessage(),
+        }
+        for field in CONTEXT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def _gzip_rotator(source, dest, mode="wb"):
+    with open(source, "rb") as src, gzip.open(dest, mode) as dst:
+        shutil.copyfileobj(src, dst)
+    os.remove(source)
+
+
+def rotating_handler(filename):
+    handler = logging.handlers.RotatingFileHandler(
+        os.path.join(LOG_DIR, filename), maxBytes=LOG_MAX_BYTES,
+        backupCount=LOG_BACKUP_COUNT, encoding="utf-8",
+    )
+    handler.namer = lambda name: name + ".gz"
+    handler.rotator = _gzip_rotator
+    return handler
+
+
+def _safe_name(name):
+    return re.sub(r"[^\w.-]", "_", str(name))
+
+
+def job_log_path(job_id, vm_name=None):
+    """Path of a job's log, or of one VM's part of it, relative to LOG_DIR."""
+    filename = f"{_safe_name(vm_name)}.jsonl" if vm_name else "job.jsonl"
+    return os.path.join("jobs", str(job_id), filename)
+
+
+_INSERT_INDEX = """INSERT OR IGNORE INTO job_logs (job_id, hv_id, vm_name, path, created_at)
+                   VALUES (?, ?, ?, ?, ?)"""
+
+
+def index_job_logs(conn, jobs):
+    """Record the log files of just claimed ``jobs`` in the job_logs table.
+
+    Called inside the claim transaction, so the log of every VM named in a
+    payload is found by vm_log() while its job runs.
+    """
+    now = time.strftime("%Y-%m-%d %H:%M:%S")
+    rows = []
+    for job in jobs:
+        payload = job.get("payload") or {}
+        names = [vm["name"] for vm in payload.get("vms", [])] + list(payload.get("vm_names", []))
+        for vm_name in [None] + names:
+            rows.append((job["id"], job.get("hv_id"), vm_name or "", job_log_path(job["id"], vm_name), now))
+    conn.executemany(_INSERT_INDEX, rows)
+
+
+class JobFileHandler(logging.Handler):
+    """Write records of a job to its own file, plus a file per VM.
+
+    Files are indexed in the job_logs table when their job is claimed; one
+    opened for a VM missing from the payload is indexed when the job is
+    closed. Records can be logged in the middle of the thread's transaction,
+    so emit() never writes to the DB.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._files = {}
+        self._opened = {}  # job_id -> {vm_name: (hv_id, path)}
+
+    def _open(self, job_id, hv_id, vm_name):
+        key = (job_id, vm_name)
+        stream = self._files.pop(key, None)
+        if stream is None:
+            path = job_log_path(job_id, vm_name)
+            full = os.path.join(LOG_DIR, path)
+            os.makedirs(os.path.dirname(full), exist_ok=True)
+            # Line buffered, other processes read the log while it is written
+            stream = open(full, "a", encoding="utf-8", buffering=1)
+            self._opened.setdefault(job_id, {})[vm_name or ""] = (hv_id, path)
+            while len(self._files) >= LOG_MAX_OPEN_FILES:
+                self._files.pop(next(iter(self._files))).close()
+        self._files[key] = stream  # most recently used last
+        return stream
+
+    def emit(self, record):
+        job_id = getattr(record, "job_id", None)
+        if job_id is None:
+            return
+        try:
+            line = self.format(record) + "\n"
+            hv_id = getattr(record, "hv_id", None)
+            self._open(job_id, hv_id, None).write(line)
+            if getattr(record, "vm_name", None):
+                self._open(job_id, hv_id, record.vm_name).write(line)
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        with self.lock:
+            for stream in self._files.values():
+                stream.flush()
+
+    def _index(self, job_id, opened):
+        now = time.strftime("%Y-%m-%d %H:%M:%S")
+        try:
+            # Own connection, never part of a transaction of the caller
+            conn = db.connect()
+            try:
+                with conn:
+                    conn.executemany(_INSERT_INDEX, [(job_id, hv_id, vm_name, path, now)
+                                                     for vm_name, (hv_id, path) in opened.items()])
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            logging.warning(f"Could not index the logs of job {job_id}: {e}")
+
+    def close_job(self, job_id):
+        """Close and gzip the files of a finished job."""
+        with self.lock:
+            for key in [k for k in self._files if k[0] == job_id]:
+                self._files.pop(key).close()
+            opened = self._opened.pop(job_id, {})
+        if opened:
+            self._index(job_id, opened)
+        job_dir = os.path.join(JOB_LOG_DIR, str(job_id))
+        if not os.path.isdir(job_dir):
+            return
+        for filename in os.listdir(job_dir):
+            if filename.endswith(".jsonl"):
+                path = os.path.join(job_dir, filename)
+                # A retried job appends a new gzip member to its old log
+                _gzip_rotator(path, path + ".gz", "ab")
+
+    def close(self):
+        with self.lock:
+            for stream in self._files.values():
+                stream.close()
+            self._files.clear()
+        super().close()
+
+
+_job_handler = None
+
+
+def setup_logging(level=logging.INFO, app_log="app.jsonl"):
+    """Route application logs to rotating JSON files under LOG_DIR.
+
+    logs/app.jsonl (``app_log``) gets everything except HTTP access lines,
+    which go to logs/access.log; each job additionally gets
+    logs/jobs/<job_id>/.
+    """
+    global _job_handler
+    if _job_handler is not None:
+        return
+    os.makedirs(JOB_LOG_DIR, exist_ok=True)
+    formatter = JsonFormatter()
+    context = ContextFilter()
+
+    app_handler = rotating_handler(app_log)
+    _job_handler = JobFileHandler()
+    root = logging.getLogger()
+    root.setLevel(level)
+    for handler in (app_handler, _job_handler):
+        handler.setFormatter(formatter)
+        handler.addFilter(context)
+        root.addHandler(handler)
+
+    access = logging.getLogger("werkzeug")
+    access.propagate = False
+    access_handler = rotating_handler("access.log")
+    access_handler.setFormatter(logging.Formatter("%(message)s"))
+    access.addHandler(access_handler)
+
+    # Connection and auth chatter of every SSH session
+    logging.getLogger("paramiko").setLevel(logging.WARNING)
+
+
+def close_job_logs(job_ids):
+    if _job_handler is not None:
+        for job_id in job_ids:
+            _job_handler.close_job(job_id)
+
+
+def prune_job_logs(days=LOG_JOB_RETENTION_DAYS):
+    """Remove job logs older than ``days`` and their index rows."""
+    cutoff = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(time.time() - days * 86400))
+    try:
+        with db.transaction() as conn:
+            old = [r[0] for r in conn.execute(
+                "SELECT DISTINCT job_id FROM job_logs WHERE created_at < ?", (cutoff,))]
+            for job_id in old:
+                shutil.rmtree(os.path.join(JOB_LOG_DIR, str(job_id)), ignore_errors=True)
+            conn.execute("DELETE FROM job_logs WHERE created_at < ?", (cutoff,))
+    except sqlite3.OperationalError as e:
+        logging.warning(f"Could not prune job logs: {e}")
+
+
+def _read_log(path):
+    full = os.path.join(LOG_DIR, path)
+    records = []
+    for name, opener in ((full + ".gz", gzip.open), (full, open)):
+        if os.path.exists(name):
+            with opener(name, "rt", encoding="utf-8") as f:
+                records.extend(json.loads(line) for line in f if line.strip())
+    return records
+
+
+def job_log(job_id):
+    """Records of a job, oldest first."""
+    if _job_handler is not None:
+        _job_handler.flush()
+    return _read_log(job_log_path(job_id))
+
+
+def ansible_output(job_id, limit):
+    """Last ``limit`` Ansible output lines of a job, read from its log.
+
+    Returns None if the job logged no output.
+    """
+    lines = [r["msg"] for r in job_log(job_id)
+             if r["msg"].startswith(("[Ansible STDOUT]", "[Ansible STDERR]"))]
+    return lines[-limit:] or None
+
+
+def vm_log(vm_name, hv_id=None):
+    """Records of the latest job that logged about ``vm_name``.
+
+    Returns (job_id, records), or (None, []) if the VM has no log.
+    """
+    query = "SELECT job_id, path FROM job_logs WHERE vm_name=?"
+    params = [vm_name]
+    if hv_id is not None:
+        query += " AND hv_id=?"
+        params.append(hv_id)
+    row = db.query_one(query + " ORDER BY job_id DESC LIMIT 1", params)
+    if row is None:
+        return None, []
+    if _job_handler is not None:
+        _job_handler.flush()
+    return row["job_id"], _read_log(row["path"])
@@ -0,0 +1,307 @@
+import os
+import json
+import threading
+import time
+import logging
+from contextlib import nullcontext
+import db
+import job_logs
+import ansible_engine
+
+# Worker threads, and maximum jobs running at once overall and against a
+# single hypervisor. One worker can run a whole batch of jobs.
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "4"))
+JOB_MAX_RUNNING = int(os.environ.get("JOB_MAX_RUNNING", "16"))
+JOB_MAX_PER_HV = int(os.environ.get("JOB_MAX_PER_HV", "1"))
+JOB_POLL_INTERVAL = float(os.environ.get("JOB_POLL_INTERVAL", "2"))
+
+JOB_STATES = ("queued", "running", "succeeded", "failed", "cancelled")
+
+_handlers = {}
+_cancel_handlers = {}
+_batched_kinds = set()
+_workers = []
+_worker_lock = None
+_wakeup = threading.Event()
+_stop = threading.Event()
+
+
+def _now():
+    return time.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def register_handler(kind, handler, batched=False, on_cancel=None):
+    """Register a handler for jobs of ``kind``.
+
+    A plain handler is called as ``handler(payload)``; the job succeeds when
+    it returns and fails when it raises. A batched handler is called as
+    ``handler(jobs)`` with every runnable queued job sharing the same batch
+    id, and returns ``{job_id: error}`` with error None for success.
+    ``on_cancel(job)`` is called for every job of the kind that is cancelled
+    before it ran.
+    """
+    _handlers[kind] = handler
+    if on_cancel is not None:
+        _cancel_handlers[kind] = on_cancel
+    if batched:
+        _batched_kinds.add(kind)
+    else:
+        _batched_kinds.discard(kind)
+
+
+def enqueue(kind, payload, hv_id=None, conn=None, batch=None, depends_on=()):
+    """Queue a job and return its id.
+
+    Jobs of a batched kind that share ``batch`` are handed to the handler
+    together. The job only runs once every job in ``depends_on`` has
+    succeeded, and is cancelled if one of them fails or is cancelled. Pass
+    ``conn`` to insert the job inside the caller's transaction; the caller
+    is then responsible for committing.
+    """
+    with db.transaction() if conn is None else nullcontext(conn) as conn:
+        job_id = conn.execute(
+            """INSERT INTO jobs (kind, hv_id, batch, payload, state, created_at)
+               VALUES (?, ?, ?, ?, 'queued', ?)""",
+            (kind, hv_id, batch, json.dumps(payload), _now()),
+        ).lastrowid
+        conn.executemany("INSERT OR IGNORE INTO job_deps (job_id, depends_on) VALUES (?, ?)",
+                         [(job_id, parent) for parent in depends_on])
+    _wakeup.set()
+    return job_id
+
+
+def _cancel_dependents(conn, job_id):
+    """Cancel the queued jobs that depend on ``job_id``, directly or not."""
+    rows = conn.execute(
+        """WITH RECURSIVE blocked(id) AS (
+               SELECT job_id FROM job_deps WHERE depends_on = ?
+               UNION
+               SELECT d.job_id FROM job_deps d JOIN blocked b ON d.depends_on = b.id)
+           SELECT id, kind, hv_id, batch, payload FROM jobs
+           WHERE id IN (SELECT id FROM blocked) AND state = 'queued'""",
+        (job_id,),
+    ).fetchall()
+    conn.executemany(
+        "UPDATE jobs SET state='cancelled', error=?, finished_at=? WHERE id=? AND state='queued'",
+        [(f"dependency job {job_id} did not succeed", _now(), row[0]) for row in rows],
+    )
+    if rows:
+        logging.warning(f"Cancelled job(s) {[row[0] for row in rows]} depending on job {job_id}")
+    return rows
+
+
+def _run_cancel_handlers(rows):
+    for job_id, kind, hv_id, batch, payload in rows:
+        handler = _cancel_handlers.get(kind)
+        if handler is None:
+            continue
+        try:
+            handler({"id": job_id, "kind": kind, "hv_id": hv_id, "batch": batch,
+                     "payload": json.loads(payload)})
+        except Exception as e:
+            logging.exception(f"Cancel handler of job {job_id} ({kind}) failed: {e}")
+
+
+def cancel(job_id):
+    """Cancel a job that has not started yet, and the jobs depending on it.
+
+    Returns True on success.
+    """
+    with db.transaction(immediate=True) as conn:
+        row = conn.execute(
+            "SELECT id, kind, hv_id, batch, payload FROM jobs WHERE id=? AND state='queued'", (job_id,)
+        ).fetchone()
+        if row is None:
+            return False
+        conn.execute("UPDATE jobs SET state='cancelled', finished_at=? WHERE id=?", (_now(), job_id))
+        rows = [row] + _cancel_dependents(conn, job_id)
+    _run_cancel_handlers(rows)
+    return True
+
+
+def list_jobs(limit=100):
+    return db.query(
+        """SELECT id, kind, hv_id, batch, state, attempts, error, created_at, started_at, finished_at
+           FROM jobs ORDER BY id DESC LIMIT ?""",
+        (limit,),
+    )
+
+
+def record_pid(job_ids, pid):
+    """Remember the playbook process running ``job_ids``."""
+    if not job_ids:
+        return
+    db.execute(f"UPDATE jobs SET pid=? WHERE id IN ({','.join('?' * len(job_ids))})",
+               (pid, *job_ids))
+
+
+def recover_orphaned_jobs():
+    """Requeue jobs left 'running' by a process that died mid-run.
+
+    Their playbooks run in their own session and may have outlived it, they
+    are stopped first so a job never runs twice at once.
+    """
+    for row in db.query("SELECT DISTINCT pid FROM jobs WHERE state='running' AND pid IS NOT NULL"):
+        ansible_engine.stop_orphaned_playbook(row["pid"])
+    cur = db.execute("UPDATE jobs SET state='queued', started_at=NULL, pid=NULL WHERE state='running'")
+    if cur.rowcount:
+        logging.warning(f"Requeued {cur.rowcount} orphaned job(s)")
+    return cur.rowcount
+
+
+def claim_jobs():
+    """Atomically move the oldest runnable queued job to 'running'.
+
+    A job is runnable when the global and per-hypervisor limits leave room
+    for it. For batched kinds the other runnable jobs of the same batch are
+    claimed with it. Returns the claimed jobs as dicts, empty if nothing can
+    run now.
+    """
+    with db.transaction(immediate=True) as conn:
+        running = dict(conn.execute(
+            "SELECT hv_id, COUNT(*) FROM jobs WHERE state='running' GROUP BY hv_id"
+        ).fetchall())
+        total = sum(running.values())
+
+        # Jobs whose dependencies have not all succeeded yet are skipped
+        rows = conn.execute(
+            """SELECT id, kind, hv_id, batch, payload FROM jobs j
+               WHERE state='queued'
+                 AND NOT EXISTS (SELECT 1 FROM job_deps d JOIN jobs p ON p.id = d.depends_on
+                                 WHERE d.job_id = j.id AND p.state != 'succeeded')
+               ORDER BY id"""
+        ).fetchall()
+        claimed = []
+        for job_id, kind, hv_id, batch, payload in rows:
+            if total >= JOB_MAX_RUNNING:
+                break
+            if claimed:
+                first = claimed[0]
+                if kind != first["kind"] or batch is None or batch != first["batch"]:
+                    continue
+            if hv_id is not None and running.get(hv_id, 0) >= JOB_MAX_PER_HV:
+                continue
+            conn.execute(
+                "UPDATE jobs SET state='running', started_at=?, attempts=attempts+1 WHERE id=?",
+                (_now(), job_id),
+            )
+            running[hv_id] = running.get(hv_id, 0) + 1
+            total += 1
+            claimed.append({"id": job_id, "kind": kind, "hv_id": hv_id, "batch": batch,
+                            "payload": json.loads(payload)})
+            if kind not in _batched_kinds:
+                break
+        job_logs.index_job_logs(conn, claimed)
+    return claimed
+
+
+def finish_job(job_id, state, error=None):
+    cancelled = []
+    with db.transaction() as conn:
+        cur = conn.execute(
+            "UPDATE jobs SET state=?, error=?, finished_at=? WHERE id=? AND state='running'",
+            (state, error, _now(), job_id),
+        )
+        # A failure stops only the branch of jobs that depend on this one
+        if cur.rowcount and state != "succeeded":
+            cancelled = _cancel_dependents(conn, job_id)
+    _run_cancel_handlers(cancelled)
+    _wakeup.set()
+
+
+def run_jobs(jobs):
+    kind = jobs[0]["kind"]
+    ids = [job["id"] for job in jobs]
+    handler = _handlers.get(kind)
+    if handler is None:
+        for job_id in ids:
+            finish_job(job_id, "failed", f"No handler registered for job kind '{kind}'")
+        return
+
+    with job_logs.job_context(jobs):
+        logging.info(f"Job(s) {ids} ({kind}) started")
+        if kind in _batched_kinds:
+            try:
+                errors = handler(jobs)
+            except Exception as e:
+                logging.exception(f"Job(s) {ids} ({kind}) failed: {e}")
+                errors = {job_id: str(e) for job_id in ids}
+        else:
+            try:
+                handler(jobs[0]["payload"])
+                errors = {}
+            except Exception as e:
+                logging.exception(f"Job {ids[0]} ({kind}) failed: {e}")
+                errors = {ids[0]: str(e)}
+
+    for job_id in ids:
+        error = errors.get(job_id)
+        if error:
+            logging.error(f"Job {job_id} ({kind}) failed: {error}", extra={"job_id": job_id})
+            finish_job(job_id, "failed", error)
+        else:
+            logging.info(f"Job {job_id} ({kind}) succeeded", extra={"job_id": job_id})
+            finish_job(job_id, "succeeded")
+    job_logs.close_job_logs(ids)
+
+
+def _worker_loop():
+    while not _stop.is_set():
+        try:
+            jobs = claim_jobs()
+        except Exception as e:
+            logging.exception(f"Failed to claim jobs: {e}")
+            jobs = []
+        if not jobs:
+            _wakeup.wait(JOB_POLL_INTERVAL)
+            _wakeup.clear()
+            continue
+        run_jobs(jobs)
+
+
+class WorkersRunningError(RuntimeError):
+    """Job workers are already running in another process."""
+
+
+def start_job_workers(count=JOB_WORKERS):
+    """Start the worker threads, in one process per database only.
+
+    The process holds the "workers" lock of the DB while its workers run, so
+    jobs still 'running' can only be left over from a process that died and
+    are requeued. Raises WorkersRunningError if another process holds it.
+    """
+    global _worker_lock
+    if _workers:
+        return _workers
+    if _worker_lock is None:
+        _worker_lock = db.lock_file("workers", blocking=False)
+        if _worker_lock is None:
+            raise WorkersRunningError(f"Job workers already run in another process using {db.DB_FILE}")
+    recover_orphaned_jobs()
+    _stop.clear()
+    for i in range(count):
+        t = threading.Thread(target=_worker_loop, name=f"job-worker-{i}", daemon=True)
+        t.start()
+        _workers.append(t)
+    return _workers
+
+
+def stop_job_workers(timeout=0):
+    """Stop claiming jobs and wait up to ``timeout`` seconds for running ones.
+
+    Returns True once every worker has exited, which also releases the
+    workers lock.
+    """
+    global _worker_lock
+    _stop.set()
+    _wakeup.set()
+    deadline = time.monotonic() + timeout
+    for t in _workers:
+        t.join(max(0, deadline - time.monotonic()))
+    if any(t.is_alive() for t in _workers):
+        return False
+    _workers.clear()
+    if _worker_lock is not None:
+        _worker_lock.close()
+        _worker_lock = None
+    return True
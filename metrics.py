@@ -0,0 +1,214 @@
+import time
+import threading
+from contextlib import contextmanager
+
+# Histogram bucket bounds in seconds
+SSH_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+TASK_BUCKETS = (0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+PLAYBOOK_BUCKETS = (10, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200)
+LOCK_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+RENDER_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_metrics = []
+_collectors = []
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    """One metric family, holding a value per label combination."""
+
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} takes labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def snapshot(self):
+        """[label values, value] pairs, JSON serialisable."""
+        with self._lock:
+            return [[list(key), self._copy(value)] for key, value in self._values.items()]
+
+    def merged(self, snapshots, own=True):
+        """Sums of ``snapshots`` and, if ``own``, this process's values, keyed by label values."""
+        values = {}
+        for items in ([self.snapshot()] if own else []) + list(snapshots):
+            for key, value in items:
+                key = tuple(key)
+                values[key] = self._add(values.get(key), value)
+        return values
+
+    def _copy(self, value):
+        return value
+
+    def _add(self, total, value):
+        return (total or 0) + value
+
+    def samples(self, values=None):
+        """(suffix, label values, extra labels, value) tuples for render()."""
+        if values is None:
+            values = self.merged([])
+        return [("", key, (), value) for key, value in sorted(values.items())]
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=SSH_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of the ``with`` block, also when it raises.
+
+        Works as a decorator as well.
+        """
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def total(self):
+        """(count, sum) of the observations across all label values."""
+        with self._lock:
+            return (sum(counts[-1] for counts, _ in self._values.values()),
+                    sum(total for _, total in self._values.values()))
+
+    def _copy(self, value):
+        counts, total = value
+        return [list(counts), total]
+
+    def _add(self, total, value):
+        counts, value_sum = value
+        if len(counts) != len(self.buckets):
+            return total  # recorded with other buckets
+        if total is None:
+            return [list(counts), value_sum]
+        return [[a + b for a, b in zip(total[0], counts)], total[1] + value_sum]
+
+    def samples(self, values=None):
+        if values is None:
+            values = self.merged([])
+        samples = []
+        for key, (counts, total) in sorted(values.items()):
+            for bound, count in zip(self.buckets, counts):
+                samples.append(("_bucket", key, (("le", _format_value(bound)),), count))
+            samples.append(("_sum", key, (), total))
+            samples.append(("_count", key, (), counts[-1]))
+        return samples
+
+
+def register_collector(collector):
+    """Add a callable returning metric families built at scrape time.
+
+    It returns (name, type, documentation, [(label dict, value)]) tuples,
+    e.g. gauges read from a cache that is already kept elsewhere.
+    """
+    _collectors.append(collector)
+
+
+def snapshot():
+    """Values of every metric of this process, JSON serialisable."""
+    return {metric.name: metric.snapshot() for metric in _metrics}
+
+
+def merge_snapshots(snapshots):
+    """One snapshot holding the sums of ``snapshots``."""
+    return {metric.name: [[list(key), value] for key, value in
+                          metric.merged([s.get(metric.name, []) for s in snapshots], own=False).items()]
+            for metric in _metrics}
+
+
+def render(snapshots=()):
+    """All metrics in the Prometheus text exposition format.
+
+    ``snapshots`` taken by snapshot() in other processes are added to the
+    values of this one.
+    """
+    lines = []
+    for metric in _metrics:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        values = metric.merged([s.get(metric.name, []) for s in snapshots])
+        for suffix, key, extra, value in metric.samples(values):
+            lines.append(f"{metric.name}{suffix}{_format_labels(metric.labelnames, key, extra)} "
+                         f"{_format_value(value)}")
+    for collector in _collectors:
+        for name, kind, documentation, samples in collector():
+            lines.append(f"# HELP {name} {documentation}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                lines.append(f"{name}{_format_labels(labels, labels.values())} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+
+SSH_COMMAND_SECONDS = Histogram(
+    "vmdeploy_ssh_command_seconds", "Duration of SSH commands run on hypervisors.",
+    ("hypervisor", "command"), SSH_BUCKETS)
+SSH_COMMAND_FAILURES = Counter(
+    "vmdeploy_ssh_command_failures_total", "SSH commands that raised an error.",
+    ("hypervisor", "command"))
+DEPLOY_TASK_SECONDS = Histogram(
+    "vmdeploy_deploy_task_seconds", "Duration of the per-VM tasks of deploy playbook runs.",
+    ("hypervisor", "vm_type", "task"), TASK_BUCKETS)
+DEPLOY_TASK_FAILURES = Counter(
+    "vmdeploy_deploy_task_failures_total", "Per-VM deploy tasks that failed.",
+    ("hypervisor", "vm_type", "task"))
+VM_DEPLOYS = Counter(
+    "vmdeploy_vm_deploys_total", "Finished VM deployments by outcome.",
+    ("hypervisor", "vm_type", "result"))
+PLAYBOOK_SECONDS = Histogram(
+    "vmdeploy_playbook_seconds", "Duration of ansible-playbook runs.",
+    ("playbook", "result"), PLAYBOOK_BUCKETS)
+PAGE_RENDER_SECONDS = Histogram(
+    "vmdeploy_page_render_seconds", "Time spent building and rendering UI pages.",
+    ("page",), RENDER_BUCKETS)
+DB_LOCK_WAIT_SECONDS = Histogram(
+    "vmdeploy_db_lock_wait_seconds", "Time spent waiting for the SQLite write lock.",
+    (), LOCK_BUCKETS)
@@ -0,0 +1,75 @@
+"""Metrics of every process using the database, served from any of them.
+
+The web workers and worker.py each record their own counters and
+histograms. Every process stores a snapshot of them in metric_snapshots
+every METRICS_PUBLISH_INTERVAL seconds and /metrics adds up all stored
+snapshots, so a single scrape of any process shows the whole service.
+"""
+import os
+import json
+import time
+import logging
+import threading
+import db
+import metrics
+
+METRICS_PUBLISH_INTERVAL = float(os.environ.get("METRICS_PUBLISH_INTERVAL", "15"))
+
+# Snapshots of exited processes are folded into this row, so the sums
+# never go down while processes come and go
+RETIRED = "retired"
+
+_publisher = None
+
+
+def _process_key(pid):
+    """pid plus its start time, unique even when pids are reused; None if gone."""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            # The command name in field 2 may contain spaces, start after it
+            return f"{pid}:{f.read().rsplit(')', 1)[1].split()[19]}"
+    except (OSError, IndexError):
+        return None
+
+
+def publish():
+    """Store this process's snapshot and retire those of exited processes."""
+    now = time.strftime("%Y-%m-%d %H:%M:%S")
+    own = _process_key(os.getpid())
+    with db.transaction(immediate=True) as conn:
+        conn.execute("INSERT OR REPLACE INTO metric_snapshots (process, pid, updated_at, data) VALUES (?, ?, ?, ?)",
+                     (own, os.getpid(), now, json.dumps(metrics.snapshot())))
+        rows = conn.execute("SELECT process, pid, data FROM metric_snapshots").fetchall()
+        gone = [(process, data) for process, pid, data in rows
+                if process != RETIRED and _process_key(pid) != process]
+        if not gone:
+            return
+        retired = [json.loads(data) for process, _, data in rows if process == RETIRED]
+        merged = metrics.merge_snapshots(retired + [json.loads(data) for _, data in gone])
+        conn.execute("INSERT OR REPLACE INTO metric_snapshots (process, pid, updated_at, data) VALUES (?, NULL, ?, ?)",
+                     (RETIRED, now, json.dumps(merged)))
+        conn.executemany("DELETE FROM metric_snapshots WHERE process=?", [(process,) for process, _ in gone])
+
+
+def render():
+    """metrics.render() over the stored snapshots of all other processes."""
+    rows = db.query("SELECT data FROM metric_snapshots WHERE process != ?", (_process_key(os.getpid()),))
+    return metrics.render([json.loads(row["data"]) for row in rows])
+
+
+def _publish_loop(interval):
+    while True:
+        time.sleep(interval)
+        try:
+            publish()
+        except Exception as e:
+            logging.warning(f"Could not publish metrics: {e}")
+
+
+def start_publisher(interval=METRICS_PUBLISH_INTERVAL):
+    global _publisher
+    if _publisher is None:
+        _publisher = threading.Thread(target=_publish_loop, args=(interval,),
+                                      name="metrics-publisher", daemon=True)
+        _publisher.start()
+    return _publisher
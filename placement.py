@@ -0,0 +1,175 @@
+import os
+import heapq
+from bisect import bisect_left, insort
+
+STRATEGIES = ("spread", "best-fit", "worst-fit")
+
+# Allocation ratios applied to each hypervisor's total capacity
+CPU_OVERCOMMIT = float(os.environ.get("PLACEMENT_CPU_OVERCOMMIT", "1.0"))
+MEM_OVERCOMMIT = float(os.environ.get("PLACEMENT_MEM_OVERCOMMIT", "1.0"))
+DISK_OVERCOMMIT = float(os.environ.get("PLACEMENT_DISK_OVERCOMMIT", "1.0"))
+
+
+class PlacementError(Exception):
+    """The requested VMs cannot be placed on the given hypervisors."""
+
+
+class HostCapacity:
+    """Free capacity of one hypervisor; memory and disk in GB."""
+
+    __slots__ = ("hv_id", "order", "cpu", "mem", "disk", "placed")
+
+    def __init__(self, hv_id, order, cpu, mem, disk):
+        self.hv_id = hv_id
+        self.order = order
+        self.cpu = cpu
+        self.mem = mem
+        self.disk = disk
+        self.placed = 0
+
+    def fits(self, need):
+        return self.cpu >= need[0] and self.mem >= need[1] and self.disk >= need[2]
+
+    def take(self, need):
+        self.cpu -= need[0]
+        self.mem -= need[1]
+        self.disk -= need[2]
+        self.placed += 1
+
+
+def host_capacity(hv_id, order, total, used,
+                  cpu_ratio=CPU_OVERCOMMIT, mem_ratio=MEM_OVERCOMMIT, disk_ratio=DISK_OVERCOMMIT):
+    """Build a HostCapacity from (cpu, mem, disk) totals and usage."""
+    return HostCapacity(
+        hv_id, order,
+        total[0] * cpu_ratio - used[0],
+        total[1] * mem_ratio - used[1],
+        total[2] * disk_ratio - used[2],
+    )
+
+
+def vm_demand(vm):
+    """(cpu, mem GB, disk GB) requested by a VM spec (ram is in MB)."""
+    return (vm['cpu'], vm['ram'] / 1024, vm['disk'])
+
+
+class _FreeIndex:
+    """Hosts ordered by free memory, for best-fit and worst-fit lookups.
+
+    Memory is the scarcest resource on these hypervisors, so it is the
+    index key; CPU and disk are checked on the candidates it yields.
+    """
+
+    def __init__(self, hosts):
+        self._keys = sorted((h.mem, h.order) for h in hosts)
+        self._hosts = {h.order: h for h in hosts}
+
+    def find(self, need, smallest, allowed):
+        keys = self._keys
+        if smallest:
+            start = bisect_left(keys, (need[1], -1))
+            candidates = range(start, len(keys))
+        else:
+            candidates = range(len(keys) - 1, -1, -1)
+        for i in candidates:
+            mem, order = keys[i]
+            if mem < need[1]:
+                break
+            host = self._hosts[order]
+            if host.fits(need) and allowed(host):
+                return host
+        return None
+
+    def update(self, host, old_mem):
+        del self._keys[bisect_left(self._keys, (old_mem, host.order))]
+        insort(self._keys, (host.mem, host.order))
+
+
+class _SpreadIndex:
+    """Hosts ordered by number of VMs placed, ties broken by host order.
+
+    With enough capacity this reproduces the old round-robin spread.
+    """
+
+    def __init__(self, hosts, floor):
+        # Hosts that cannot fit even the smallest VM of the request are
+        # dropped for good instead of being skipped on every lookup
+        self._floor = floor
+        self._heap = [(h.placed, h.order, h) for h in hosts if h.fits(floor)]
+        heapq.heapify(self._heap)
+
+    def find(self, need, smallest, allowed):
+        skipped = []
+        found = None
+        while self._heap:
+            entry = heapq.heappop(self._heap)
+            host = entry[2]
+            if entry[0] != host.placed or not host.fits(self._floor):
+                continue  # stale entry or full host
+            if host.fits(need) and allowed(host):
+                found = host
+                break
+            skipped.append(entry)
+        for entry in skipped:
+            heapq.heappush(self._heap, entry)
+        return found
+
+    def update(self, host, old_mem):
+        if host.fits(self._floor):
+            heapq.heappush(self._heap, (host.placed, host.order, host))
+
+
+def place_vms(vms, hosts, strategy="spread"):
+    """Assign each VM to a hypervisor.
+
+    ``hosts`` is a list of HostCapacity. A VM may carry an ``affinity``
+    group (all members on the same host) and/or an ``anti_affinity`` group
+    (members on distinct hosts). Returns {hv_id: [vm, ...]} covering every
+    host, or raises PlacementError naming the first VM that does not fit.
+    """
+    if strategy not in STRATEGIES:
+        raise PlacementError(f"Unknown placement strategy '{strategy}'")
+    plan = {h.hv_id: [] for h in hosts}
+    if not vms:
+        return plan
+    if not hosts:
+        raise PlacementError("No hypervisors available for placement")
+
+    demands = [vm_demand(vm) for vm in vms]
+    if strategy == "spread":
+        index = _SpreadIndex(hosts, tuple(min(d[i] for d in demands) for i in range(3)))
+    else:
+        index = _FreeIndex(hosts)
+    smallest = strategy == "best-fit"
+    affinity_host = {}
+    anti_affinity_used = {}
+
+    for vm, need in zip(vms, demands):
+        group = vm.get('affinity')
+        anti = vm.get('anti_affinity')
+        used = anti_affinity_used.setdefault(anti, set()) if anti else ()
+
+        if group and group in affinity_host:
+            host = affinity_host[group]
+            if not host.fits(need) or host.hv_id in used:
+                raise PlacementError(
+                    f"VM {vm['name']} does not fit on hypervisor {host.hv_id} "
+                    f"required by affinity group '{group}'")
+        else:
+            host = index.find(need, smallest, lambda h: h.hv_id not in used)
+            if host is None:
+                reason = f" (anti-affinity group '{anti}')" if anti else ""
+                raise PlacementError(
+                    f"No hypervisor has room for VM {vm['name']} "
+                    f"({need[0]} CPU, {need[1]:g} GB RAM, {need[2]} GB disk){reason}")
+
+        old_mem = host.mem
+        host.take(need)
+        index.update(host, old_mem)
+        plan[host.hv_id].append(vm)
+        if group:
+            affinity_host[group] = host
+        if anti:
+            used.add(host.hv_id)
+
+    return plan
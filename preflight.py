@@ -0,0 +1,176 @@
+import os
+import shlex
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import db
+from ssh_pool import ssh_pool
+from virsh_collect import build_collect_script, split_sections, POOLS_COMMAND
+from hv_onboarding import free_disk_gb, DF_COMMAND
+from placement import MEM_OVERCOMMIT
+
+# Checks run against every target hypervisor before a deployment is accepted
+PREFLIGHT_WORKERS = int(os.environ.get("PREFLIGHT_WORKERS", "16"))
+PREFLIGHT_TIMEOUT = int(os.environ.get("PREFLIGHT_TIMEOUT", "30"))
+# Pool space reserved per VM whose disk is a thin overlay on the golden
+# image; flattened disks need their full size up front
+PREFLIGHT_OVERLAY_DISK_GB = int(os.environ.get("PREFLIGHT_OVERLAY_DISK_GB", "10"))
+
+
+def build_preflight_script(images, bridge, ips):
+    """One script answering every pre-flight question for a hypervisor.
+
+    ``images`` are image paths whose file name may be a glob.
+    """
+    sections = []
+    for i, image_path in enumerate(images):
+        image_dir, pattern = os.path.split(image_path)
+        # The pattern is a glob and must stay unquoted
+        sections.append((f"image{i}", f"ls -1d {shlex.quote(image_dir)}/{pattern}"))
+    sections += [
+        ("bridge", f"ip -o link show {shlex.quote(bridge)}"),
+        ("pools", POOLS_COMMAND),
+        ("df", DF_COMMAND),
+        ("meminfo", "grep MemAvailable /proc/meminfo"),
+        ("domains", "virsh list --all --name"),
+    ]
+    if ips:
+        targets = " ".join(shlex.quote(ip) for ip in ips)
+        sections.append(("ips_in_use", f"for ip in {targets}; do "
+                                       f"(ping -c 1 -W 1 \"$ip\" >/dev/null 2>&1 && echo \"$ip\") & "
+                                       f"done; wait"))
+    return build_collect_script(sections)
+
+
+def parse_preflight(output, images):
+    sections = split_sections(output)
+    found = {}
+    for i, image_path in enumerate(images):
+        matches = [line.strip() for line in sections.get(f"image{i}", "").splitlines() if line.strip()]
+        found[image_path] = matches[0] if matches else None
+    free, where = free_disk_gb(sections)
+    fields = sections.get("meminfo", "").split()
+    free_mem = int(fields[1]) / (1024 * 1024) if len(fields) >= 2 and fields[1].isdigit() else None
+    return {
+        "images": found,
+        "bridge": bool(sections.get("bridge", "").strip()),
+        "free_disk": free,
+        "free_disk_on": where,
+        "free_mem": free_mem,
+        "domains": {line.strip() for line in sections.get("domains", "").splitlines() if line.strip()},
+        "ips_in_use": set(sections.get("ips_in_use", "").split()),
+    }
+
+
+def disk_needed(vm):
+    return vm["disk"] if vm.get("flatten") else min(vm["disk"], PREFLIGHT_OVERLAY_DISK_GB)
+
+
+def check_host(entry, bridge, timeout=PREFLIGHT_TIMEOUT):
+    """Pre-flight facts of the hypervisor of one plan entry.
+
+    Returns the parse_preflight() dict, or {"error": ...} if the hypervisor
+    could not be queried.
+    """
+    hv = entry["hv"]
+    images = sorted({vm["qcow2_image"] for vm in entry["vms"]})
+    ips = sorted({vm["ipaddr"] for vm in entry["vms"] if vm.get("ipaddr")})
+    try:
+        output = ssh_pool.run(hv["ip"], hv["username"], hv["password"],
+                              build_preflight_script(images, bridge, ips), timeout=timeout,
+                              label="preflight")
+    except Exception as e:
+        return {"error": str(e) or type(e).__name__}
+    return parse_preflight(output, images)
+
+
+def _known_vms():
+    """(name, hv_id) pairs and IP owners already recorded in the database."""
+    names = {(r["name"], r["hv_id"]) for r in db.query("SELECT name, hv_id FROM vms")}
+    ips = {r["ip_addr"]: r["name"]
+           for r in db.query("SELECT name, ip_addr FROM vms WHERE ip_addr IS NOT NULL")}
+    return names, ips
+
+
+def vm_problems(plan, facts, bridge):
+    """Per-VM list of reasons the deployment would fail.
+
+    ``facts`` maps hv_id to the result of check_host().
+    """
+    known_names, known_ips = _known_vms()
+    requested_ips = {}
+    for entry in plan:
+        for vm in entry["vms"]:
+            if vm.get("ipaddr"):
+                requested_ips.setdefault(vm["ipaddr"], []).append(vm["name"])
+
+    report = []
+    for entry in plan:
+        if not entry["vms"]:
+            continue
+        hv_id, hv = entry["hv_id"], entry["hv"]
+        host = facts[hv_id]
+        host_problems = []
+        if "error" in host:
+            host_problems.append(f"hypervisor unreachable: {host['error']}")
+        else:
+            if not host["bridge"]:
+                host_problems.append(f"bridge {bridge} missing")
+            need = sum(disk_needed(vm) for vm in entry["vms"])
+            if host["free_disk"] is None:
+                host_problems.append("no storage pool or filesystem found")
+            elif host["free_disk"] < need:
+                host_problems.append(f"{host['free_disk']} GB free on {host['free_disk_on']}, "
+                                     f"{need} GB needed for {len(entry['vms'])} VM(s)")
+            # Memory the HV may hand out beyond what is free, as in placement
+            need_mem = sum(vm["ram"] for vm in entry["vms"]) / 1024
+            if host["free_mem"] is not None and host["free_mem"] * MEM_OVERCOMMIT < need_mem:
+                host_problems.append(f"{host['free_mem']:.1f} GB memory available, "
+                                     f"{need_mem:g} GB needed for {len(entry['vms'])} VM(s)")
+
+        for vm in entry["vms"]:
+            problems = list(host_problems)
+            if "error" not in host and host["images"][vm["qcow2_image"]] is None:
+                problems.append(f"no image matching {vm['qcow2_image']}")
+            if (vm["name"], hv_id) in known_names:
+                problems.append("name already in the database")
+            if "error" not in host and vm["name"] in host["domains"]:
+                problems.append("domain with this name already exists")
+            ip = vm.get("ipaddr")
+            if ip:
+                if len(requested_ips[ip]) > 1:
+                    problems.append(f"IP {ip} requested more than once")
+                if ip in known_ips:
+                    problems.append(f"IP {ip} already assigned to {known_ips[ip]}")
+                if "error" not in host and ip in host["ips_in_use"]:
+                    problems.append(f"IP {ip} answers ping")
+            report.append({"name": vm["name"], "hv_id": hv_id, "hv_ip": hv["ip"],
+                           "ok": not problems, "problems": problems})
+    return report
+
+
+def run_preflight(plan, bridge, workers=PREFLIGHT_WORKERS):
+    """Check every hypervisor of a deployment plan concurrently.
+
+    The qcow2_image of each VM may contain a glob, it is resolved on the
+    hypervisor and replaced by the matching file.
+    Returns the per-VM report of vm_problems(); nothing is changed on the
+    hypervisors.
+    """
+    entries = [entry for entry in plan if entry["vms"]]
+    if not entries:
+        return []
+    with ThreadPoolExecutor(max_workers=min(workers, len(entries)),
+                            thread_name_prefix="preflight") as pool:
+        futures = {entry["hv_id"]: pool.submit(check_host, entry, bridge) for entry in entries}
+        facts = {hv_id: future.result() for hv_id, future in futures.items()}
+
+    report = vm_problems(entries, facts, bridge)
+    for entry in entries:
+        images = facts[entry["hv_id"]].get("images", {})
+        for vm in entry["vms"]:
+            vm["qcow2_image"] = images.get(vm["qcow2_image"]) or vm["qcow2_image"]
+    failed = [r for r in report if not r["ok"]]
+    if failed:
+        logging.warning(f"Pre-flight failed for {len(failed)} of {len(report)} VM(s): "
+                        f"{[(r['name'], r['problems']) for r in failed]}")
+    return report
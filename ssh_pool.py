@@ -0,0 +1,168 @@
+import os
+import threading
+import time
+import logging
+from contextlib import contextmanager
+import paramiko
+import metrics
+
+# Pool tuning, all values in seconds except MAX_PER_HOST
+SSH_CONNECT_TIMEOUT = int(os.environ.get("SSH_CONNECT_TIMEOUT", "10"))
+SSH_COMMAND_TIMEOUT = int(os.environ.get("SSH_COMMAND_TIMEOUT", "120"))
+SSH_KEEPALIVE = int(os.environ.get("SSH_KEEPALIVE", "30"))
+SSH_IDLE_TIMEOUT = int(os.environ.get("SSH_IDLE_TIMEOUT", "300"))
+SSH_MAX_PER_HOST = int(os.environ.get("SSH_MAX_PER_HOST", "4"))
+# Port sshd listens on across the fleet
+SSH_PORT = int(os.environ.get("SSH_PORT", "22"))
+
+
+class _HostSlot:
+    def __init__(self, max_sessions):
+        self.sessions = threading.BoundedSemaphore(max_sessions)
+        self.idle = []  # list of (client, last_used)
+
+
+class SSHPool:
+    """Keyed pool of persistent paramiko connections to hypervisors.
+
+    Connections are keyed by (ip, username). At most ``max_per_host`` are
+    checked out per key at any time, idle ones are closed after
+    ``idle_timeout`` seconds and dead transports are replaced transparently.
+    """
+
+    def __init__(self, max_per_host=SSH_MAX_PER_HOST, idle_timeout=SSH_IDLE_TIMEOUT,
+                 keepalive=SSH_KEEPALIVE, connect_timeout=SSH_CONNECT_TIMEOUT):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.keepalive = keepalive
+        self.connect_timeout = connect_timeout
+        self._lock = threading.Lock()
+        self._hosts = {}
+        self._stats = {"hits": 0, "misses": 0, "reconnects": 0, "evictions": 0}
+
+    def _count(self, name, n=1):
+        with self._lock:
+            self._stats[name] += n
+
+    def _slot(self, key):
+        with self._lock:
+            slot = self._hosts.get(key)
+            if slot is None:
+                slot = self._hosts[key] = _HostSlot(self.max_per_host)
+            return slot
+
+    def _connect(self, ip, username, password):
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        client.connect(ip, port=SSH_PORT, username=username, password=password,
+                       timeout=self.connect_timeout,
+                       banner_timeout=self.connect_timeout,
+                       auth_timeout=self.connect_timeout)
+        transport = client.get_transport()
+        if transport and self.keepalive:
+            transport.set_keepalive(self.keepalive)
+        return client
+
+    @staticmethod
+    def _alive(client):
+        transport = client.get_transport()
+        return transport is not None and transport.is_active()
+
+    def _evict_idle(self):
+        now = time.monotonic()
+        expired = []
+        with self._lock:
+            for slot in self._hosts.values():
+                keep = []
+                for client, last_used in slot.idle:
+                    if now - last_used > self.idle_timeout:
+                        expired.append(client)
+                    else:
+                        keep.append((client, last_used))
+                slot.idle = keep
+            self._stats["evictions"] += len(expired)
+        for client in expired:
+            client.close()
+
+    def _checkout(self, slot, ip, username, password):
+        self._evict_idle()
+        while True:
+            with self._lock:
+                client = slot.idle.pop()[0] if slot.idle else None
+            if client is None:
+                self._count("misses")
+                return self._connect(ip, username, password)
+            if self._alive(client):
+                self._count("hits")
+                return client
+            client.close()
+            self._count("reconnects")
+            return self._connect(ip, username, password)
+
+    def _checkin(self, slot, client):
+        if self._alive(client):
+            with self._lock:
+                slot.idle.append((client, time.monotonic()))
+        else:
+            client.close()
+
+    @contextmanager
+    def connection(self, ip, username, password):
+        slot = self._slot((ip, username))
+        slot.sessions.acquire()
+        client = None
+        try:
+            client = self._checkout(slot, ip, username, password)
+            yield client
+        finally:
+            if client is not None:
+                self._checkin(slot, client)
+            slot.sessions.release()
+
+    def run(self, ip, username, password, command, timeout=SSH_COMMAND_TIMEOUT, label="other"):
+        """Run ``command`` on a pooled connection and return decoded stdout.
+
+        A command that fails because the transport dropped under us is
+        retried once on a fresh connection. The duration, waiting for a
+        pooled session included, is recorded under ``label``.
+        """
+        with metrics.SSH_COMMAND_SECONDS.time(hypervisor=ip, command=label):
+            try:
+                return self._run(ip, username, password, command, timeout)
+            except Exception:
+                metrics.SSH_COMMAND_FAILURES.inc(hypervisor=ip, command=label)
+                raise
+
+    def _run(self, ip, username, password, command, timeout):
+        for attempt in (1, 2):
+            with self.connection(ip, username, password) as ssh:
+                try:
+                    stdin, stdout, stderr = ssh.exec_command(command, timeout=timeout)
+                    output = stdout.read().decode()
+                    # -1: no exit status, the connection went away mid-command
+                    if stdout.channel.recv_exit_status() == -1 and not self._alive(ssh):
+                        raise paramiko.SSHException("connection closed before the command finished")
+                    return output
+                except (paramiko.SSHException, EOFError, OSError) as e:
+                    if self._alive(ssh) or attempt == 2:
+                        raise
+                    logging.warning(f"SSH transport to {ip} dropped ({e}), reconnecting")
+                    self._count("reconnects")
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["idle"] = sum(len(s.idle) for s in self._hosts.values())
+            stats["hosts"] = len(self._hosts)
+        return stats
+
+    def close_all(self):
+        with self._lock:
+            clients = [c for s in self._hosts.values() for c, _ in s.idle]
+            for s in self._hosts.values():
+                s.idle = []
+        for client in clients:
+            client.close()
+
+
+ssh_pool = SSHPool()
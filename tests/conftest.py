@@ -0,0 +1,34 @@
+import os
+import sys
+import tempfile
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Modules read their configuration at import time, point them at scratch
+# locations before any test imports them
+_scratch = tempfile.mkdtemp(prefix="vmdeploy-tests-")
+os.environ["HV_DB_FILE"] = os.path.join(_scratch, "hv.db")
+os.environ["LOG_DIR"] = os.path.join(_scratch, "logs")
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+
+def fixture(*path):
+    with open(os.path.join(FIXTURES, *path), encoding="utf-8") as f:
+        return f.read()
+
+
+@pytest.fixture
+def database():
+    """Migrated scratch database, emptied again after the test."""
+    import db
+    db.migrate()
+    yield db
+    tables = [r["name"] for r in db.query(
+        "SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%'")]
+    with db.transaction() as conn:
+        for table in tables:
+            if table != "cache_generations":
+                conn.execute(f"DELETE FROM {table}")
@@ -0,0 +1,73 @@
+import os
+import subprocess
+import sys
+import time
+import ansible_engine
+
+
+def _child(code):
+    return subprocess.Popen([sys.executable, "-c", code], stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE, start_new_session=True)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+
+
+def test_pump_drains_stderr_while_stdout_is_quiet():
+    # 1 MiB on stderr is far more than a pipe buffer; a reader blocked on
+    # stdout would leave the child stuck in write()
+    process = _child("import sys\n"
+                     "for i in range(16384):\n"
+                     "    sys.stderr.write('x' * 63 + '\\n')\n"
+                     "sys.stderr.flush()\n"
+                     "print('done')\n")
+    stdout, stderr = [], []
+    started = time.monotonic()
+    try:
+        assert not ansible_engine.pump_process(process, stdout.append, stderr.append, timeout=30)
+    finally:
+        process.kill()
+    assert process.wait(5) == 0
+    assert time.monotonic() - started < 30
+    assert stdout == ["done"]
+    assert len(stderr) == 16384 and stderr[0] == "x" * 63
+
+
+def test_pump_flushes_partial_last_line():
+    process = _child("import sys; sys.stdout.write('no newline')")
+    stdout = []
+    ansible_engine.pump_process(process, stdout.append, lambda line: None, timeout=30)
+    process.wait(5)
+    assert stdout == ["no newline"]
+
+
+def test_run_playbook_kills_process_group_after_timeout(tmp_path, monkeypatch):
+    fake = tmp_path / "ansible-playbook"
+    fake.write_text(f"#!{sys.executable}\n"
+                    "import subprocess, time\n"
+                    "child = subprocess.Popen(['sleep', '60'])\n"
+                    "print(child.pid, flush=True)\n"
+                    "time.sleep(60)\n")
+    fake.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{tmp_path}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setattr(ansible_engine, "ansible_runner", None)
+    pids = []
+
+    started = time.monotonic()
+    run = ansible_engine.run_playbook("vm_creation.yml", {"hv1": {}}, output_keys=("timeout-test",),
+                                      timeout=1, on_start=pids.append)
+    assert time.monotonic() - started < 10
+    assert run.timed_out
+    assert run.rc != 0
+    assert not _alive(pids[0])
+    grandchild = int(ansible_engine.get_output("timeout-test")[0])
+    deadline = time.monotonic() + 5
+    while _alive(grandchild) and time.monotonic() < deadline:
+        time.sleep(0.1)
+    assert not _alive(grandchild)
+    assert ansible_engine.get_output("timeout-test")[-1] == "[killed after 1s]"
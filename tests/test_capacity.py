@@ -0,0 +1,82 @@
+import pytest
+
+import capacity
+
+
+@pytest.fixture
+def hv(database):
+    capacity.invalidate()
+    hv_id = database.execute(
+        "INSERT INTO hypervisors (name, ip, username, password) VALUES ('hv1', '10.0.0.1', 'root', 'x')"
+    ).lastrowid
+    database.execute("""INSERT INTO hv_status (hv_id, total_cpu, total_mem, total_disk, used_cpu, used_mem, used_disk)
+                        VALUES (?, 32, 256, 20000, 8, 64, 5000)""", (hv_id,))
+    return hv_id
+
+
+def _add_vm(database, hv_id, name, status, cpu=2, memory_mb=4096, disk=50):
+    database.execute("INSERT INTO vms (name, status, hv_id, cpu, memory, disk) VALUES (?, ?, ?, ?, ?, ?)",
+                     (name, status, hv_id, cpu, memory_mb, disk))
+
+
+def test_pending_memory_is_converted_to_gb(database, hv):
+    _add_vm(database, hv, "vm1", "In-progress", memory_mb=6144)
+    _add_vm(database, hv, "vm2", "running", memory_mb=8192)
+    host = capacity.load_capacity()[hv]
+    assert (host["pending_cpu"], host["pending_mem"]) == (2, 6)
+    assert (host["remaining_cpu"], host["remaining_mem"]) == (22, 186)
+    assert (host["total_disk"], host["remaining_disk"]) == (20000, 15000)
+
+
+def test_used_disk_falls_back_to_provisioned_disk(database, hv):
+    database.execute("UPDATE hv_status SET used_disk = NULL")
+    _add_vm(database, hv, "vm1", "running", disk=300)
+    _add_vm(database, hv, "vm2", "In-progress", disk=200)
+    host = capacity.load_capacity()[hv]
+    assert (host["used_disk"], host["remaining_disk"]) == (500, 19500)
+
+
+def test_hypervisor_without_inventory_reports_zeros(database):
+    hv_id = database.execute(
+        "INSERT INTO hypervisors (name, ip, username, password) VALUES ('new', '10.0.0.2', 'root', 'x')"
+    ).lastrowid
+    host = capacity.load_capacity()[hv_id]
+    assert (host["total_cpu"], host["used_disk"], host["remaining_mem"], host["vm_count"]) == (0, 0, 0, 0)
+
+
+def test_totals_sums_every_host():
+    hosts = [
+        dict.fromkeys(("total_cpu", "used_cpu", "pending_cpu", "remaining_cpu"), 1)
+        | dict.fromkeys(("total_mem", "used_mem", "pending_mem", "remaining_mem"), 2.5)
+        | dict.fromkeys(("total_disk", "used_disk", "remaining_disk"), 100),
+    ] * 3
+    total = capacity.totals(hosts)
+    assert (total["total_cpu"], total["pending_mem"], total["remaining_disk"]) == (3, 7.5, 300)
+
+
+def test_snapshot_is_served_until_ttl_expires(database, hv, monkeypatch):
+    monkeypatch.setattr(capacity, "CAPACITY_TTL", 3600)
+    first = capacity.get_capacity()
+    database.execute("UPDATE hv_status SET used_cpu = 30")
+    assert capacity.get_capacity() is first
+
+    monkeypatch.setattr(capacity, "CAPACITY_TTL", 0)
+    assert capacity.get_capacity()[hv]["used_cpu"] == 30
+
+
+def test_generation_bump_from_another_process_rebuilds(database, hv, monkeypatch):
+    monkeypatch.setattr(capacity, "CAPACITY_TTL", 3600)
+    first = capacity.get_capacity()
+    database.execute("UPDATE hv_status SET used_cpu = 30")
+    # invalidate() in another process only bumps the stored generation
+    database.execute("UPDATE cache_generations SET generation = generation + 1 WHERE name='capacity'")
+    rebuilt = capacity.get_capacity()
+    assert rebuilt is not first
+    assert rebuilt[hv]["used_cpu"] == 30
+
+
+def test_invalidate_drops_the_local_snapshot(database, hv, monkeypatch):
+    monkeypatch.setattr(capacity, "CAPACITY_TTL", 3600)
+    capacity.get_capacity()
+    capacity.invalidate()
+    assert capacity.snapshot_age() is None
@@ -0,0 +1,135 @@
+import os
+import jinja2
+import pytest
+import yaml
+import checkpoints
+import deploy_vm_handler2
+
+HV_ID = 1
+
+
+def _vm(name="vm1", **spec):
+    vm = {"name": name, "qcow2_image": "/home/qcow2images/default.qcow2", "disk": 20, "flatten": False,
+          "vg_name": "vg1", "required_partitions": [], "ipaddr": "10.20.0.5", "prefix": "24",
+          "gateway": "10.20.0.1", "cpu": 2, "ram": 2048, "vm_type": "other"}
+    vm.update(spec)
+    return vm
+
+
+def _record(vm, *stages, hv_id=HV_ID):
+    for stage in stages:
+        checkpoints.record(hv_id, vm["name"], stage, checkpoints.spec_hash(vm), job_id=7)
+
+
+class _Run:
+    def __init__(self, ok):
+        self.ok = ok
+
+    def host_ok(self, host):
+        return self.ok
+
+
+def _fake_playbook(monkeypatch, stages, ok):
+    """Replace the playbook by one reporting ``stages[vm_name]`` for each VM."""
+    seen = []
+
+    def run_playbook(playbook, hosts, extravars, event_handler=None, **kwargs):
+        for host in hosts.values():
+            for vm in host["vms"]:
+                seen.append((vm["name"], list(vm["done_stages"])))
+                for stage in stages.get(vm["name"], ()):
+                    event_handler({"event": "ok", "host": "10.0.0.1",
+                                   "task": f"vm_deploy : {vm['name']} | Checkpoint {stage}"})
+        return _Run(ok)
+
+    monkeypatch.setattr(deploy_vm_handler2.ansible_engine, "run_playbook", run_playbook)
+    return seen
+
+
+def _target(*vms):
+    return {"hv_id": HV_ID, "hv_ip": "10.0.0.1", "hv_user": "root", "job_id": 7, "vms": list(vms)}
+
+
+def test_spec_hash_follows_spec_fields_only():
+    vm = _vm()
+    assert checkpoints.spec_hash(vm) == checkpoints.spec_hash(_vm(done_stages=["image_staged"]))
+    assert checkpoints.spec_hash(vm) == checkpoints.spec_hash(dict(vm, name="other"))
+    for field, value in (("disk", 40), ("ram", 4096), ("ipaddr", "10.20.0.6"), ("flatten", True),
+                         ("required_partitions", [{"lv": "data", "mount": "/data", "size_mb": 1024}])):
+        assert checkpoints.spec_hash(vm) != checkpoints.spec_hash(dict(vm, **{field: value})), field
+
+
+def test_attach_skips_stages_recorded_for_the_same_spec(database):
+    vm, fresh = _vm("vm1"), _vm("vm2")
+    # Recorded out of order, reported in playbook order
+    _record(vm, "lvs_laid_out", "image_staged", "disk_resized")
+    checkpoints.attach(HV_ID, [vm, fresh])
+    assert vm["done_stages"] == ["image_staged", "disk_resized", "lvs_laid_out"]
+    assert vm["spec_hash"] == checkpoints.spec_hash(vm)
+    assert fresh["done_stages"] == []
+
+
+def test_spec_change_invalidates_checkpoints(database):
+    _record(_vm(), "image_staged", "disk_resized", "lvs_laid_out")
+    resized = checkpoints.attach(HV_ID, [_vm(disk=40)])[0]
+    assert resized["done_stages"] == []
+    # Stages recorded again for the new spec count from then on
+    _record(resized, "image_staged")
+    assert checkpoints.attach(HV_ID, [_vm(disk=40)])[0]["done_stages"] == ["image_staged"]
+
+
+def test_checkpoints_are_per_hypervisor(database):
+    _record(_vm(), "image_staged", hv_id=2)
+    assert checkpoints.attach(HV_ID, [_vm()])[0]["done_stages"] == []
+    assert checkpoints.completed_stages(2, ["vm1", "vm9"]) == {"vm1": {"image_staged": checkpoints.spec_hash(_vm())}}
+    assert checkpoints.completed_stages(2, []) == {}
+
+
+def test_clear_forgets_only_the_given_vms(database):
+    _record(_vm("vm1"), "image_staged")
+    _record(_vm("vm2"), "image_staged")
+    with database.transaction() as conn:
+        checkpoints.clear(conn, HV_ID, ["vm1"])
+    assert list(checkpoints.completed_stages(HV_ID, ["vm1", "vm2"])) == ["vm2"]
+
+
+def test_retry_resumes_after_the_last_checkpoint(database, monkeypatch):
+    _fake_playbook(monkeypatch, {"vm1": checkpoints.DEPLOY_STAGES[:3]}, ok=False)
+    assert deploy_vm_handler2.run_ansible_playbook([_target(_vm())], "run-1") == {HV_ID: False}
+
+    seen = _fake_playbook(monkeypatch, {"vm1": checkpoints.DEPLOY_STAGES[3:]}, ok=True)
+    assert deploy_vm_handler2.run_ansible_playbook([_target(_vm())], "run-2") == {HV_ID: True}
+    assert seen == [("vm1", list(checkpoints.DEPLOY_STAGES[:3]))]
+    # A deployed VM starts from scratch the next time
+    assert checkpoints.completed_stages(HV_ID, ["vm1"]) == {}
+
+
+def test_vm_past_last_checkpoint_counts_as_deployed(database, monkeypatch):
+    _record(_vm("vm1"), *checkpoints.DEPLOY_STAGES[:-1])
+    # vm1 finishes its last stage, vm2 fails before its first one
+    _fake_playbook(monkeypatch, {"vm1": checkpoints.DEPLOY_STAGES[-1:]}, ok=False)
+    database.execute("INSERT INTO vms (name, hv_id, status) VALUES ('vm1', ?, 'In-progress')", (HV_ID,))
+    database.execute("INSERT INTO vms (name, hv_id, status) VALUES ('vm2', ?, 'In-progress')", (HV_ID,))
+    deploy_vm_handler2.run_ansible_playbook([_target(_vm("vm1"), _vm("vm2"))], "run-1")
+    statuses = {r["name"]: r["status"] for r in database.query("SELECT name, status FROM vms")}
+    assert statuses == {"vm1": "Completed", "vm2": "Failed"}
+
+
+def _remove_domain_condition():
+    path = os.path.join(deploy_vm_handler2.ansible_engine.PLAYBOOK_DIR, "roles", "vm_deploy", "tasks",
+                        "vm_creation.yml")
+    with open(path) as f:
+        tasks = yaml.safe_load(f)[0]["block"]
+    task = next(t for t in tasks if t["name"].endswith("| Remove half-defined domain"))
+    return jinja2.Environment().compile_expression(task["when"])
+
+
+@pytest.mark.parametrize("done_stages, removed", [
+    ([], False),  # first attempt, an existing domain is not ours
+    (["image_staged", "disk_resized"], False),
+    (["image_staged", "disk_resized", "lvs_laid_out", "guest_configured"], True),
+    (list(checkpoints.DEPLOY_STAGES[:5]), False),  # domain already defined by this VM
+])
+def test_half_defined_domain_is_only_removed_on_retry(done_stages, removed):
+    condition = _remove_domain_condition()
+    assert bool(condition(vm={"name": "vm1", "done_stages": done_stages}, vm_done=done_stages)) is removed
@@ -0,0 +1,47 @@
+import pytest
+import delete_vm
+
+
+class _Run:
+    rc = 0
+    timed_out = False
+
+    def host_ok(self, host):
+        return True
+
+
+def _queue_delete(database):
+    hv_id = database.execute(
+        "INSERT INTO hypervisors (name, ip, username, password) VALUES ('hv1', '10.0.0.1', 'root', 'x')"
+    ).lastrowid
+    database.execute("INSERT INTO vms (name, status, hv_id) VALUES ('vm1', 'Deleting', ?)", (hv_id,))
+    return {"id": 1, "payload": {"hv_id": hv_id, "hv_ip": "10.0.0.1", "hv_user": "root", "vm_names": ["vm1"]}}
+
+
+def test_delete_job_fails_when_rows_cannot_be_removed(database, monkeypatch):
+    job = _queue_delete(database)
+    monkeypatch.setattr(delete_vm.ansible_engine, "run_playbook", lambda *a, **kw: _Run())
+
+    def broken(conn, hv_id, names):
+        raise RuntimeError("disk I/O error")
+
+    monkeypatch.setattr(delete_vm.ipam, "release_vms", broken)
+    errors = delete_vm.delete_vms_batch([job])
+    assert "not removed from the DB: disk I/O error" in errors[1]
+    assert database.query_one("SELECT status FROM vms WHERE name='vm1'")["status"] == "Delete failed"
+
+
+def test_delete_job_removes_rows(database, monkeypatch):
+    job = _queue_delete(database)
+    monkeypatch.setattr(delete_vm.ansible_engine, "run_playbook", lambda *a, **kw: _Run())
+    assert delete_vm.delete_vms_batch([job]) == {}
+    assert database.query("SELECT name FROM vms") == []
+
+
+def test_remove_vm_from_db_raises(database, monkeypatch):
+    def locked(*args):
+        raise RuntimeError("database is locked")
+
+    monkeypatch.setattr(delete_vm.checkpoints, "clear", locked)
+    with pytest.raises(RuntimeError):
+        delete_vm.remove_vm_from_db(1, ["vm1"])
@@ -0,0 +1,23 @@
+import deploy_events
+
+
+def test_stream_ends_after_max_seconds(database):
+    chunks = list(deploy_events.stream_events(poll_interval=0.01, max_seconds=0.05))
+    assert chunks[0] == f"retry: {deploy_events.SSE_RETRY_MS}\n\n"
+    assert all(chunk.startswith(("retry:", ":", "id:")) for chunk in chunks)
+
+
+def test_open_stream_limit_and_release(database):
+    streams = [deploy_events.open_stream() for _ in range(deploy_events.SSE_MAX_STREAMS)]
+    assert None not in streams
+    assert deploy_events.open_stream() is None
+    # Closing releases the slot, also for a stream that was never iterated
+    streams.pop().close()
+    again = deploy_events.open_stream()
+    assert again is not None
+    assert next(again).startswith("retry:")
+    for stream in streams + [again]:
+        stream.close()
+    last = deploy_events.open_stream()
+    assert last is not None
+    last.close()
@@ -0,0 +1,79 @@
+import time
+import threading
+import hv_inventory
+import job_queue
+from deploy_vm_handler2 import retry_failed
+
+
+def _domain(name, state="running"):
+    return {"name": name, "cpu": 2, "memory": 4, "disk": 20, "state": state,
+            "active": state == "running", "disks": [], "addresses": []}
+
+
+def test_diff_vms_keeps_deploy_and_delete_outcomes():
+    rows = [("failed", 2, 4, 20, "Failed"), ("building", 2, 4, 20, "In-progress"),
+            ("deleting", 2, 4, 20, "Deleting"), ("stuck", 2, 4, 20, "Delete failed"),
+            ("done", 2, 4, 20, "Completed")]
+    domains = [_domain(name) for name, *_ in rows]
+    inserts, updates, deletes = hv_inventory.diff_vms(rows, domains)
+    assert (inserts, deletes) == ([], [])
+    assert updates == [("done", 2, 4, 20, "running")]
+
+
+def test_diff_vms_updates_and_removes():
+    rows = [("vm1", 2, 4, 20, "running"), ("gone", 2, 4, 20, "running"), ("failed", 2, 4, 20, "Failed")]
+    inserts, updates, deletes = hv_inventory.diff_vms(
+        rows, [_domain("vm1", "shut off"), _domain("new")])
+    assert inserts == [("new", 2, 4, 20, "running")]
+    assert updates == [("vm1", 2, 4, 20, "shut off")]
+    assert deletes == ["gone"]
+
+
+def test_failed_vm_can_be_retried_after_inventory_poll(database):
+    hv_id = database.execute(
+        "INSERT INTO hypervisors (name, ip, username, password) VALUES ('hv1', '10.0.0.1', 'root', 'x')"
+    ).lastrowid
+    database.execute("INSERT INTO vms (name, cpu, memory, disk, status, hv_id) VALUES ('vm1', 2, 4, 20, 'Failed', ?)",
+                     (hv_id,))
+    job_id = job_queue.enqueue("deploy", {"hv_id": hv_id, "hv_ip": "10.0.0.1", "vms": [{"name": "vm1"}]},
+                               hv_id=hv_id)
+    assert [job["id"] for job in job_queue.claim_jobs()] == [job_id]
+    job_queue.finish_job(job_id, "failed", "autostart failed")
+
+    # The domain was defined before the deploy failed
+    inventory = {"node": {"cpu": 64, "memory": 256}, "domains": [_domain("vm1")], "pools": []}
+    hv_inventory.apply_hv_inventory(hv_id, "10.0.0.1", "root", "x", inventory)
+    assert database.query_one("SELECT status FROM vms WHERE name='vm1'")["status"] == "Failed"
+
+    new_id = retry_failed(job_id)
+    assert new_id is not None
+    assert database.query_one("SELECT status FROM vms WHERE name='vm1'")["status"] == "In-progress"
+
+
+def test_collect_fleet_abandons_hosts_past_their_deadline(monkeypatch):
+    release = threading.Event()
+
+    def collect(ip, user, password, timeout):
+        if ip == "10.0.0.2":
+            release.wait(10)  # trickles output, the channel timeout never fires
+        if ip == "10.0.0.3":
+            raise OSError("Connection refused")
+        return {"ip": ip}
+
+    monkeypatch.setattr(hv_inventory, "collect_hv_inventory", collect)
+    hvs = [(1, "hv1", "10.0.0.1", "root", "x"), (2, "hv2", "10.0.0.2", "root", "x"),
+           (3, "hv3", "10.0.0.3", "root", "x")]
+    started = time.monotonic()
+    results = hv_inventory.collect_fleet(hvs, host_timeout=0.3, global_timeout=5)
+    assert time.monotonic() - started < 2
+    assert results == {1: ({"ip": "10.0.0.1"}, None), 2: (None, "timed out after 0.3s"),
+                       3: (None, "Connection refused")}
+
+    # The abandoned host is not collected twice at once
+    results = hv_inventory.collect_fleet(hvs, host_timeout=0.3, global_timeout=5)
+    assert results[2] == (None, "previous collection still running")
+    release.set()
+    deadline = time.monotonic() + 5
+    while 2 in hv_inventory._inflight and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert hv_inventory.collect_fleet(hvs, host_timeout=0.3, global_timeout=5)[2] == ({"ip": "10.0.0.2"}, None)
@@ -0,0 +1,77 @@
+import pytest
+import hv_onboarding
+
+HV1 = {"name": "hv1", "ip": "10.0.0.1", "username": "root", "password": "secret"}
+HV2 = {"name": "hv2", "ip": "10.0.0.2", "username": "admin", "password": "pw"}
+
+
+def test_parse_csv_with_aliases_and_blank_lines():
+    data = ("﻿Hostname,IP Address,User,Password\n"
+            "hv1, 10.0.0.1 ,root,secret\n"
+            ",,,\n"
+            "hv2,10.0.0.2,admin,pw\n").encode()
+    assert hv_onboarding.parse_hv_file("hosts.CSV", data) == [HV1, HV2]
+
+
+def test_parse_yaml_list():
+    data = b"- {name: hv1, ip: 10.0.0.1, username: root, password: secret}\n" \
+           b"- {hv_name: hv2, host: 10.0.0.2, user: admin, password: pw}\n"
+    assert hv_onboarding.parse_hv_file("hosts.yml", data) == [HV1, HV2]
+
+
+def test_parse_yaml_mapping_keeps_values_as_text():
+    data = b"hypervisors:\n  - name: hv1\n    ip: 10.0.0.1\n    username: root\n    password: 1234\n"
+    assert hv_onboarding.parse_hv_file("hosts.yaml", data) == [dict(HV1, password="1234")]
+
+
+@pytest.mark.parametrize("filename, data", [
+    ("hosts.csv", b"name,ip,username\nhv1,10.0.0.1,root\n"),
+    ("hosts.yml", b"- {name: hv1, ip: 10.0.0.1, username: root}\n"),
+])
+def test_parse_rejects_missing_columns(filename, data):
+    with pytest.raises(ValueError, match="Missing column\\(s\\): password"):
+        hv_onboarding.parse_hv_file(filename, data)
+
+
+@pytest.mark.parametrize("data", [b"hypervisors: 3\n", b"- just a name\n", b"[unclosed\n"])
+def test_parse_rejects_malformed_yaml(data):
+    with pytest.raises(ValueError):
+        hv_onboarding.parse_hv_file("hosts.yml", data)
+
+
+def test_parse_keeps_rows_with_empty_fields():
+    data = b"name,ip,username,password\nhv1,10.0.0.1,,secret\n"
+    assert hv_onboarding.parse_hv_file("hosts.csv", data) == [dict(HV1, username="")]
+
+
+def test_validate_many_rejects_incomplete_duplicate_and_known_rows(database, monkeypatch):
+    database.execute("INSERT INTO hypervisors (name, ip, username, password) VALUES ('old', '10.0.0.9', 'r', 'x')")
+    checked = []
+
+    def validate_hv(hv):
+        checked.append(hv["ip"])
+        return {"ok": True}
+
+    monkeypatch.setattr(hv_onboarding, "validate_hv", validate_hv)
+    hvs = [HV1, dict(HV2, username=""), dict(HV1, name="again"), dict(HV2, name="known", ip="10.0.0.9")]
+    results = [(hv["name"], result) for hv, result in hv_onboarding.validate_many(hvs)]
+    rejected = {name: r["checks"]["input"]["detail"] for name, r in results if not r["ok"]}
+    assert rejected == {"hv2": "missing username", "again": "listed more than once",
+                        "known": "hypervisor already added"}
+    assert checked == ["10.0.0.1"]
+
+
+def test_insert_hypervisors_skips_known_ips(database):
+    assert len(hv_onboarding.insert_hypervisors([HV1])) == 1
+    assert hv_onboarding.insert_hypervisors([HV1]) == []
+    assert [hv["ip"] for hv in database.query("SELECT ip FROM hypervisors")] == ["10.0.0.1"]
+
+
+def test_add_hv_rejects_known_hypervisor(database, monkeypatch):
+    import app
+    monkeypatch.setattr(hv_onboarding, "validate_hv", lambda hv: {"ok": True, "checks": {}})
+    client = app.app.test_client()
+    assert client.post("/add_hv", data=HV1).status_code == 302
+    response = client.post("/add_hv", data=HV1)
+    assert response.status_code == 400
+    assert b"already added" in response.data
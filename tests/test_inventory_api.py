@@ -0,0 +1,43 @@
+import base64
+import json
+import pytest
+from werkzeug.datastructures import MultiDict
+import inventory_api
+from inventory_api import QueryError, encode_cursor, decode_cursor
+
+
+def _raw_cursor(items):
+    return base64.urlsafe_b64encode(json.dumps(items).encode()).decode().rstrip("=")
+
+
+@pytest.mark.parametrize("value", ["web-01", 7, 2.5, None])
+def test_cursor_round_trip(value):
+    assert decode_cursor(encode_cursor("name", "asc", value, 42), "name", "asc") == (value, 42)
+
+
+@pytest.mark.parametrize("items", [
+    ["name", "asc", {"a": 1}, 42],
+    ["name", "asc", [1, 2], 42],
+    ["name", "asc", "web-01", "42"],
+    ["name", "asc", "web-01", None],
+    ["name", "asc", "web-01", [42]],
+    ["name", "asc", True, 42],
+    ["name", "asc", "web-01"],
+    {"sort": "name"},
+])
+def test_decode_cursor_rejects_malformed_values(items):
+    with pytest.raises(QueryError):
+        decode_cursor(_raw_cursor(items), "name", "asc")
+
+
+def test_decode_cursor_rejects_garbage_and_other_sort():
+    with pytest.raises(QueryError):
+        decode_cursor("not a cursor!", "name", "asc")
+    with pytest.raises(QueryError):
+        decode_cursor(encode_cursor("id", "asc", 1, 1), "name", "asc")
+
+
+def test_list_vms_with_crafted_cursor_is_a_query_error(database):
+    args = MultiDict({"sort": "name", "cursor": _raw_cursor(["name", "asc", {"x": 1}, 1])})
+    with pytest.raises(QueryError):
+        inventory_api.list_vms(args)
@@ -0,0 +1,32 @@
+import ipam
+
+
+def _setup(database, status):
+    subnet_id = ipam.add_subnet("10.20.0.0/24")
+    hv_id = database.execute(
+        "INSERT INTO hypervisors (name, ip, username, password) VALUES ('hv1', '10.0.0.1', 'root', 'x')"
+    ).lastrowid
+    database.execute("INSERT INTO vms (name, status, ip_addr, hv_id) VALUES ('vm1', ?, '10.20.0.5', ?)",
+                     (status, hv_id))
+    database.execute("""INSERT INTO ip_allocations (ip, subnet_id, vm_name, hv_id, source, allocated_at)
+                        VALUES ('10.20.0.5', ?, 'vm1', ?, 'ipam', '')""", (subnet_id, hv_id))
+    return hv_id
+
+
+def _allocations(database):
+    return database.query("SELECT ip, vm_name, source FROM ip_allocations ORDER BY ip")
+
+
+def test_record_addresses_replaces_the_old_allocation(database):
+    hv_id = _setup(database, "running")
+    with database.transaction() as conn:
+        assert ipam.record_addresses(conn, hv_id, [{"name": "vm1", "addresses": ["10.20.0.9"]}]) == 1
+    assert _allocations(database) == [{"ip": "10.20.0.9", "vm_name": "vm1", "source": "harvest"}]
+    assert database.query_one("SELECT ip_addr FROM vms")["ip_addr"] == "10.20.0.9"
+
+
+def test_record_addresses_keeps_allocation_while_deploying(database):
+    hv_id = _setup(database, "In-progress")
+    with database.transaction() as conn:
+        ipam.record_addresses(conn, hv_id, [{"name": "vm1", "addresses": ["192.168.122.40"]}])
+    assert _allocations(database) == [{"ip": "10.20.0.5", "vm_name": "vm1", "source": "ipam"}]
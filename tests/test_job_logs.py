@@ -0,0 +1,85 @@
+import logging
+import os
+import pytest
+import job_logs
+import job_queue
+
+
+@pytest.fixture
+def handler(tmp_path, monkeypatch):
+    monkeypatch.setattr(job_logs, "LOG_DIR", str(tmp_path))
+    monkeypatch.setattr(job_logs, "JOB_LOG_DIR", str(tmp_path / "jobs"))
+    handler = job_logs.JobFileHandler()
+    handler.setFormatter(job_logs.JsonFormatter())
+    handler.addFilter(job_logs.ContextFilter())
+    logger = logging.getLogger("test_job_logs")
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    logger.addHandler(handler)
+    yield handler
+    logger.removeHandler(handler)
+    handler.close()
+
+
+def _log(msg, **extra):
+    logging.getLogger("test_job_logs").info(msg, extra=extra)
+
+
+def test_job_log_path():
+    assert job_logs.job_log_path(7) == os.path.join("jobs", "7", "job.jsonl")
+    assert job_logs.job_log_path(7, "web-01") == os.path.join("jobs", "7", "web-01.jsonl")
+    assert job_logs.job_log_path(7, "../etc/x y") == os.path.join("jobs", "7", ".._etc_x_y.jsonl")
+
+
+def test_claim_indexes_the_logs_of_payload_vms(database):
+    job_id = job_queue.enqueue("deploy", {"vms": [{"name": "vm1"}, {"name": "vm2"}]}, hv_id=3)
+    job_queue.claim_jobs()
+    rows = database.query("SELECT vm_name, hv_id, path FROM job_logs WHERE job_id=? ORDER BY vm_name", (job_id,))
+    assert rows == [
+        {"vm_name": "", "hv_id": 3, "path": job_logs.job_log_path(job_id)},
+        {"vm_name": "vm1", "hv_id": 3, "path": job_logs.job_log_path(job_id, "vm1")},
+        {"vm_name": "vm2", "hv_id": 3, "path": job_logs.job_log_path(job_id, "vm2")},
+    ]
+
+
+def test_vm_log_returns_latest_job_of_the_vm(database, handler):
+    first = job_queue.enqueue("delete", {"vm_names": ["vm1"]}, hv_id=1)
+    job_queue.claim_jobs()
+    _log("first try", job_id=first, hv_id=1, vm_name="vm1")
+    handler.close_job(first)
+    job_queue.finish_job(first, "failed", "boom")
+    second = job_queue.enqueue("delete", {"vm_names": ["vm1"]}, hv_id=1)
+    job_queue.claim_jobs()
+    _log("second try", job_id=second, hv_id=1, vm_name="vm1")
+    handler.close_job(second)
+
+    job_id, records = job_logs.vm_log("vm1")
+    assert job_id == second
+    assert [r["msg"] for r in records] == ["second try"]
+    assert job_logs.vm_log("vm1", hv_id=2) == (None, [])
+    assert job_logs.vm_log("missing") == (None, [])
+
+
+def test_rolled_back_transaction_keeps_the_index_row(database, handler):
+    with pytest.raises(RuntimeError):
+        with database.transaction() as conn:
+            conn.execute("INSERT INTO hypervisors (name, ip, username, password) VALUES ('hv', '10.0.0.9', 'r', 'x')")
+            _log("inside", job_id=41, hv_id=1, vm_name="unplanned")
+            raise RuntimeError("rollback")
+    handler.close_job(41)
+    assert database.query("SELECT name FROM hypervisors") == []
+    job_id, records = job_logs.vm_log("unplanned")
+    assert job_id == 41
+    assert [r["msg"] for r in records] == ["inside"]
+
+
+def test_open_files_are_capped(database, handler, monkeypatch):
+    monkeypatch.setattr(job_logs, "LOG_MAX_OPEN_FILES", 2)
+    for name in ("vm1", "vm2", "vm3", "vm1"):
+        _log(f"to {name}", job_id=50, hv_id=1, vm_name=name)
+    # job.jsonl was used last together with vm1
+    assert list(handler._files) == [(50, None), (50, "vm1")]
+    handler.close_job(50)
+    assert handler._files == {}
+    assert [r["msg"] for r in job_logs.vm_log("vm1")[1]] == ["to vm1", "to vm1"]
+    assert len(job_logs.job_log(50)) == 4
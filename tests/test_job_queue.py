@@ -0,0 +1,195 @@
+import os
+import subprocess
+import threading
+import time
+import job_queue
+
+
+def _detached(command):
+    """Start ``command`` in its own session, not as a child of the test."""
+    out = subprocess.run(["bash", "-c", f"setsid {command} >/dev/null 2>&1 & echo $!"],
+                         capture_output=True, text=True, check=True)
+    return int(out.stdout)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+
+
+def _wait_gone(pid, timeout=5):
+    deadline = time.monotonic() + timeout
+    while _alive(pid) and time.monotonic() < deadline:
+        time.sleep(0.1)
+    return not _alive(pid)
+
+
+def test_recover_orphaned_jobs_stops_playbook_before_requeue(database, tmp_path):
+    script = tmp_path / "ansible-playbook"
+    script.write_text("import time\ntime.sleep(60)\n")
+    pid = _detached(f"python3 {script}")
+    time.sleep(0.3)
+    job_id = job_queue.enqueue("deploy", {"vms": []})
+    assert [job["id"] for job in job_queue.claim_jobs()] == [job_id]
+    job_queue.record_pid([job_id], pid)
+
+    assert job_queue.recover_orphaned_jobs() == 1
+    assert _wait_gone(pid)
+    job = database.query_one("SELECT state, pid FROM jobs WHERE id=?", (job_id,))
+    assert job == {"state": "queued", "pid": None}
+
+
+def test_recover_orphaned_jobs_leaves_reused_pid_alone(database):
+    pid = _detached("sleep 30")
+    job_id = job_queue.enqueue("deploy", {"vms": []})
+    job_queue.claim_jobs()
+    job_queue.record_pid([job_id], pid)
+    try:
+        assert job_queue.recover_orphaned_jobs() == 1
+        assert _alive(pid)
+    finally:
+        os.kill(pid, 9)
+
+
+def _states(database):
+    return {row["id"]: row["state"] for row in database.query("SELECT id, state FROM jobs")}
+
+
+def _claim_ids():
+    return [job["id"] for job in job_queue.claim_jobs()]
+
+
+def test_failed_job_cancels_dependents_transitively(database, monkeypatch):
+    cancelled = []
+    monkeypatch.setattr(job_queue, "_cancel_handlers", {"test": lambda job: cancelled.append(job["id"])})
+    first = job_queue.enqueue("test", {})
+    second = job_queue.enqueue("test", {}, depends_on=[first])
+    third = job_queue.enqueue("test", {}, depends_on=[second])
+    other = job_queue.enqueue("test", {})
+
+    assert _claim_ids() == [first]
+    job_queue.finish_job(first, "failed", "boom")
+    assert _states(database) == {first: "failed", second: "cancelled", third: "cancelled", other: "queued"}
+    assert sorted(cancelled) == [second, third]
+    error = database.query_one("SELECT error FROM jobs WHERE id=?", (third,))["error"]
+    assert error == f"dependency job {first} did not succeed"
+
+
+def test_cancel_cancels_dependents_transitively(database):
+    first = job_queue.enqueue("test", {})
+    second = job_queue.enqueue("test", {}, depends_on=[first])
+    third = job_queue.enqueue("test", {}, depends_on=[second])
+    assert job_queue.cancel(first)
+    assert _states(database) == {first: "cancelled", second: "cancelled", third: "cancelled"}
+
+
+def test_job_waits_until_every_dependency_succeeded(database):
+    first = job_queue.enqueue("test", {})
+    second = job_queue.enqueue("test", {})
+    joined = job_queue.enqueue("test", {}, depends_on=[first, second])
+
+    assert _claim_ids() == [first]
+    assert _claim_ids() == [second]
+    assert _claim_ids() == []
+    job_queue.finish_job(first, "succeeded")
+    assert _claim_ids() == []
+    job_queue.finish_job(second, "succeeded")
+    assert _claim_ids() == [joined]
+
+
+def test_claim_respects_per_hypervisor_limit(database, monkeypatch):
+    monkeypatch.setattr(job_queue, "JOB_MAX_PER_HV", 1)
+    first = job_queue.enqueue("test", {}, hv_id=1)
+    job_queue.enqueue("test", {}, hv_id=1)
+    other_hv = job_queue.enqueue("test", {}, hv_id=2)
+
+    assert _claim_ids() == [first]
+    assert _claim_ids() == [other_hv]
+    assert _claim_ids() == []
+
+
+def test_claim_respects_global_limit(database, monkeypatch):
+    monkeypatch.setattr(job_queue, "JOB_MAX_RUNNING", 2)
+    monkeypatch.setattr(job_queue, "_batched_kinds", {"test"})
+    ids = [job_queue.enqueue("test", {}, hv_id=hv_id, batch="b1") for hv_id in (1, 2, 3)]
+
+    assert _claim_ids() == ids[:2]
+    assert _claim_ids() == []
+    job_queue.finish_job(ids[0], "succeeded")
+    assert _claim_ids() == ids[2:]
+
+
+def test_job_runs_from_queued_to_succeeded(database, monkeypatch):
+    payloads = []
+    monkeypatch.setattr(job_queue, "_handlers", {"test": payloads.append})
+    job_id = job_queue.enqueue("test", {"vm": "vm1"})
+    assert _states(database) == {job_id: "queued"}
+
+    jobs = job_queue.claim_jobs()
+    assert _states(database) == {job_id: "running"}
+    job_queue.run_jobs(jobs)
+    job = database.query_one("SELECT state, attempts, error, started_at, finished_at FROM jobs")
+    assert (job["state"], job["attempts"], job["error"]) == ("succeeded", 1, None)
+    assert job["started_at"] and job["finished_at"]
+    assert payloads == [{"vm": "vm1"}]
+
+
+def test_job_fails_when_handler_raises(database, monkeypatch):
+    def handler(payload):
+        raise RuntimeError("host unreachable")
+
+    monkeypatch.setattr(job_queue, "_handlers", {"test": handler})
+    job_queue.enqueue("test", {})
+    job_queue.run_jobs(job_queue.claim_jobs())
+    job = database.query_one("SELECT state, error FROM jobs")
+    assert job == {"state": "failed", "error": "host unreachable"}
+
+
+def test_job_without_handler_fails(database, monkeypatch):
+    monkeypatch.setattr(job_queue, "_handlers", {})
+    job_queue.enqueue("unknown", {})
+    job_queue.run_jobs(job_queue.claim_jobs())
+    assert database.query_one("SELECT state FROM jobs")["state"] == "failed"
+
+
+def test_finished_job_is_not_finished_again(database):
+    job_id = job_queue.enqueue("test", {})
+    job_queue.claim_jobs()
+    job_queue.finish_job(job_id, "succeeded")
+    job_queue.finish_job(job_id, "failed", "late")
+    assert database.query_one("SELECT state, error FROM jobs") == {"state": "succeeded", "error": None}
+
+
+def test_concurrent_claims_never_take_a_job_twice(database, monkeypatch):
+    monkeypatch.setattr(job_queue, "JOB_MAX_RUNNING", 100)
+    ids = [job_queue.enqueue("test", {}) for _ in range(20)]
+    claimed = []
+
+    def worker():
+        while True:
+            jobs = job_queue.claim_jobs()
+            if not jobs:
+                return
+            claimed.extend(job["id"] for job in jobs)
+
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(claimed) == ids
+
+
+def test_cancel_only_cancels_queued_jobs(database):
+    running = job_queue.enqueue("test", {})
+    queued = job_queue.enqueue("test", {})
+    job_queue.claim_jobs()
+
+    assert not job_queue.cancel(running)
+    assert job_queue.cancel(queued)
+    assert not job_queue.cancel(queued)
+    assert not job_queue.cancel(12345)
+    assert _states(database) == {running: "running", queued: "cancelled"}
@@ -0,0 +1,49 @@
+import json
+import metrics
+import metrics_shared
+
+
+def test_render_adds_snapshots_of_other_processes():
+    counter = metrics.Counter("test_jobs_total", "Jobs.", ("kind",))
+    histogram = metrics.Histogram("test_job_seconds", "Job time.", (), (1, 5))
+    counter.inc(kind="deploy")
+    histogram.observe(0.5)
+    other = {"test_jobs_total": [[["deploy"], 2], [["delete"], 1]],
+             "test_job_seconds": [[[], [[0, 1, 1], 3.0]]]}
+
+    text = metrics.render([other])
+    assert 'test_jobs_total{kind="delete"} 1' in text
+    assert 'test_jobs_total{kind="deploy"} 3' in text
+    assert 'test_job_seconds_bucket{le="1"} 1' in text
+    assert 'test_job_seconds_bucket{le="5"} 2' in text
+    assert "test_job_seconds_count 2" in text
+    assert "test_job_seconds_sum 3.5" in text
+    # This process's own values are untouched
+    assert counter.snapshot() == [[["deploy"], 1]]
+
+
+def test_merge_snapshots_skips_other_bucket_layouts():
+    histogram = metrics.Histogram("test_merge_seconds", "", (), (1, 5))
+    merged = metrics.merge_snapshots([{"test_merge_seconds": [[[], [[1, 1, 1], 0.5]]]},
+                                      {"test_merge_seconds": [[[], [[1, 1], 0.5]]]},
+                                      {"test_merge_seconds": [[[], [[0, 1, 1], 2.0]]]}])
+    assert merged["test_merge_seconds"] == [[[], [[1, 2, 2], 2.5]]]
+    assert histogram.snapshot() == []
+
+
+def test_publish_retires_exited_processes(database):
+    counter = metrics.Counter("test_published_total", "")
+    counter.inc(4)
+    dead = json.dumps({"test_published_total": [[[], 10]]})
+    database.execute("INSERT INTO metric_snapshots (process, pid, updated_at, data) VALUES ('999999:1', 999999, '', ?)",
+                     (dead,))
+    metrics_shared.publish()
+    processes = {row["process"] for row in database.query("SELECT process FROM metric_snapshots")}
+    assert "999999:1" not in processes and metrics_shared.RETIRED in processes
+    assert "test_published_total 14" in metrics_shared.render()
+
+    # Retired counts stay when more processes exit
+    database.execute("INSERT INTO metric_snapshots (process, pid, updated_at, data) VALUES ('999998:1', 999998, '', ?)",
+                     (dead,))
+    metrics_shared.publish()
+    assert "test_published_total 24" in metrics_shared.render()
@@ -0,0 +1,79 @@
+import pytest
+
+import placement
+
+
+def _vm(name, cpu=1, ram_gb=2, disk=10, **groups):
+    return dict(name=name, cpu=cpu, ram=ram_gb * 1024, disk=disk, **groups)
+
+
+def _hosts(*mems, cpu=32, disk=1000):
+    return [placement.HostCapacity(f"hv{i}", i, cpu, mem, disk) for i, mem in enumerate(mems)]
+
+
+def _placed(plan):
+    return {hv_id: [vm['name'] for vm in vms] for hv_id, vms in plan.items()}
+
+
+def test_spread_round_robins_across_hosts():
+    vms = [_vm(f"vm{i}") for i in range(4)]
+    plan = placement.place_vms(vms, _hosts(64, 64, 64), "spread")
+    assert _placed(plan) == {"hv0": ["vm0", "vm3"], "hv1": ["vm1"], "hv2": ["vm2"]}
+
+
+def test_best_fit_fills_the_tightest_host_first():
+    vms = [_vm("vm0", ram_gb=4), _vm("vm1", ram_gb=4), _vm("vm2", ram_gb=4)]
+    plan = placement.place_vms(vms, _hosts(32, 8, 16), "best-fit")
+    assert _placed(plan) == {"hv0": [], "hv1": ["vm0", "vm1"], "hv2": ["vm2"]}
+
+
+def test_worst_fit_picks_the_host_with_most_free_memory():
+    vms = [_vm("vm0", ram_gb=4), _vm("vm1", ram_gb=4)]
+    plan = placement.place_vms(vms, _hosts(8, 32, 30), "worst-fit")
+    assert _placed(plan) == {"hv0": [], "hv1": ["vm0"], "hv2": ["vm1"]}
+
+
+def test_hosts_short_on_cpu_or_disk_are_skipped():
+    hosts = [placement.HostCapacity("small", 0, 1, 64, 1000),
+             placement.HostCapacity("big", 1, 8, 64, 1000)]
+    plan = placement.place_vms([_vm("vm0", cpu=4)], hosts, "best-fit")
+    assert _placed(plan) == {"small": [], "big": ["vm0"]}
+
+
+def test_unplaceable_vm_raises():
+    with pytest.raises(placement.PlacementError, match="vm1"):
+        placement.place_vms([_vm("vm0", ram_gb=6), _vm("vm1", ram_gb=6)], _hosts(8), "spread")
+
+
+def test_unknown_strategy_is_rejected():
+    with pytest.raises(placement.PlacementError, match="Unknown placement strategy"):
+        placement.place_vms([_vm("vm0")], _hosts(8), "random")
+
+
+def test_host_capacity_applies_overcommit_ratios():
+    host = placement.host_capacity("hv0", 0, (8, 64, 500), (10, 60, 100),
+                                   cpu_ratio=4.0, mem_ratio=1.5, disk_ratio=1.0)
+    assert (host.cpu, host.mem, host.disk) == (22, 36, 400)
+
+
+def test_vm_demand_converts_ram_to_gb():
+    assert placement.vm_demand(_vm("vm0", cpu=2, ram_gb=4, disk=20)) == (2, 4, 20)
+
+
+@pytest.mark.parametrize("strategy", placement.STRATEGIES)
+def test_anti_affinity_places_members_on_distinct_hosts(strategy):
+    vms = [_vm(f"vm{i}", anti_affinity="db") for i in range(3)]
+    plan = placement.place_vms(vms, _hosts(64, 64, 64), strategy)
+    assert all(len(names) == 1 for names in _placed(plan).values())
+
+
+def test_anti_affinity_fails_with_fewer_hosts_than_members():
+    vms = [_vm(f"vm{i}", anti_affinity="db") for i in range(3)]
+    with pytest.raises(placement.PlacementError, match="anti-affinity group 'db'"):
+        placement.place_vms(vms, _hosts(64, 64), "best-fit")
+
+
+def test_affinity_keeps_members_together():
+    vms = [_vm(f"vm{i}", affinity="web") for i in range(3)]
+    plan = placement.place_vms(vms, _hosts(64, 64, 64), "spread")
+    assert _placed(plan)["hv0"] == ["vm0", "vm1", "vm2"]
@@ -0,0 +1,120 @@
+from conftest import fixture
+import preflight
+
+K8S_IMAGE = "/home/qcow2images/NSP_K8S_PLATFORM_RHEL*.qcow2"
+DEFAULT_IMAGE = "/home/qcow2images/default.qcow2"
+IMAGES = [K8S_IMAGE, DEFAULT_IMAGE]
+
+
+def _vm(name, image=DEFAULT_IMAGE, ram_gb=2, disk=20, **extra):
+    return dict(name=name, qcow2_image=image, cpu=2, ram=ram_gb * 1024, disk=disk, **extra)
+
+
+def _entry(hv_id, *vms):
+    return {"hv_id": hv_id, "hv": {"ip": f"10.0.0.{hv_id}", "username": "root", "password": "x"},
+            "vms": list(vms)}
+
+
+def _problems(report):
+    return {r["name"]: r["problems"] for r in report}
+
+
+def test_build_preflight_script_sections():
+    script = preflight.build_preflight_script(IMAGES, "br0", ["10.20.0.5"])
+    for name in ("image0", "image1", "bridge", "pools", "df", "meminfo", "domains", "ips_in_use"):
+        assert f"echo '@@section {name}'" in script
+    # The image name is a glob and must reach the shell unquoted
+    assert "ls -1d /home/qcow2images/NSP_K8S_PLATFORM_RHEL*.qcow2" in script
+    assert "ips_in_use" not in preflight.build_preflight_script(IMAGES, "br0", [])
+
+
+def test_parse_preflight_ready_host():
+    facts = preflight.parse_preflight(fixture("preflight", "ready.txt"), IMAGES)
+    assert facts["images"] == {K8S_IMAGE: "/home/qcow2images/NSP_K8S_PLATFORM_RHEL8-23.11.qcow2",
+                               DEFAULT_IMAGE: DEFAULT_IMAGE}
+    assert facts["bridge"]
+    # The storage pool wins over df
+    assert (facts["free_disk"], facts["free_disk_on"]) == (2700, "pool default")
+    assert facts["free_mem"] == 384
+    assert facts["domains"] == {"nsp-deployer-01", "nfmp-01"}
+    assert facts["ips_in_use"] == set()
+
+
+def test_parse_preflight_degraded_host():
+    facts = preflight.parse_preflight(fixture("preflight", "degraded.txt"), IMAGES)
+    assert facts["images"][K8S_IMAGE] is None
+    assert not facts["bridge"]
+    assert (facts["free_disk"], facts["free_disk_on"]) == (15, "/home")
+    assert facts["free_mem"] == 6
+    assert facts["ips_in_use"] == {"10.20.0.12"}
+
+
+def test_parse_preflight_without_output():
+    facts = preflight.parse_preflight("", IMAGES)
+    assert facts["images"] == {K8S_IMAGE: None, DEFAULT_IMAGE: None}
+    assert (facts["bridge"], facts["free_disk"], facts["free_mem"]) == (False, None, None)
+
+
+def test_vm_problems_ready_host_flags_existing_domain(database):
+    facts = {1: preflight.parse_preflight(fixture("preflight", "ready.txt"), IMAGES)}
+    plan = [_entry(1, _vm("nfmp-01"), _vm("nfmp-02", image=K8S_IMAGE))]
+    report = preflight.vm_problems(plan, facts, "br0")
+    assert _problems(report) == {"nfmp-01": ["domain with this name already exists"], "nfmp-02": []}
+    assert [r["ok"] for r in report] == [False, True]
+
+
+def test_vm_problems_degraded_host(database):
+    facts = {1: preflight.parse_preflight(fixture("preflight", "degraded.txt"), IMAGES)}
+    plan = [_entry(1, _vm("web-01", ram_gb=4, flatten=True),
+                   _vm("web-02", image=K8S_IMAGE, ram_gb=4, ipaddr="10.20.0.12"))]
+    problems = _problems(preflight.vm_problems(plan, facts, "br0"))
+    host = ["bridge br0 missing",
+            "15 GB free on /home, 30 GB needed for 2 VM(s)",
+            "6.0 GB memory available, 8 GB needed for 2 VM(s)"]
+    assert problems["web-01"] == host + ["domain with this name already exists"]
+    assert problems["web-02"] == host + ["no image matching " + K8S_IMAGE, "IP 10.20.0.12 answers ping"]
+
+
+def test_vm_problems_memory_check_follows_overcommit(database, monkeypatch):
+    monkeypatch.setattr(preflight, "MEM_OVERCOMMIT", 2.0)
+    facts = {1: preflight.parse_preflight(fixture("preflight", "degraded.txt"), IMAGES)}
+    plan = [_entry(1, _vm("api-01", ram_gb=4, disk=5), _vm("api-02", ram_gb=4, disk=5))]
+    assert _problems(preflight.vm_problems(plan, facts, "br0")) == {
+        "api-01": ["bridge br0 missing"], "api-02": ["bridge br0 missing"]}
+
+
+def test_vm_problems_checks_database_and_requested_ips(database):
+    hv_id = database.execute(
+        "INSERT INTO hypervisors (name, ip, username, password) VALUES ('hv1', '10.0.0.1', 'root', 'x')"
+    ).lastrowid
+    database.execute("INSERT INTO vms (name, hv_id, ip_addr, status) VALUES ('db-01', ?, '10.20.0.7', 'running')",
+                     (hv_id,))
+    facts = {hv_id: preflight.parse_preflight(fixture("preflight", "ready.txt"), IMAGES)}
+    plan = [_entry(hv_id, _vm("db-01"), _vm("db-02", ipaddr="10.20.0.7"),
+                   _vm("db-03", ipaddr="10.20.0.8"), _vm("db-04", ipaddr="10.20.0.8"))]
+    assert _problems(preflight.vm_problems(plan, facts, "br0")) == {
+        "db-01": ["name already in the database"],
+        "db-02": ["IP 10.20.0.7 already assigned to db-01"],
+        "db-03": ["IP 10.20.0.8 requested more than once"],
+        "db-04": ["IP 10.20.0.8 requested more than once"],
+    }
+
+
+def test_unreachable_host_fails_every_vm(database, monkeypatch):
+    def run(*args, **kwargs):
+        raise TimeoutError("timed out")
+
+    monkeypatch.setattr(preflight.ssh_pool, "run", run)
+    entry = _entry(1, _vm("vm1"), _vm("vm2"))
+    facts = {1: preflight.check_host(entry, "br0")}
+    assert facts[1] == {"error": "timed out"}
+    assert _problems(preflight.vm_problems([entry], facts, "br0")) == {
+        "vm1": ["hypervisor unreachable: timed out"], "vm2": ["hypervisor unreachable: timed out"]}
+
+
+def test_run_preflight_resolves_image_globs(database, monkeypatch):
+    monkeypatch.setattr(preflight.ssh_pool, "run", lambda *a, **kw: fixture("preflight", "ready.txt"))
+    vm = _vm("vm1", image=K8S_IMAGE)
+    report = preflight.run_preflight([_entry(1, vm), _entry(2)], "br0")
+    assert [r["ok"] for r in report] == [True]
+    assert vm["qcow2_image"] == "/home/qcow2images/NSP_K8S_PLATFORM_RHEL8-23.11.qcow2"
@@ -0,0 +1,109 @@
+from conftest import fixture
+from virsh_collect import (build_collect_script, split_sections, parse_nodeinfo, parse_domstats,
+                           parse_pools, parse_domifaddr, parse_inventory)
+
+
+def test_split_sections_ignores_output_before_first_marker():
+    sections = split_sections(fixture("virsh", "collect.txt"))
+    assert list(sections) == ["nodeinfo", "domstats", "pools", "addresses"]
+    assert "Last login" not in sections["nodeinfo"]
+    assert sections["nodeinfo"].startswith("CPU model:")
+
+
+def test_split_sections_of_build_collect_script_markers():
+    output = "@@section a\none\n@@section b\n@@section c\nthree\nfour"
+    assert split_sections(output) == {"a": "one", "b": "", "c": "three\nfour"}
+    assert build_collect_script([("a", "true")]) == "echo '@@section a'; true 2>/dev/null"
+
+
+def test_split_sections_empty():
+    assert split_sections("") == {}
+    assert split_sections("no markers at all\n") == {}
+
+
+def test_parse_nodeinfo():
+    assert parse_nodeinfo(fixture("virsh", "nodeinfo.txt")) == {"cpu": 64, "memory": 503}
+
+
+def test_parse_nodeinfo_empty():
+    assert parse_nodeinfo("") == {"cpu": 0, "memory": 0}
+
+
+def test_parse_domstats_multiple_domains():
+    domains = {d["name"]: d for d in parse_domstats(fixture("virsh", "domstats.txt"))}
+    assert list(domains) == ["nsp-deployer-01", "nfmp-01", "cluster-03", "guestfs-8x2kq0hcn4ud7a1e"]
+
+    deployer = domains["nsp-deployer-01"]
+    assert (deployer["state"], deployer["active"]) == ("running", True)
+    assert (deployer["cpu"], deployer["memory"]) == (8, 32)
+    # Only qcow2 disks count, not the attached ISO
+    assert deployer["disk"] == 200
+    assert [d["name"] for d in deployer["disks"]] == ["vda", "hda"]
+
+    nfmp = domains["nfmp-01"]
+    assert (nfmp["state"], nfmp["active"]) == ("shut off", False)
+    # Inactive domains report no vcpu.current
+    assert (nfmp["cpu"], nfmp["memory"], nfmp["disk"]) == (16, 64, 500)
+
+    cluster = domains["cluster-03"]
+    assert (cluster["state"], cluster["active"]) == ("paused", True)
+    assert (cluster["disk"], cluster["disks"]) == (0, [])
+
+
+def test_parse_domstats_empty():
+    assert parse_domstats("") == []
+
+
+def test_parse_domstats_unknown_state_and_missing_stats():
+    domains = parse_domstats("Domain: 'odd'\n  state.state=42\n")
+    assert domains == [{"name": "odd", "state": "Unknown", "active": False, "cpu": 0,
+                        "memory": 0, "disk": 0, "disks": []}]
+
+
+def test_parse_pools():
+    pools = {p["name"]: p for p in parse_pools(fixture("virsh", "pools.txt"))}
+    assert pools["default"] == {"name": "default", "state": "running", "capacity": 3724,
+                                "allocation": 1024, "available": 2700}
+    # An inactive pool prints no sizes
+    assert pools["iso"] == {"name": "iso", "state": "inactive", "capacity": 0,
+                            "allocation": 0, "available": 0}
+    # Older virsh without --bytes prints units
+    assert (pools["images"]["capacity"], pools["images"]["allocation"],
+            pools["images"]["available"]) == (1863, 512, 1351)
+
+
+def test_parse_pools_empty():
+    assert parse_pools("") == []
+
+
+def test_parse_domifaddr():
+    addresses = parse_domifaddr(fixture("virsh", "domifaddr.txt"))
+    # Lease and ARP results are merged without duplicates, IPv6 is skipped
+    assert addresses == {"nsp-deployer-01": ["192.168.122.45", "10.20.0.15"], "cluster-03": []}
+
+
+def test_parse_domifaddr_empty():
+    assert parse_domifaddr("") == {}
+
+
+def test_parse_inventory():
+    inventory = parse_inventory(fixture("virsh", "collect.txt"))
+    assert inventory["node"] == {"cpu": 64, "memory": 503}
+    # libguestfs appliances are not VMs
+    assert [d["name"] for d in inventory["domains"]] == ["nsp-deployer-01", "nfmp-01", "cluster-03"]
+    assert inventory["domains"][0]["addresses"] == ["192.168.122.45", "10.20.0.15"]
+    assert inventory["domains"][1]["addresses"] == []
+    assert [p["name"] for p in inventory["pools"]] == ["default", "iso", "images"]
+
+
+def test_parse_inventory_partial_output():
+    # pool-list failed and the connection dropped before the addresses
+    inventory = parse_inventory(fixture("virsh", "collect_partial.txt"))
+    assert inventory["node"]["cpu"] == 64
+    assert len(inventory["domains"]) == 3
+    assert all(d["addresses"] == [] for d in inventory["domains"])
+    assert inventory["pools"] == []
+
+
+def test_parse_inventory_empty():
+    assert parse_inventory("") == {"node": {"cpu": 0, "memory": 0}, "domains": [], "pools": []}
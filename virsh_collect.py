@@ -0,0 +1,178 @@
+import logging
+from ssh_pool import ssh_pool, SSH_COMMAND_TIMEOUT
+
+# Everything the inventory needs from one hypervisor, fetched in a single
+# exec_command. Each section is introduced by a marker line so the output can
+# be split without relying on the formatting of the individual commands.
+SECTION_MARKER = "@@section "
+
+POOLS_COMMAND = "for p in $(virsh pool-list --name); do echo \"Pool: $p\"; virsh pool-info --bytes \"$p\"; done"
+
+# Guest addresses of running domains, from libvirt's DHCP leases and the
+# host's ARP table (VMs on a bridge with static addresses)
+ADDRESSES_COMMAND = ("for d in $(virsh list --name); do echo \"Domain: $d\"; "
+                     "virsh domifaddr \"$d\" --source lease; virsh domifaddr \"$d\" --source arp; done")
+
+COLLECT_SECTIONS = [
+    ("nodeinfo", "virsh nodeinfo"),
+    ("domstats", "virsh domstats --raw --state --vcpu --balloon --block"),
+    ("pools", POOLS_COMMAND),
+    ("addresses", ADDRESSES_COMMAND),
+]
+
+# Units virsh pool-info prints when --bytes is not supported
+SIZE_UNITS = {"B": 1, "bytes": 1, "KiB": 1024, "MiB": 1024 ** 2, "GiB": 1024 ** 3,
+              "TiB": 1024 ** 4, "PiB": 1024 ** 5}
+
+# virDomainState values as printed by `virsh domstats --raw`, mapped to the
+# strings `virsh domstate` prints
+DOMAIN_STATES = {
+    0: "no state",
+    1: "running",
+    2: "idle",
+    3: "paused",
+    4: "in shutdown",
+    5: "shut off",
+    6: "crashed",
+    7: "pmsuspended",
+}
+
+
+def build_collect_script(sections=COLLECT_SECTIONS):
+    parts = []
+    for name, command in sections:
+        parts.append(f"echo '{SECTION_MARKER}{name}'; {command} 2>/dev/null")
+    return "; ".join(parts)
+
+
+def split_sections(output):
+    sections = {}
+    current = None
+    for line in output.splitlines():
+        if line.startswith(SECTION_MARKER):
+            current = line[len(SECTION_MARKER):].strip()
+            sections[current] = []
+        elif current is not None:
+            sections[current].append(line)
+    return {name: "\n".join(lines) for name, lines in sections.items()}
+
+
+def parse_nodeinfo(output):
+    hv_info = {}
+    for line in output.splitlines():
+        if ":" in line:
+            key, value = line.split(":", 1)
+            hv_info[key.strip()] = value.strip()
+
+    return {
+        "cpu": int(hv_info.get("CPU(s)", 0)),
+        "memory": int(hv_info.get("Memory size", "0").split()[0]) // 1024 // 1024,
+    }
+
+
+def parse_domstats(output):
+    """Parse `virsh domstats --raw` output into one record per domain.
+
+    cpu is the current vCPU count, memory the maximum memory in GB and disk
+    the summed capacity in GB of the domain's qcow2 disks.
+    """
+    raw = []
+    for line in output.splitlines():
+        line = line.strip()
+        if line.startswith("Domain:"):
+            name = line.split(":", 1)[1].strip().strip("'\"")
+            raw.append((name, {}))
+        elif "=" in line and raw:
+            key, value = line.split("=", 1)
+            raw[-1][1][key.strip()] = value.strip()
+
+    domains = []
+    for name, stats in raw:
+        state = int(stats.get("state.state", 0) or 0)
+        cpu = int(stats.get("vcpu.current") or stats.get("vcpu.maximum") or 0)
+        memory = int(stats.get("balloon.maximum", 0) or 0) // 1024 // 1024
+
+        disks = []
+        for i in range(int(stats.get("block.count", 0) or 0)):
+            path = stats.get(f"block.{i}.path", "")
+            capacity = int(stats.get(f"block.{i}.capacity", 0) or 0)
+            disks.append({
+                "name": stats.get(f"block.{i}.name", ""),
+                "path": path,
+                "capacity": capacity,
+            })
+        disk = sum(d["capacity"] for d in disks if d["path"].endswith(".qcow2")) // (1024 ** 3)
+
+        domains.append({
+            "name": name,
+            "state": DOMAIN_STATES.get(state, "Unknown"),
+            "active": state in (1, 2, 3, 4, 7),
+            "cpu": cpu,
+            "memory": memory,
+            "disk": disk,
+            "disks": disks,
+        })
+    return domains
+
+
+def _parse_size(value):
+    parts = value.split()
+    if not parts:
+        return 0
+    return int(float(parts[0]) * SIZE_UNITS.get(parts[1] if len(parts) > 1 else "B", 1))
+
+
+def parse_pools(output):
+    """Parse `virsh pool-info` blocks into records with sizes in GB."""
+    pools = []
+    for line in output.splitlines():
+        if ":" not in line:
+            continue
+        key, value = (s.strip() for s in line.split(":", 1))
+        if key == "Pool":
+            pools.append({"name": value, "state": None, "capacity": 0, "allocation": 0, "available": 0})
+        elif pools and key == "State":
+            pools[-1]["state"] = value
+        elif pools and key in ("Capacity", "Allocation", "Available"):
+            pools[-1][key.lower()] = _parse_size(value) // (1024 ** 3)
+    return pools
+
+
+def parse_domifaddr(output):
+    """Map domain names to their IPv4 addresses from `virsh domifaddr` blocks."""
+    addresses = {}
+    current = None
+    for line in output.splitlines():
+        fields = line.split()
+        if line.startswith("Domain:"):
+            current = addresses.setdefault(line.split(":", 1)[1].strip(), [])
+        elif current is not None and len(fields) >= 4 and fields[-2] == "ipv4":
+            ip = fields[-1].split("/")[0]
+            if ip not in current:
+                current.append(ip)
+    return addresses
+
+
+def parse_inventory(output):
+    sections = split_sections(output)
+    addresses = parse_domifaddr(sections.get("addresses", ""))
+    domains = [
+        d for d in parse_domstats(sections.get("domstats", ""))
+        if not d["name"].startswith("guestfs")
+    ]
+    for d in domains:
+        d["addresses"] = addresses.get(d["name"], [])
+    return {
+        "node": parse_nodeinfo(sections.get("nodeinfo", "")),
+        "domains": domains,
+        "pools": parse_pools(sections.get("pools", "")),
+    }
+
+
+def collect_hv_inventory(ip, username, password, timeout=SSH_COMMAND_TIMEOUT):
+    """Fetch node and per-domain data from a hypervisor in one round-trip."""
+    output = ssh_pool.run(ip, username, password, build_collect_script(), timeout=timeout,
+                          label="inventory")
+    inventory = parse_inventory(output)
+    logging.debug(f"Collected {len(inventory['domains'])} domains from {ip}")
+    return inventory
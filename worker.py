@@ -0,0 +1,95 @@
+"""Background worker process: runs queued jobs and the inventory poller.
+
+Run exactly one next to the web tier (wsgi.py), with the same HV_DB_FILE
+and LOG_DIR; a second one exits. The web tier queues jobs in the database
+and reads their state, events and logs back from it.
+"""
+import os
+import sys
+import signal
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from contextlib import closing
+import job_logs
+
+job_logs.setup_logging(app_log="worker.jsonl")
+
+import db
+import metrics
+import metrics_shared
+import job_queue
+import ansible_engine
+import hv_inventory
+# Importing these registers the deploy and delete job handlers
+import deploy_vm_handler2  # noqa: F401
+import delete_vm  # noqa: F401
+
+# Port of a /metrics served by the worker too, 0 to disable. It shows the
+# same sums over all processes as the web tier's /metrics.
+WORKER_METRICS_PORT = int(os.environ.get("WORKER_METRICS_PORT", "0"))
+# Seconds running jobs get to finish on SIGTERM. Their playbooks are then
+# stopped and the jobs get WORKER_STOP_GRACE seconds to record the failure;
+# jobs still running after that are requeued when the worker starts again
+WORKER_SHUTDOWN_TIMEOUT = int(os.environ.get("WORKER_SHUTDOWN_TIMEOUT", "60"))
+WORKER_STOP_GRACE = int(os.environ.get("WORKER_STOP_GRACE", "30"))
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = metrics_shared.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", metrics.CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_metrics(port):
+    server = ThreadingHTTPServer(("0.0.0.0", port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="worker-metrics", daemon=True).start()
+    logging.info(f"Worker metrics on port {port}")
+    return server
+
+
+def main():
+    with closing(db.lock_file("init")):
+        db.migrate()
+        job_logs.prune_job_logs()
+    try:
+        job_queue.start_job_workers()
+    except job_queue.WorkersRunningError as e:
+        logging.error(str(e))
+        print(e, file=sys.stderr)
+        return 1
+    hv_inventory.start_inventory_poller()
+    metrics_shared.start_publisher()
+    if WORKER_METRICS_PORT:
+        serve_metrics(WORKER_METRICS_PORT)
+
+    stop = threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *_: stop.set())
+    logging.info(f"Worker started with {job_queue.JOB_WORKERS} job threads, pid {os.getpid()}")
+    stop.wait()
+
+    logging.info("Worker stopping")
+    hv_inventory.stop_inventory_poller()
+    if not job_queue.stop_job_workers(WORKER_SHUTDOWN_TIMEOUT):
+        # Playbooks run in their own session and would outlive this process
+        stopped = ansible_engine.terminate_playbooks()
+        logging.warning(f"Jobs still running after {WORKER_SHUTDOWN_TIMEOUT}s, stopped {stopped} playbook(s)")
+        if not job_queue.stop_job_workers(WORKER_STOP_GRACE):
+            logging.warning("Jobs still running, they are requeued on next start")
+    metrics_shared.publish()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
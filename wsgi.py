@@ -0,0 +1,10 @@
+"""WSGI entry point of the web tier: gunicorn -c gunicorn.conf.py wsgi:app
+
+Only serves requests. Jobs and the inventory poller run in worker.py; the
+two talk through the database.
+"""
+from app import app, init_db
+import metrics_shared
+
+init_db()
+metrics_shared.start_publisher()